@@ -1,15 +1,53 @@
-import pickle
-from sqlalchemy import create_engine, Column, Integer, Text, LargeBinary
+import hashlib
+import json
+import struct
+import threading
+from sqlalchemy import create_engine, insert, Column, Integer, Text, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
-from llm import create_template_string
+from llm import TEMPLATE_VERSION, count_tokens, create_template_string
 import pandas as pd
 import numpy as np
-from sentence_transformers import SentenceTransformer
+from bm25_index import hybrid_search
+from cache import embedding_cache_from_env
+from vector_store import VectorStore, get_vector_store, load_sidecar, save_sidecar
 
 
 Base = declarative_base()
-model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+_model = None
+_model_lock = threading.Lock()
+# embeddings of recent queries, so that repeated queries skip the encoder
+query_cache = embedding_cache_from_env(MODEL_NAME)
+
+
+def get_model():
+    """
+    Returns the SentenceTransformer used to embed books and queries, loading it on first use.
+    sentence_transformers imports torch, so the import is deferred too.
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from sentence_transformers import SentenceTransformer
+                _model = SentenceTransformer(MODEL_NAME)
+    return _model
+
+
+def __getattr__(name: str):
+    # keeps alchemy_database.model working without loading the model when the module is imported
+    if name == 'model':
+        return get_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Every stored embedding is a header followed by the raw little-endian vector.
+# The header holds a magic string, the storage format version, a dtype code and the dimension.
+EMBEDDING_MAGIC = b'BEMB'
+EMBEDDING_FORMAT_VERSION = 1
+EMBEDDING_HEADER = struct.Struct('<4sBcH')
+EMBEDDING_DTYPES = {b'f': np.dtype('<f4')}
 
 
 class Book(Base):
@@ -20,37 +58,217 @@ class Book(Base):
     """
     __tablename__ = "books"
     id = Column(Integer, primary_key=True, unique=True, index=True)
+    wikipedia_id = Column(Integer, unique=True, index=True)  # stable key from the Kaggle dataset
+    freebase_id = Column(Text)
     title = Column(Text)
     author = Column(Text)
-    genres = Column(LargeBinary)  # dictionary
+    genres = Column(Text)  # JSON object
     summary = Column(Text)
     pub_date = Column(Text)
-    embedding = Column(LargeBinary)  # np array
+    embedding = Column(LargeBinary)  # header + raw float32 vector, see encode_embedding
+    content_hash = Column(Text)  # hash of the embedding input, see content_hash
+    context = Column(Text)  # output of create_template_string, reused in prompts
+    context_tokens = Column(Integer)  # estimated number of tokens in context
+    context_version = Column(Integer)  # llm.TEMPLATE_VERSION the context was rendered with
 
     def __repr__(self):
         return f"('{self.title}')"
 
 
-def make_book_df(db: Session) -> pd.DataFrame:
+def encode_embedding(embedding: np.ndarray) -> bytes:
+    """
+    Serializes an embedding vector for storage in the database.
+    Args:
+        embedding (numpy array): embedding vector
+
+    Returns:
+        Header followed by the vector as raw little-endian float32 bytes
+    """
+    vector = np.asarray(embedding, dtype='<f4').ravel()
+    return EMBEDDING_HEADER.pack(EMBEDDING_MAGIC, EMBEDDING_FORMAT_VERSION, b'f', len(vector)) + vector.tobytes()
+
+
+def decode_embeddings(blobs: list[bytes]) -> np.ndarray:
+    """
+    Deserializes many stored embeddings at once with a single np.frombuffer over their concatenation.
+    Args:
+        blobs (list[bytes]): embeddings as written by encode_embedding, all with the same dimension
+
+    Returns:
+        (N, dim) float32 matrix with one row per blob
+    """
+    if not blobs:
+        return np.zeros((0, 0), dtype=np.float32)
+    header = blobs[0][:EMBEDDING_HEADER.size]
+    if len(header) < EMBEDDING_HEADER.size:
+        raise ValueError("Stored embeddings are not in a recognized format. Run migrate_database.py to convert them.")
+    magic, version, dtype_code, dim = EMBEDDING_HEADER.unpack(header)
+    if magic != EMBEDDING_MAGIC:
+        raise ValueError("Stored embeddings are not in a recognized format. Run migrate_database.py to convert them.")
+    if version != EMBEDDING_FORMAT_VERSION or dtype_code not in EMBEDDING_DTYPES:
+        raise ValueError(f"Unsupported embedding format version {version} with dtype {dtype_code!r}")
+    row_dtype = np.dtype([('header', f'V{EMBEDDING_HEADER.size}'), ('vector', EMBEDDING_DTYPES[dtype_code], (dim,))])
+    buffer = b''.join(blobs)
+    if len(buffer) != row_dtype.itemsize * len(blobs):
+        raise ValueError("Stored embeddings do not all have the same dimension")
+    rows = np.frombuffer(buffer, dtype=row_dtype)
+    if not np.all(rows['header'] == rows['header'][0]):
+        raise ValueError("Stored embeddings do not all have the same header")
+    # copy the vectors out of the interleaved buffer so that the buffer can be freed
+    return np.array(rows['vector'], dtype=np.float32)
+
+
+def decode_embedding(blob: bytes) -> np.ndarray:
+    """
+    Deserializes a single stored embedding.
+    Args:
+        blob (bytes): embedding as written by encode_embedding
+
+    Returns:
+        Embedding vector as a float32 numpy array
+    """
+    return decode_embeddings([blob])[0]
+
+
+def content_hash(data: str) -> str:
+    """
+    Hashes the text a book's embedding is computed from together with the name of the embedding model,
+    so that a book only needs to be embedded again when this hash changes.
+    Args:
+        data (str): output of create_template_string for the book
+
+    Returns:
+        Hex digest of the model name and text
+    """
+    return hashlib.sha256(f"{MODEL_NAME}\n{data}".encode()).hexdigest()
+
+
+def context_columns(text: str) -> dict:
+    """
+    Returns the values of the context columns of a book, given its create_template_string output.
+    """
+    return {"context": text, "context_tokens": count_tokens(text), "context_version": TEMPLATE_VERSION}
+
+
+def encode_genres(genres: dict[str, str] | None) -> str | None:
+    """
+    Serializes a genre dictionary for storage in the database.
+    """
+    return None if genres is None else json.dumps(genres)
+
+
+def decode_genres(genres: str | None) -> dict[str, str] | None:
+    """
+    Deserializes a stored genre dictionary.
+    """
+    if isinstance(genres, bytes):
+        raise ValueError("Stored genres are not in a recognized format. Run migrate_database.py to convert them.")
+    return None if genres is None else json.loads(genres)
+
+
+def embedding_checksum(ids: np.ndarray, hashes: list[str | None]) -> str:
+    """
+    Computes a checksum of stored embeddings, used to tell whether an embedding sidecar is stale.
+    A book is embedded again exactly when its content_hash changes, so the checksum covers the ids and content hashes
+    instead of the embeddings, and checking a sidecar does not read every embedding from the database.
+    Args:
+        ids (numpy array): book id of each embedding
+        hashes (list[str]): content_hash of each book
+
+    Returns:
+        Hex digest over the ids and content hashes
+    """
+    digest = hashlib.sha256(np.asarray(ids, dtype='<i8').tobytes())
+    for book_hash in hashes:
+        digest.update(f"{book_hash or ''}\n".encode())
+    return digest.hexdigest()
+
+
+def open_embedding_sidecar(db: Session, ids: np.ndarray, hashes: list[str | None], sidecar_path: str) -> VectorStore:
+    """
+    Builds a vector store that is a read-only memmap of the sidecar file.
+    The file is (re)written first if it is missing or does not match the database; only then are the embeddings read.
+    Args:
+        db (Session): a database session
+        ids (numpy array): book id of each embedding, in id order
+        hashes (list[str]): content_hash of each book
+        sidecar_path (str): path of the .npy sidecar file
+
+    Returns:
+        VectorStore for the embeddings, in memory instead if the sidecar cannot be read back
+    """
+    metadata = {'model': MODEL_NAME, 'checksum': embedding_checksum(ids, hashes)}
+    store = load_sidecar(sidecar_path, ids, metadata)
+    if store is None:
+        blobs = [row.embedding for row in db.query(Book.embedding).order_by(Book.id)]
+        built = VectorStore(decode_embeddings(blobs), ids)
+        save_sidecar(built, sidecar_path, metadata)
+        # another process can replace the sidecar in the meantime; this process then keeps its own copy
+        store = load_sidecar(sidecar_path, ids, metadata) or built
+    return store
+
+
+def make_book_df(db: Session, sidecar_path: str | None = None) -> pd.DataFrame:
     """
     Given a database db and model, creates a pandas dataframe that includes equivalent information.
     Args:
         db (Session) : a database session
+        sidecar_path (str) : optional .npy file to memory-map the embeddings from, so that processes share them.
+            It is created or rebuilt when it is missing or stale. The embedding column then holds normalized vectors.
 
     Returns:
-        DataFrame representing the equivalent data from the database
+        DataFrame representing the equivalent data from the database, including each book's rendered context
+        and its token count. Contexts missing from the database or rendered with an older template are rebuilt.
     """
-    instances = db.query(Book).all()
-    data = [{"id": instance.id,
-             "title": instance.title,
-             "author": instance.author,
-             "genres": pickle.loads(instance.genres),
-             "summary": instance.summary,
-             "pub_date": instance.pub_date,
-             "embedding": np.array(pickle.loads(instance.embedding))}
-            for instance in instances]
+    # with a sidecar, the embeddings are only read from the database when the sidecar has to be rebuilt
+    rows = db.query(Book.id, Book.title, Book.author, Book.genres, Book.summary, Book.pub_date,
+                    Book.context, Book.context_tokens, Book.context_version,
+                    Book.embedding if sidecar_path is None else Book.content_hash).order_by(Book.id).all()
+    ids = np.array([row.id for row in rows], dtype=np.int64)
+    if sidecar_path is None:
+        embeddings = decode_embeddings([row.embedding for row in rows])
+        # the dataframe is shared by every request, so its arrays are read-only like the store's
+        embeddings.flags.writeable = False
+        store = VectorStore(embeddings, ids)
+    else:
+        store = open_embedding_sidecar(db, ids, [row.content_hash for row in rows], sidecar_path)
+        embeddings = store.matrix
+    book_df = pd.DataFrame({"id": ids,
+                            "title": [row.title for row in rows],
+                            "author": [row.author for row in rows],
+                            "genres": [decode_genres(row.genres) for row in rows],
+                            "summary": [row.summary for row in rows],
+                            "pub_date": [row.pub_date for row in rows],
+                            "context": [row.context for row in rows],
+                            "context_tokens": [row.context_tokens for row in rows],
+                            "embedding": list(embeddings)})
+    stale = [i for i, row in enumerate(rows) if row.context is None or row.context_version != TEMPLATE_VERSION]
+    if stale:
+        columns = [context_columns(create_template_string(book))
+                   for book in book_df.iloc[stale].drop(columns=["context", "embedding"]).to_dict("records")]
+        book_df.loc[book_df.index[stale], "context"] = [column["context"] for column in columns]
+        book_df.loc[book_df.index[stale], "context_tokens"] = [column["context_tokens"] for column in columns]
+    book_df["context_tokens"] = book_df["context_tokens"].astype(np.int64)
+    # attach the search matrix up front instead of building it on the first query
+    book_df.attrs['vector_store'] = store
+    return book_df
 
-    return pd.DataFrame(data)
+
+def corpus_version(data_df: pd.DataFrame) -> str:
+    """
+    Hashes the ids and rendered contexts of the books in a dataframe together with the embedding model name
+    and the template version, so that anything cached from searching the books can tell when the books change.
+    The contexts are read from the dataframe's context column rather than rendered again.
+    Args:
+        data_df (pd.DataFrame): dataframe made by make_book_df
+
+    Returns:
+        Hex digest of the model name, template version, ids and contexts
+    """
+    digest = hashlib.sha256(f"{MODEL_NAME}\n{TEMPLATE_VERSION}".encode())
+    for book_id, context in zip(data_df['id'].tolist(), data_df['context'].tolist()):
+        digest.update(f"\n{book_id}\n{context}".encode())
+    return digest.hexdigest()
 
 
 def cosine_sim(x: np.ndarray, y: np.ndarray) -> float:
@@ -80,20 +298,40 @@ def get_max_sim(data_df: pd.DataFrame, query_vec: np.ndarray) -> dict[str, str |
     return dict(data_df.iloc[np.argmax(dot_products)])
 
 
-def get_max_sims(data_df: pd.DataFrame, query_vec: np.ndarray, n: int) -> list[dict]:
+def get_max_sims(data_df: pd.DataFrame, query_vec: np.ndarray, n: int, index=None) -> list[dict]:
     """
     Gets the n data_df dataframe entries that are most similar to the query vector.
     Args:
         data_df (pd.DataFrame): Dataframe containing embedding column of numpy array embedding vecs
         query_vec (numpy array): embedding vector representing the query
         n (int): number of most similar values to return
+        index: optional approximate index over data_df's vector store (e.g. an IVFIndex) to search instead
+            of scanning every row
 
     Returns:
         List of dictionaries representing the data in the most similar rows to the query vector,
-        ordered from most to least simiilar
+        ordered from most to least simiilar, each with its cosine similarity under 'sims'
+    """
+    searcher = index if index is not None else get_vector_store(data_df)
+    rows, scores = searcher.search(query_vec, n)
+    return rows_to_records(data_df, rows, scores)
+
+
+def rows_to_records(data_df: pd.DataFrame, rows: np.ndarray, scores: np.ndarray) -> list[dict]:
+    """
+    Converts search results into book information dictionaries.
+    Args:
+        data_df (pd.DataFrame): Dataframe that was searched
+        rows (numpy array): row positions of the results
+        scores (numpy array): cosine similarity of each result
+
+    Returns:
+        List of dictionaries representing the rows, each with its cosine similarity under 'sims'
     """
-    data_df['sims'] = data_df['embedding'].apply(lambda x: cosine_sim(x, query_vec))
-    return data_df.nlargest(n, 'sims').to_dict('records')
+    records = data_df.iloc[rows].to_dict('records')
+    for record, score in zip(records, scores):
+        record['sims'] = float(score)
+    return records
 
 
 def add_book(model, db: Session, title: str, author: str, genres: dict[str, str], summary: str, pub_date: str):
@@ -113,43 +351,143 @@ def add_book(model, db: Session, title: str, author: str, genres: dict[str, str]
                                    "genres": genres,
                                    "pub_date": pub_date,
                                    "summary": summary})
-    embedding = np.array(model.encode(data))
+    embedding = model.encode(data)
     book = Book(title=title,
                 author=author,
-                genres=pickle.dumps(genres),
+                genres=encode_genres(genres),
                 summary=summary,
                 pub_date=pub_date,
-                embedding=pickle.dumps(embedding))
+                embedding=encode_embedding(embedding),
+                content_hash=content_hash(data),
+                **context_columns(data))
     db.add(book)
     db.commit()
 
 
-def process_query_and_search(query: str, dataframe: pd.DataFrame, k: int = 1) -> list[dict]:
+def book_rows(model, books: list[dict], batch_size: int = 128) -> list[dict]:
+    """
+    Embeds books in batches and converts them into rows of the books table.
+    Args:
+        model: SentenceTransformers model for encoding document embeddings
+        books (list[dict]): dictionaries with the title, author, genres, summary and pub_date of each book,
+            and optionally its wikipedia_id and freebase_id
+        batch_size (int): number of books encoded together by the model
+
+    Returns:
+        List of dictionaries mapping Book column names to values
+    """
+    if not books:
+        return []
+    data = [create_template_string(book) for book in books]
+    embeddings = model.encode(data, batch_size=batch_size)
+    return [{"wikipedia_id": book.get("wikipedia_id"),
+             "freebase_id": book.get("freebase_id"),
+             "title": book["title"],
+             "author": book["author"],
+             "genres": encode_genres(book["genres"]),
+             "summary": book["summary"],
+             "pub_date": book["pub_date"],
+             "embedding": encode_embedding(embedding),
+             "content_hash": content_hash(text),
+             **context_columns(text)}
+            for book, text, embedding in zip(books, data, embeddings)]
+
+
+def add_books(model, db: Session, books: list[dict], batch_size: int = 128) -> None:
+    """
+    Add many books to a sqlalchemy database at once.
+    The books are embedded in batches of batch_size and inserted with one bulk INSERT in a single transaction.
+    Args:
+        model: SentenceTransformers model for encoding document embeddings
+        db (Session): database for books to be added to
+        books (list[dict]): dictionaries with the title, author, genres, summary and pub_date of each book,
+            and optionally its wikipedia_id and freebase_id
+        batch_size (int): number of books encoded together by the model
+    """
+    if not books:
+        return
+    db.execute(insert(Book), book_rows(model, books, batch_size))
+    db.commit()
+
+
+def process_query_and_search(query: str, dataframe: pd.DataFrame, k: int = 1, index=None, lexical=None) -> list[dict]:
     """
     Given a user's query, returns the most relevant documents.
     Args:
         query (str) : user's query
         dataframe (pd.DataFrame) : name of dataframe to search
         k (int) : number of books to return, default 1
+        index : optional approximate index to search instead of every row, see get_max_sims
+        lexical : optional BM25Index over dataframe whose results are fused with the embedding search,
+            see bm25_index.hybrid_search
     Returns:
-        List of book information dictionaries most similar to query
+        List of book information dictionaries most relevant to query, each with its cosine similarity under 'sims'
     """
-    # get the query embedding and convert it to a list
-    embeddings = model.encode([query])
-    query_vector = np.array(embeddings[0])
+    # get the query embedding, from the cache if the query was seen before
+    query_vector = query_cache.encode(get_model(), [query])[0]
     # search
-    return get_max_sims(dataframe, query_vector, k)
+    if lexical is not None:
+        store = get_vector_store(dataframe)
+        rows, scores = hybrid_search(index if index is not None else store, store, lexical, query, query_vector, k)
+        return rows_to_records(dataframe, rows, scores)
+    return get_max_sims(dataframe, query_vector, k, index)
+
+
+def search_rows_many(queries: list[str], dataframe: pd.DataFrame, k: int = 1, batch_size: int = 64,
+                     index=None, lexical=None) -> tuple[list[np.ndarray], list[np.ndarray]]:
+    """
+    Given many queries, returns the row positions of the most relevant documents for each of them.
+    Queries are encoded in batches, and each batch is scored against every book with one matrix product.
+    Args:
+        queries (list[str]) : users' queries
+        dataframe (pd.DataFrame) : dataframe to search
+        k (int) : number of rows to return per query, default 1
+        batch_size (int) : number of queries encoded and scored together, default 64
+        index : optional approximate index to search instead of every row, see get_max_sims
+        lexical : optional BM25Index over dataframe whose results are fused with the embedding search
+    Returns:
+        Row positions and cosine similarities of the results of each query, in the same order as queries
+    """
+    store = get_vector_store(dataframe)
+    searcher = index if index is not None else store
+    all_rows, all_scores = [], []
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        query_vectors = query_cache.encode(get_model(), batch, batch_size)
+        if lexical is not None:
+            # BM25 scores one query at a time, so only the encoding is batched
+            hits = [hybrid_search(searcher, store, lexical, query, query_vector, k)
+                    for query, query_vector in zip(batch, query_vectors)]
+            rows, scores = [rows for rows, _ in hits], [scores for _, scores in hits]
+        else:
+            rows, scores = searcher.search_many(query_vectors, k)
+        all_rows.extend(rows)
+        all_scores.extend(scores)
+    return all_rows, all_scores
+
+
+def search_many(queries: list[str], dataframe: pd.DataFrame, k: int = 1, batch_size: int = 64,
+                index=None, lexical=None) -> list[list[dict]]:
+    """
+    Given many queries, returns the most relevant documents for each of them, see search_rows_many.
+    Returns:
+        One list of book information dictionaries per query, in the same order as queries
+    """
+    rows, scores = search_rows_many(queries, dataframe, k, batch_size, index, lexical)
+    return [rows_to_records(dataframe, query_rows, query_scores)
+            for query_rows, query_scores in zip(rows, scores)]
 
 
-def make_book_db(db_url: str) -> Session:
+def make_book_db(db_url: str, echo: bool = False) -> Session:
     """
     Returns database based on specific url.
     Args:
         db_url (str): url of requested database
+        echo (bool): whether to log every SQL statement, default False
     Returns:
         Database session
     """
-    engine = create_engine(db_url, echo=True)
+    engine = create_engine(db_url, echo=echo)
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
     Base.metadata.create_all(bind=engine)
     db = SessionLocal()
@@ -1,10 +1,14 @@
+import os
+import tempfile
 import unittest
+from unittest import mock
 import numpy as np
-import pickle
 import pandas as pd
-from llm import dict_to_commas
-from alchemy_database import Book, make_book_db, add_book, make_book_df, \
-    cosine_sim, get_max_sim, get_max_sims
+from bm25_index import BM25Index
+from llm import TEMPLATE_VERSION, count_tokens, dict_to_commas
+from alchemy_database import Book, make_book_db, add_book, add_books, make_book_df, \
+    cosine_sim, get_max_sim, get_max_sims, get_model, process_query_and_search, search_many, \
+    encode_embedding, decode_embedding, decode_embeddings, decode_genres, corpus_version
 
 
 # Define the unit tests
@@ -16,6 +20,7 @@ class TestBookClass(unittest.TestCase):
             def encode(self, data):
                 return [1, 2, 3]  # Sample embedding
 
+        self.Model = Model
         self.db = make_book_db("sqlite:///:memory:")
         # add sample books to the database
         add_book(Model(), self.db, "Title 1", "Author 1", {"Genre": "Fiction"}, "Summary 1", "2022-01-01")
@@ -47,14 +52,29 @@ class TestBookClass(unittest.TestCase):
         # check if the book's attributes match the provided values
         self.assertEqual(added_book.title, "Title")
         self.assertEqual(added_book.author, "Author")
-        self.assertEqual(pickle.loads(added_book.genres), {"Genre": "Fiction"})
+        self.assertEqual(decode_genres(added_book.genres), {"Genre": "Fiction"})
         self.assertEqual(added_book.summary, "Summary")
         self.assertEqual(added_book.pub_date, "2022-01-01")
         # check if the embedding was added successfully
         expected_embedding = np.array([1, 2, 3])
-        actual_embedding = pickle.loads(added_book.embedding)
+        actual_embedding = decode_embedding(added_book.embedding)
         self.assertTrue(np.array_equal(actual_embedding, expected_embedding))
 
+    def test_add_books(self):
+        class BatchModel:
+            def encode(self, data, batch_size=32):
+                return [[len(text), 1, 0] for text in data]
+
+        db = make_book_db("sqlite:///:memory:")
+        add_books(BatchModel(), db, [
+            {"title": "Title A", "author": "Author A", "genres": {"Genre": "Fiction"},
+             "summary": "Summary A", "pub_date": "2022"},
+            {"title": "Title B", "author": None, "genres": None, "summary": "Summary B", "pub_date": None}])
+        df = make_book_df(db)
+        self.assertEqual(list(df["title"]), ["Title A", "Title B"])
+        self.assertEqual(list(df["genres"]), [{"Genre": "Fiction"}, None])
+        self.assertEqual(df["embedding"][1][0], len("Here is a summary of Title B: Summary B"))
+
     def test_make_book_df(self):
         # call make_book_df to convert database records to dataframe
         df = make_book_df(self.db)
@@ -63,13 +83,102 @@ class TestBookClass(unittest.TestCase):
         self.assertFalse(df.empty)
 
         # check if df columns are as expected
-        expected_columns = ["id", "title", "author", "genres", "summary", "pub_date", "embedding"]
+        expected_columns = ["id", "title", "author", "genres", "summary", "pub_date", "context", "context_tokens",
+                            "embedding"]
         self.assertEqual(list(df.columns), expected_columns)
 
         # check if embedding column contains np arrays
         self.assertTrue(all(isinstance(embedding, np.ndarray) for embedding in df["embedding"]))
         # check if genres column has dicts
         self.assertTrue(all(isinstance(embedding, dict) for embedding in df["genres"]))
+        # check that requests cannot modify the shared embeddings
+        self.assertFalse(any(embedding.flags.writeable for embedding in df["embedding"]))
+
+    def test_stale_context_is_rebuilt(self):
+        db = make_book_db("sqlite:///:memory:")
+        add_book(self.Model(), db, "Title", "Author", None, "Summary", "2022")
+        book = db.query(Book).one()
+        expected = book.context
+        self.assertEqual(book.context_version, TEMPLATE_VERSION)
+        self.assertEqual(book.context_tokens, count_tokens(expected))
+        book.context, book.context_version = "old", TEMPLATE_VERSION - 1
+        db.commit()
+        df = make_book_df(db)
+        self.assertEqual(df["context"][0], expected)
+        self.assertEqual(df["context_tokens"][0], count_tokens(expected))
+
+
+class TestEmbeddingSidecar(unittest.TestCase):
+    class Model:
+        def encode(self, data):
+            return [len(data), 1, 2]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "embeddings.npy")
+        self.db = make_book_db("sqlite:///:memory:")
+        add_book(self.Model(), self.db, "Title 1", "Author 1", {"Genre": "Fiction"}, "Summary 1", "2022-01-01")
+        add_book(self.Model(), self.db, "Title 2", "Author 2", None, "A longer summary", "2022-01-02")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_sidecar_matches_database(self):
+        plain_df = make_book_df(self.db)
+        sidecar_df = make_book_df(self.db, self.path)
+        self.assertTrue(os.path.exists(self.path + '.json'))
+        np.testing.assert_allclose(sidecar_df.attrs['vector_store'].matrix,
+                                   plain_df.attrs['vector_store'].matrix)
+        query_vec = np.array([20, 1, 2])
+        self.assertEqual([book['id'] for book in get_max_sims(sidecar_df, query_vec, 2)],
+                         [book['id'] for book in get_max_sims(plain_df, query_vec, 2)])
+
+    def test_stale_sidecar_is_rebuilt(self):
+        make_book_df(self.db, self.path)
+        add_book(self.Model(), self.db, "Title 3", "Author 3", None, "Summary 3", "2022-01-03")
+        df = make_book_df(self.db, self.path)
+        self.assertEqual(len(df.attrs['vector_store']), 3)
+
+    def test_reembedded_book_rebuilds_sidecar(self):
+        make_book_df(self.db, self.path)
+        book = self.db.query(Book).filter(Book.id == 1).one()
+        book.embedding, book.content_hash = encode_embedding([0, 0, 1]), "new hash"
+        self.db.commit()
+        df = make_book_df(self.db, self.path)
+        np.testing.assert_allclose(df.attrs['vector_store'].matrix[0], [0, 0, 1])
+
+    def test_sidecar_replaced_while_opening(self):
+        # another process replaces the sidecar before it can be read back
+        with mock.patch("alchemy_database.load_sidecar", return_value=None) as load:
+            df = make_book_df(self.db, self.path)
+        self.assertEqual(load.call_count, 2)
+        np.testing.assert_allclose(df.attrs['vector_store'].matrix, make_book_df(self.db).attrs['vector_store'].matrix)
+
+
+class TestStorageFormat(unittest.TestCase):
+    def test_embedding_round_trip(self):
+        embedding = np.array([0.5, -1.25, 3.0])
+        blob = encode_embedding(embedding)
+        # 8 byte header followed by three little-endian float32 values
+        self.assertEqual(len(blob), 8 + 3 * 4)
+        decoded = decode_embedding(blob)
+        self.assertEqual(decoded.dtype, np.float32)
+        self.assertTrue(np.array_equal(decoded, embedding))
+
+    def test_decode_many(self):
+        blobs = [encode_embedding([1, 2]), encode_embedding([3, 4]), encode_embedding([5, 6])]
+        self.assertTrue(np.array_equal(decode_embeddings(blobs), [[1, 2], [3, 4], [5, 6]]))
+
+    def test_mixed_dimensions(self):
+        with self.assertRaises(ValueError):
+            decode_embeddings([encode_embedding([1, 2]), encode_embedding([1, 2, 3])])
+
+    def test_legacy_pickle_rejected(self):
+        import pickle
+        with self.assertRaises(ValueError):
+            decode_embedding(pickle.dumps(np.array([1.0, 2.0])))
+        with self.assertRaises(ValueError):
+            decode_genres(pickle.dumps({"Genre": "Fiction"}))
 
 
 class TestMethods(unittest.TestCase):
@@ -127,9 +236,59 @@ class TestMethods(unittest.TestCase):
                      'genres': {'g': 'Non-Fiction'},
                      'summary': 'Summary 2',
                      'pub_date': '2022-01-02',
-                     'embedding': [1, 0, 1],
-                     'sims': cosine_sim(query_vec, np.array([1, 0, 1]))}]
+                     'embedding': [1, 0, 1]}]
+        # similarities are computed in float32, so compare them separately
+        sims = [record.pop('sims') for record in result]
         self.assertListEqual(result, expected)
+        self.assertAlmostEqual(sims[0], cosine_sim(query_vec, np.array([1, 0, 1])), places=6)
+
+    def test_get_max_sims_order(self):
+        query_vec = np.array([1, 0, 0])
+        result = get_max_sims(self.df, query_vec, 3)
+        # ties keep dataframe order, and the dataframe itself is left untouched
+        self.assertEqual([record['title'] for record in result], ['Book 1', 'Book 3', 'Book 2'])
+        self.assertNotIn('sims', self.df.columns)
+
+
+class TestSearchMany(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        db = make_book_db("sqlite:///:memory:")
+        model = get_model()
+        add_book(model, db, "Macbeth", "William Shakespeare", {"0": "Tragedy"},
+                 "A Scottish general murders his king to take the throne.", "1606")
+        add_book(model, db, "Pride and Prejudice", "Jane Austen", {"0": "Romance"},
+                 "Elizabeth Bennet spars with the proud Mr. Darcy.", "1813")
+        add_book(model, db, "Dune", "Frank Herbert", {"0": "Science Fiction"},
+                 "Paul Atreides leads a desert people on the planet Arrakis.", "1965")
+        self.df = make_book_df(db)
+        self.queries = ["Who murders the king of Scotland?",
+                        "Which book takes place on a desert planet?",
+                        "Who does Elizabeth Bennet marry?"]
+
+    def test_same_as_single_query(self):
+        results = search_many(self.queries, self.df, k=2, batch_size=2)
+        self.assertEqual(len(results), len(self.queries))
+        for query, books in zip(self.queries, results):
+            expected = process_query_and_search(query, self.df, 2)
+            self.assertEqual([book['id'] for book in books], [book['id'] for book in expected])
+
+    def test_empty(self):
+        self.assertEqual(search_many([], self.df), [])
+
+    def test_hybrid_same_as_single_query(self):
+        lexical = BM25Index.build(self.df)
+        results = search_many(self.queries, self.df, k=2, batch_size=2, lexical=lexical)
+        for query, books in zip(self.queries, results):
+            expected = process_query_and_search(query, self.df, 2, lexical=lexical)
+            self.assertEqual([book['id'] for book in books], [book['id'] for book in expected])
+        self.assertEqual(results[1][0]['title'], "Dune")
+
+    def test_corpus_version(self):
+        changed = self.df.copy()
+        changed.loc[0, 'context'] = "Dune was written by Frank Herbert. A different summary."
+        self.assertEqual(corpus_version(self.df), corpus_version(self.df.copy()))
+        self.assertNotEqual(corpus_version(self.df), corpus_version(changed))
 
 
 if __name__ == '__main__':
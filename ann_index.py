@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import numpy as np
+from vector_store import VectorStore, top_k
+
+
+def store_fingerprint(store: VectorStore, version: str = '') -> str:
+    """
+    Hashes the ids and shape of a store together with a version of its contents, to tell whether an index
+    was built from it. The embeddings themselves are not read, so checking a memmapped store stays cheap.
+    Args:
+        store (VectorStore): the store
+        version (str): changes whenever the embeddings change, e.g. alchemy_database.corpus_version
+
+    Returns:
+        Hex digest over the ids, shape and version
+    """
+    digest = hashlib.sha256(f"{store.matrix.shape}\n{version}\n".encode())
+    digest.update(np.asarray(store.ids, dtype='<i8').tobytes())
+    return digest.hexdigest()
+
+
+def spherical_kmeans(vectors: np.ndarray, n_clusters: int, n_iter: int = 20, seed: int = 0) -> np.ndarray:
+    """
+    Clusters unit vectors by cosine similarity.
+    Args:
+        vectors (numpy array): (N, dim) matrix of L2-normalized vectors
+        n_clusters (int): number of clusters, at most the number of vectors
+        n_iter (int): number of assignment/update rounds
+        seed (int): random seed for the initial centroids
+
+    Returns:
+        (n_clusters, dim) matrix of L2-normalized centroids
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, min(n_clusters, len(vectors)))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = assign(vectors, centroids)
+        # per-cluster sums, one dimension at a time to avoid copying the vectors
+        sums = np.stack([np.bincount(assignments, weights=vectors[:, d], minlength=n_clusters)
+                         for d in range(vectors.shape[1])], axis=1)
+        norms = np.linalg.norm(sums, axis=1)
+        empty = norms == 0
+        # restart empty clusters from random vectors
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        norms[empty] = 1
+        centroids = sums / norms[:, None]
+    return centroids.astype(np.float32)
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """
+    Returns the index of the most similar centroid for each vector.
+    """
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    # assign in chunks so that the score matrix stays around 16 MB
+    chunk_size = max(1, 2 ** 22 // len(centroids))
+    for start in range(0, len(vectors), chunk_size):
+        assignments[start:start + chunk_size] = np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+    return assignments
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate cosine search over a VectorStore.
+    The rows are partitioned by k-means into n_lists lists, and a query only scans the nprobe lists
+    whose centroids are most similar to it. Raising nprobe trades latency for recall;
+    nprobe == n_lists gives the same results as the exact search.
+    The index only holds the rows of each list; their vectors are read from the store's matrix,
+    so a memmapped sidecar stays the only copy of the embeddings.
+    """
+    def __init__(self, store: VectorStore, centroids: np.ndarray, rows: np.ndarray, offsets: np.ndarray,
+                 nprobe: int = 16, fingerprint: str = ''):
+        """
+        Args:
+            store (VectorStore): the indexed store
+            centroids (numpy array): (n_lists, dim) matrix of list centroids
+            rows (numpy array): store row of every indexed vector, grouped by list
+            offsets (numpy array): list i holds rows[offsets[i]:offsets[i + 1]]
+            nprobe (int): default number of lists to scan per query
+            fingerprint (str): store_fingerprint of the store the index was built from
+        """
+        self.store = store
+        self.centroids = centroids
+        self.rows = rows
+        self.offsets = offsets
+        self.nprobe = nprobe
+        self.fingerprint = fingerprint
+        # the index is shared by every thread of a server, so its arrays are read-only
+        for array in (centroids, rows, offsets):
+            array.flags.writeable = False
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, store: VectorStore, n_lists: int | None = None, nprobe: int = 16, n_iter: int = 10,
+              sample_size: int = 50000, seed: int = 0, version: str = '') -> "IVFIndex":
+        """
+        Trains the list centroids with spherical k-means and assigns every row of the store to a list.
+        Args:
+            store (VectorStore): the store to index
+            n_lists (int): number of lists, defaults to 4 * sqrt(number of rows)
+            nprobe (int): default number of lists to scan per query
+            n_iter (int): number of k-means iterations
+            sample_size (int): maximum number of rows the centroids are trained on
+            seed (int): random seed
+            version (str): version of the store's contents, see store_fingerprint
+
+        Returns:
+            IVFIndex over the store
+        """
+        if len(store) == 0:
+            raise ValueError("Cannot build an IVF index over an empty vector store")
+        matrix = store.matrix
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(len(store)))
+        rng = np.random.default_rng(seed)
+        if len(store) > sample_size:
+            sample = matrix[np.sort(rng.choice(len(store), sample_size, replace=False))]
+        else:
+            sample = matrix
+        # k-means needs a distinct sampled vector to start every list from
+        n_lists = max(1, min(n_lists, len(sample)))
+        centroids = spherical_kmeans(sample, n_lists, n_iter, seed)
+        assignments = assign(matrix, centroids)
+        rows = np.argsort(assignments, kind='stable')
+        offsets = np.searchsorted(assignments[rows], np.arange(n_lists + 1))
+        return cls(store, centroids, rows, offsets, min(nprobe, n_lists), store_fingerprint(store, version))
+
+    def probe(self, query: np.ndarray, nprobe: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Scores the vectors in the nprobe lists closest to a normalized query.
+        The candidates are returned in row order, so that the store's matrix is read front to back
+        and ties are broken the same way as in the exact search.
+        """
+        lists = top_k(self.centroids @ query, nprobe)
+        candidates = np.sort(np.concatenate([self.rows[self.offsets[i]:self.offsets[i + 1]] for i in lists]))
+        scores = self.store.matrix[candidates] @ query
+        return candidates, scores
+
+    def search(self, query_vec: np.ndarray, k: int, nprobe: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds (approximately) the k rows most similar to the query vector.
+        Args:
+            query_vec (numpy array): embedding vector representing the query
+            k (int): number of rows to return
+            nprobe (int): number of lists to scan, defaults to self.nprobe
+
+        Returns:
+            Store row positions and cosine similarities of the k best rows found, from most to least similar
+        """
+        query = np.asarray(query_vec, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        candidates, scores = self.probe(query, min(nprobe or self.nprobe, self.n_lists))
+        best = top_k(scores, k)
+        return candidates[best], scores[best]
+
+    def search_many(self, query_vecs: np.ndarray, k: int, nprobe: int | None = None) \
+            -> tuple[list[np.ndarray], list[np.ndarray]]:
+        """
+        Finds (approximately) the k rows most similar to each of several query vectors.
+        Args:
+            query_vecs (numpy array): (Q, dim) matrix of query embeddings
+            k (int): number of rows to return per query
+            nprobe (int): number of lists to scan, defaults to self.nprobe
+
+        Returns:
+            Lists of store row positions and cosine similarities for each query.
+            A query gets fewer than k rows if the scanned lists hold fewer than k rows.
+        """
+        results = [self.search(query_vec, k, nprobe) for query_vec in np.atleast_2d(query_vecs)]
+        return [rows for rows, _ in results], [scores for _, scores in results]
+
+    def save(self, path: str) -> None:
+        """
+        Writes the index to a .npz file. The file is written under a temporary name and then renamed,
+        so readers never see a partially written index.
+        """
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, centroids=self.centroids, rows=self.rows, offsets=self.offsets,
+                 meta=np.array(json.dumps({'nprobe': self.nprobe, 'fingerprint': self.fingerprint})))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, store: VectorStore) -> "IVFIndex":
+        """
+        Reads an index written by save, searching the vectors of store.
+        """
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            return cls(store, data['centroids'], data['rows'], data['offsets'], meta['nprobe'], meta['fingerprint'])
+
+
+def load_or_build_ivf(path: str, store: VectorStore, version: str = '', nprobe: int | None = None,
+                      **build_args) -> IVFIndex:
+    """
+    Loads the IVF index saved at path, or builds and saves one if it is missing or was built from different data.
+    Args:
+        path (str): path of the .npz index file
+        store (VectorStore): the store the index must cover
+        version (str): version of the store's contents, see store_fingerprint
+        nprobe (int): number of lists to scan per query, defaults to the saved value
+        build_args: arguments for IVFIndex.build
+
+    Returns:
+        IVFIndex over the store
+    """
+    index = None
+    if os.path.exists(path):
+        index = IVFIndex.load(path, store)
+        if index.fingerprint != store_fingerprint(store, version):
+            index = None
+    if index is None:
+        index = IVFIndex.build(store, version=version, **build_args)
+        index.save(path)
+    if nprobe is not None:
+        index.nprobe = min(nprobe, index.n_lists)
+    return index
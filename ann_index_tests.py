@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from ann_index import IVFIndex, load_or_build_ivf, spherical_kmeans
+from vector_store import VectorStore
+
+
+def clustered_store(n_rows=2000, dim=16, n_clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim))
+    embeddings = centers[rng.integers(n_clusters, size=n_rows)] + 0.3 * rng.standard_normal((n_rows, dim))
+    return VectorStore(embeddings, np.arange(100, 100 + n_rows))
+
+
+class TestKMeans(unittest.TestCase):
+    def test_centroids_are_normalized(self):
+        store = clustered_store()
+        centroids = spherical_kmeans(store.matrix, 8, n_iter=5)
+        self.assertEqual(centroids.shape, (8, 16))
+        self.assertEqual(spherical_kmeans(store.matrix[:5], 8, n_iter=1).shape, (5, 16))
+        np.testing.assert_allclose(np.linalg.norm(centroids, axis=1), 1, rtol=1e-5)
+
+
+class TestIVFIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.store = clustered_store()
+        self.index = IVFIndex.build(self.store, n_lists=32, nprobe=4)
+        self.queries = np.random.default_rng(1).standard_normal((20, 16))
+
+    def test_empty_store(self):
+        with self.assertRaises(ValueError):
+            IVFIndex.build(VectorStore(np.zeros((0, 16)), np.arange(0)))
+
+    def test_single_row_store(self):
+        index = IVFIndex.build(clustered_store(n_rows=1), n_lists=0)
+        self.assertEqual(len(index.offsets), 2)
+        self.assertEqual(index.search(np.ones(16), 3)[0].tolist(), [0])
+
+    def test_more_lists_than_sampled_rows(self):
+        index = IVFIndex.build(self.store, n_lists=64, sample_size=50)
+        self.assertEqual(index.n_lists, 50)
+        self.assertEqual(index.offsets[-1], len(self.store))
+
+    def test_every_row_is_in_one_list(self):
+        self.assertEqual(sorted(self.index.rows.tolist()), list(range(len(self.store))))
+        self.assertEqual(self.index.offsets[-1], len(self.store))
+
+    def test_probing_every_list_is_exact(self):
+        for query in self.queries:
+            rows, scores = self.index.search(query, 5, nprobe=self.index.n_lists)
+            exact_rows, exact_scores = self.store.search(query, 5)
+            self.assertListEqual(rows.tolist(), exact_rows.tolist())
+            np.testing.assert_allclose(scores, exact_scores, rtol=1e-5)
+
+    def test_recall(self):
+        hits = 0
+        for query in self.queries:
+            rows, _ = self.index.search(query, 10)
+            exact_rows, _ = self.store.search(query, 10)
+            hits += len(set(rows.tolist()) & set(exact_rows.tolist()))
+        self.assertGreater(hits / (10 * len(self.queries)), 0.8)
+
+    def test_search_many(self):
+        rows, _ = self.index.search_many(self.queries[:3], 5)
+        for query, query_rows in zip(self.queries[:3], rows):
+            self.assertListEqual(query_rows.tolist(), self.index.search(query, 5)[0].tolist())
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'index.npz')
+            self.index.save(path)
+            loaded = IVFIndex.load(path, self.store)
+            self.assertEqual(loaded.nprobe, 4)
+            self.assertEqual(loaded.fingerprint, self.index.fingerprint)
+            self.assertListEqual(loaded.search(self.queries[0], 5)[0].tolist(),
+                                 self.index.search(self.queries[0], 5)[0].tolist())
+
+    def test_load_or_build(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'index.npz')
+            index = load_or_build_ivf(path, self.store, n_lists=16)
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(load_or_build_ivf(path, self.store, nprobe=2).n_lists, index.n_lists)
+            # an index built from other data is rebuilt
+            other = clustered_store(seed=5)
+            self.assertNotEqual(load_or_build_ivf(path, other, 'other', n_lists=8).fingerprint, index.fingerprint)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+""" Recall and latency of the IVF index against the exact search"""
+
+import os
+import time
+from argparse import ArgumentParser
+import numpy as np
+from alchemy_database import make_book_db, make_book_df, get_model
+from ann_index import IVFIndex
+from benchmark import DATABASE_URL, clustered_embeddings, recall_at_k, report
+from evaluate import read_test_set
+from vector_store import VectorStore
+
+
+def bench_ann(store: VectorStore, queries: np.ndarray, k: int, nprobes: list[int], n_lists: int | None = None) \
+        -> None:
+    """
+    Reports recall@k and per-query latency of an IVF index at several nprobe settings against the exact search.
+    """
+    start = time.perf_counter()
+    index = IVFIndex.build(store, n_lists)
+    print(f'{len(store)} books, {len(queries)} queries, k={k}: '
+          f'built {index.n_lists} lists in {time.perf_counter() - start:.1f} s')
+    exact, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        exact.append(store.search(query, k)[0])
+        latencies.append((time.perf_counter() - start) * 1000)
+    report('exact', latencies)
+    for nprobe in nprobes:
+        found, latencies = [], []
+        for query in queries:
+            start = time.perf_counter()
+            found.append(index.search(query, k, nprobe)[0])
+            latencies.append((time.perf_counter() - start) * 1000)
+        report(f'nprobe={nprobe}', latencies)
+        print(f'{"":>10}  recall@{k} {recall_at_k(found, exact):.3f}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64], help='nprobe values to report')
+    parser.add_argument('--lists', type=int, help='number of IVF lists, default 4 * sqrt(books)')
+    parser.add_argument('-f', '--filepath', default='test_data/test_questions.jsonl',
+                        help='test set whose questions are the queries when books_db.db is used')
+    parser.add_argument('--books', type=int, default=16000,
+                        help='size of the synthetic corpus, used when there is no database')
+    parser.add_argument('--queries', type=int, default=100, help='number of synthetic queries to time')
+    parser.add_argument('-k', type=int, default=3, help='number of books to retrieve per query')
+    parser.add_argument('--synthetic', action='store_true', help='ignore books_db.db even if it exists')
+    args = parser.parse_args()
+
+    if not args.synthetic and os.path.exists('books_db.db'):
+        store = make_book_df(make_book_db(DATABASE_URL)).attrs['vector_store']
+        queries = get_model().encode(read_test_set(args.filepath)[0])
+    else:
+        embeddings = clustered_embeddings(args.books + args.queries)
+        store = VectorStore(embeddings[:args.books])
+        queries = embeddings[args.books:]
+    bench_ann(store, queries, args.k, args.nprobe, args.lists)
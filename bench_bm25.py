@@ -0,0 +1,71 @@
+""" Build time, size and latency of the BM25 index and of its fusion with the dense search,
+and their accuracy on the test set"""
+
+import os
+import time
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+from alchemy_database import make_book_db, make_book_df, get_model
+from benchmark import DATABASE_URL, report, synthetic_text_df, test_set_book_df
+from bm25_index import BM25Index, hybrid_search, pack_strings
+from evaluate import read_test_set
+from vector_store import get_vector_store
+
+
+def bench_bm25(book_df: pd.DataFrame, queries: list[str], true_titles: list[str] | None, k: int) -> None:
+    """
+    Reports the build time and size of the BM25 index and the latency of BM25 and of both fusions.
+    If the right titles are given, also reports the top-1 accuracy of the embedding search, BM25 and both fusions.
+    """
+    start = time.perf_counter()
+    lexical = BM25Index.build(book_df)
+    n_bytes = sum(array.nbytes for array in (*pack_strings(lexical.vocabulary), lexical.offsets, lexical.rows,
+                                             lexical.weights))
+    print(f'{len(book_df)} books, {len(queries)} queries: built in {time.perf_counter() - start:.1f} s, '
+          f'{len(lexical.vocabulary)} terms, {len(lexical.rows)} postings, {n_bytes / 2 ** 20:.1f} MiB')
+    store = get_vector_store(book_df)
+    query_vecs = get_model().encode(queries) if true_titles is not None \
+        else np.random.default_rng(1).standard_normal((len(queries), store.matrix.shape[1]))
+    searches = {'dense': lambda query, vec: store.search(vec, k)[0],
+                'bm25': lambda query, vec: lexical.search(query, k)[0],
+                'rrf': lambda query, vec: hybrid_search(store, store, lexical, query, vec, k, 'rrf')[0],
+                'weighted': lambda query, vec: hybrid_search(store, store, lexical, query, vec, k, 'weighted')[0]}
+    for name, search in searches.items():
+        latencies, correct = [], 0
+        for i, (query, query_vec) in enumerate(zip(queries, query_vecs)):
+            start = time.perf_counter()
+            rows = search(query, query_vec)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if true_titles is not None and len(rows):
+                correct += book_df['title'].iloc[rows[0]] == true_titles[i]
+        report(name, latencies)
+        if true_titles is not None:
+            print(f'{"":>10}  top-1 accuracy {correct / len(queries):.3f}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-f', '--filepath', default='test_data/test_questions.jsonl',
+                        help='the file containing the test set')
+    parser.add_argument('--books', type=int, default=16000, help='size of the synthetic corpus')
+    parser.add_argument('--queries', type=int, default=100, help='number of synthetic queries to time')
+    parser.add_argument('-k', type=int, default=3, help='number of books to retrieve per query')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='time a synthetic corpus and queries instead of the test set (latency only)')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        book_df = synthetic_text_df(args.books)
+        rng = np.random.default_rng(2)
+        # queries of a few words, like questions without their stopwords
+        queries = [' '.join(rng.choice(book_df['summary'].iloc[rng.integers(len(book_df))].split(), 6))
+                   for _ in range(args.queries)]
+        bench_bm25(book_df, queries, None, args.k)
+    else:
+        queries, true_contexts, _ = read_test_set(args.filepath)
+        if os.path.exists('books_db.db'):
+            book_df = make_book_df(make_book_db(DATABASE_URL))
+        else:
+            book_df = test_set_book_df(true_contexts)
+        bench_bm25(book_df, queries, [true['title'] for true in true_contexts], args.k)
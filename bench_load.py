@@ -0,0 +1,115 @@
+""" Compares the startup time and peak memory of loading the original pickle-based database and the current one"""
+
+import json
+import os
+import pickle
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+from alchemy_database import Base, Book, make_book_db, make_book_df
+from migrate_database import migrate
+from vector_store import get_vector_store
+
+
+def legacy_make_book_df(db: Session) -> pd.DataFrame:
+    """
+    The original make_book_df, which unpickled the genres and embedding of every row.
+    Kept here as the baseline for the benchmark.
+    """
+    instances = db.query(Book).all()
+    data = [{"id": instance.id,
+             "title": instance.title,
+             "author": instance.author,
+             "genres": pickle.loads(instance.genres),
+             "summary": instance.summary,
+             "pub_date": instance.pub_date,
+             "embedding": np.array(pickle.loads(instance.embedding))}
+            for instance in instances]
+    book_df = pd.DataFrame(data)
+    # the current make_book_df also builds the search matrix, so include it for a fair comparison
+    get_vector_store(book_df)
+    return book_df
+
+
+def write_legacy_db(path: str, n_books: int, dim: int = 384, seed: int = 0) -> None:
+    """
+    Writes a synthetic books database in the original pickle-based storage format.
+    """
+    engine = create_engine('sqlite:///' + path)
+    Base.metadata.create_all(bind=engine)
+    rng = np.random.default_rng(seed)
+    with engine.begin() as connection:
+        for start in range(0, n_books, 1000):
+            embeddings = rng.standard_normal((min(1000, n_books - start), dim)).astype(np.float32)
+            connection.execute(
+                text("INSERT INTO books (title, author, genres, summary, pub_date, embedding) "
+                     "VALUES (:title, :author, :genres, :summary, :pub_date, :embedding)"),
+                [{"title": f"Book {start + i}", "author": f"Author {start + i}",
+                  "genres": pickle.dumps({"/m/05hgj": "Novel", "/m/02xlf": "Fiction"}),
+                  "summary": "A summary of the book. " * 40, "pub_date": "1999",
+                  "embedding": pickle.dumps(embedding)}
+                 for i, embedding in enumerate(embeddings)])
+    engine.dispose()
+
+
+def measure_load(db_path: str, loader: str) -> dict:
+    """
+    Loads a database into a dataframe and measures how long it takes and how much memory it needs.
+    Args:
+        db_path (str): path to the SQLite database
+        loader (str): 'legacy' for the pickle-based make_book_df, 'current' for the current one
+
+    Returns:
+        Dictionary with the load time in seconds and the increase in peak RSS in MB
+    """
+    load = legacy_make_book_df if loader == 'legacy' else make_book_df
+    db = make_book_db('sqlite:///' + db_path)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    book_df = load(db)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in kilobytes on Linux
+    return {'books': len(book_df), 'seconds': elapsed, 'peak_rss_mb': (peak - baseline) / 1024}
+
+
+def bench_load(n_books: int) -> None:
+    """
+    Compares startup time and peak memory of loading the old pickle-based format and the current format.
+    Each loader runs in a fresh process so that their peak RSS numbers do not affect each other.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        legacy_path = os.path.join(tmpdir, 'legacy.db')
+        current_path = os.path.join(tmpdir, 'current.db')
+        write_legacy_db(legacy_path, n_books)
+        shutil.copy(legacy_path, current_path)
+        migrate('sqlite:///' + current_path)
+        print(f'{n_books} books')
+        for loader, path in [('legacy', legacy_path), ('current', current_path)]:
+            output = subprocess.run([sys.executable, __file__, '--loader', loader, '--db', path],
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f'{loader:>10}: {result["seconds"]:.3f} s, peak RSS +{result["peak_rss_mb"]:.1f} MB '
+                  f'({os.path.getsize(path) / 2 ** 20:.1f} MB on disk)')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--books', type=int, default=16000, help='size of the synthetic database')
+    parser.add_argument('--loader', choices=['legacy', 'current'],
+                        help='measure only this loader on the database given by --db')
+    parser.add_argument('--db', help='database file used with --loader')
+    args = parser.parse_args()
+
+    if args.loader:
+        print(json.dumps(measure_load(args.db, args.loader)))
+    else:
+        bench_load(args.books)
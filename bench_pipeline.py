@@ -0,0 +1,75 @@
+""" Latency of running the rerank and answer calls one after the other against answering speculatively,
+with a mocked Mistral client"""
+
+import os
+import time
+import zlib
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+from alchemy_database import make_book_db, make_book_df, search_many
+from benchmark import DATABASE_URL, report, test_set_book_df
+from evaluate import read_test_set
+from pipeline import executor, sequential_answer, speculative_answer
+
+
+class MockMistral:
+    """
+    Stands in for the two Mistral calls with fixed latencies. The rerank picks the retrieved book
+    with the right title if there is one, and the top-ranked book otherwise.
+    Latencies are lognormal around the given medians and depend only on the call, so every strategy sees the same ones.
+    """
+    def __init__(self, true_titles: dict[str, str], rerank_ms: float, answer_ms: float, sigma: float = 0.3):
+        self.true_titles = true_titles
+        self.rerank_ms = rerank_ms
+        self.answer_ms = answer_ms
+        self.sigma = sigma
+
+    def sleep(self, median_ms: float, *key: str) -> None:
+        rng = np.random.default_rng(zlib.crc32('\n'.join(key).encode()))
+        time.sleep(median_ms * rng.lognormal(0, self.sigma) / 1000)
+
+    def choose_best_book(self, question: str, contexts: list[dict]) -> dict:
+        self.sleep(self.rerank_ms, 'rerank', question)
+        return next((context for context in contexts if context['title'] == self.true_titles[question]), contexts[0])
+
+    def get_answer(self, question: str, context: dict) -> str:
+        self.sleep(self.answer_ms, 'answer', question, context['title'])
+        return f"Answer from {context['title']}"
+
+
+def bench_pipeline(book_df: pd.DataFrame, queries: list[str], true_contexts: list[dict],
+                   rerank_ms: float, answer_ms: float) -> None:
+    """
+    Compares running choose_best_book and get_answer one after the other against speculative_answer,
+    with a mocked Mistral client, and reports how often the rerank agreed with the top-ranked book.
+    """
+    mock = MockMistral({query: true['title'] for query, true in zip(queries, true_contexts)}, rerank_ms, answer_ms)
+    results = search_many(queries, book_df, k=3)
+    print(f'{len(book_df)} books, {len(queries)} queries, mocked rerank {rerank_ms:.0f} ms, '
+          f'answer {answer_ms:.0f} ms (medians)')
+    agreed = None
+    for name, run in [('sequential', sequential_answer), ('speculative', speculative_answer)]:
+        infos = [run(query, docs, mock.choose_best_book, mock.get_answer)[2] for query, docs in zip(queries, results)]
+        report(name, [info['seconds'] * 1000 for info in infos])
+        agreed = np.mean([info['agreed'] for info in infos])
+    print(f'rerank agreed with the top-ranked book for {agreed:.1%} of queries')
+    executor.shutdown()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-f', '--filepath', default='test_data/test_questions.jsonl',
+                        help='the file containing the test set')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='search the books of the test set instead of books_db.db even if it exists')
+    parser.add_argument('--rerank-ms', type=float, default=300, help='median latency of the mocked rerank call')
+    parser.add_argument('--answer-ms', type=float, default=400, help='median latency of the mocked answer call')
+    args = parser.parse_args()
+
+    queries, true_contexts, _ = read_test_set(args.filepath)
+    if not args.synthetic and os.path.exists('books_db.db'):
+        book_df = make_book_df(make_book_db(DATABASE_URL))
+    else:
+        book_df = test_set_book_df(true_contexts)
+    bench_pipeline(book_df, queries, true_contexts, args.rerank_ms, args.answer_ms)
@@ -0,0 +1,61 @@
+""" Memory, recall and latency of the binary quantized index against the exact search"""
+
+import os
+import time
+from argparse import ArgumentParser
+import numpy as np
+from alchemy_database import make_book_db, make_book_df, get_model
+from benchmark import DATABASE_URL, clustered_embeddings, recall_at_k, report
+from evaluate import read_test_set
+from quantized_index import QuantizedIndex
+from vector_store import VectorStore
+
+
+def bench_quantized(store: VectorStore, queries: np.ndarray, k: int, candidates: list[int]) -> None:
+    """
+    Reports memory, recall@k and per-query latency of binary quantized search against the exact search.
+    """
+    n, dim = store.matrix.shape
+    print(f'{n} books, {len(queries)} queries, k={k}')
+    print(f'{"float64":>10}: {n * dim * 8 / 2 ** 20:8.2f} MB (embeddings as loaded by the original make_book_df)')
+    print(f'{"float32":>10}: {store.matrix.nbytes / 2 ** 20:8.2f} MB')
+    exact, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        exact.append(store.search(query, k)[0])
+        latencies.append((time.perf_counter() - start) * 1000)
+    report('exact', latencies)
+    index = QuantizedIndex(store)
+    print(f'{"binary":>10}: {index.nbytes / 2 ** 20:8.2f} MB of codes')
+    for n_candidates in candidates:
+        index.n_candidates = n_candidates
+        found, latencies = [], []
+        for query in queries:
+            start = time.perf_counter()
+            found.append(index.search(query, k)[0])
+            latencies.append((time.perf_counter() - start) * 1000)
+        report(f'{n_candidates}', latencies)
+        print(f'{"":>10}  recall@{k} {recall_at_k(found, exact):.3f}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--candidates', type=int, nargs='+', default=[50, 200, 500],
+                        help='numbers of candidates rescored per query')
+    parser.add_argument('-f', '--filepath', default='test_data/test_questions.jsonl',
+                        help='test set whose questions are the queries when books_db.db is used')
+    parser.add_argument('--books', type=int, default=16000,
+                        help='size of the synthetic corpus, used when there is no database')
+    parser.add_argument('--queries', type=int, default=100, help='number of synthetic queries to time')
+    parser.add_argument('-k', type=int, default=3, help='number of books to retrieve per query')
+    parser.add_argument('--synthetic', action='store_true', help='ignore books_db.db even if it exists')
+    args = parser.parse_args()
+
+    if not args.synthetic and os.path.exists('books_db.db'):
+        store = make_book_df(make_book_db(DATABASE_URL)).attrs['vector_store']
+        queries = get_model().encode(read_test_set(args.filepath)[0])
+    else:
+        embeddings = clustered_embeddings(args.books + args.queries)
+        store = VectorStore(embeddings[:args.books])
+        queries = embeddings[args.books:]
+    bench_quantized(store, queries, args.k, args.candidates)
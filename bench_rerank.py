@@ -0,0 +1,56 @@
+""" Accuracy and latency of the rerankers choosing among the retrieved books of the test set"""
+
+import os
+import time
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+from alchemy_database import make_book_db, make_book_df, search_many
+from benchmark import DATABASE_URL, report, test_set_book_df
+from evaluate import read_test_set
+from reranker import RERANKERS, make_reranker
+
+
+def bench_rerank(book_df: pd.DataFrame, queries: list[str], true_contexts: list[dict], k: int,
+                 names: list[str]) -> None:
+    """
+    Reports the top-1 accuracy and latency of each reranker choosing among the k most similar books,
+    against taking the most similar book and against the share of questions whose book was retrieved at all.
+    """
+    results = search_many(queries, book_df, k=k)
+    true_titles = [true['title'] for true in true_contexts]
+    print(f'{len(book_df)} books, {len(queries)} queries, {k} candidates')
+    top_1 = np.mean([docs[0]['title'] == title for docs, title in zip(results, true_titles)])
+    recall = np.mean([title in {doc['title'] for doc in docs} for docs, title in zip(results, true_titles)])
+    print(f'{"top-1":>10}  accuracy {top_1:.3f}')
+    print(f'{f"recall@{k}":>10}  accuracy {recall:.3f}')
+    for name in names:
+        reranker = make_reranker(name)
+        reranker.warm_up()
+        latencies, correct = [], 0
+        for query, docs, title in zip(queries, results, true_titles):
+            start = time.perf_counter()
+            chosen = reranker.choose(query, docs)
+            latencies.append((time.perf_counter() - start) * 1000)
+            correct += chosen['title'] == title
+        report(name, latencies)
+        print(f'{"":>10}  accuracy {correct / len(queries):.3f}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-f', '--filepath', default='test_data/test_questions.jsonl',
+                        help='the file containing the test set')
+    parser.add_argument('-k', type=int, default=3, help='number of books retrieved per query')
+    parser.add_argument('--rerankers', nargs='+', choices=list(RERANKERS), default=list(RERANKERS),
+                        help='rerankers to compare, the llm one needs MISTRAL_API_KEY')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='search the books of the test set instead of books_db.db even if it exists')
+    args = parser.parse_args()
+
+    queries, true_contexts, _ = read_test_set(args.filepath)
+    if not args.synthetic and os.path.exists('books_db.db'):
+        book_df = make_book_df(make_book_db(DATABASE_URL))
+    else:
+        book_df = test_set_book_df(true_contexts)
+    bench_rerank(book_df, queries, true_contexts, args.k, args.rerankers)
@@ -0,0 +1,291 @@
+""" Retrieval benchmark suite over synthetic corpora of growing size, writing its results as JSON
+
+Every backend and corpus size runs in a fresh process, so that the memory numbers of one do not include another's.
+Queries are embedded by StubEncoder instead of the sentence encoder, so the suite runs offline and measures
+the retrieval code rather than the model.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from argparse import SUPPRESS, ArgumentParser
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import alchemy_database
+from alchemy_database import make_book_db, make_book_df, process_query_and_search
+from ann_index import IVFIndex
+from bench_load import write_legacy_db
+from benchmark import clustered_embeddings, synthetic_text_df
+from bm25_index import BM25Index
+from migrate_database import migrate
+from quantized_index import QuantizedIndex
+from vector_store import VectorStore, load_sidecar, save_sidecar
+
+BACKENDS = ['exact', 'ivf', 'binary', 'bm25', 'load']
+# backends whose corpus is too slow to generate beyond this many books; --full lifts the limit
+MAX_BOOKS = {'bm25': 100000, 'load': 100000}
+
+
+class StubEncoder:
+    """
+    Stands in for the SentenceTransformer: every text gets a fixed random vector seeded by its checksum.
+    """
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def encode(self, sentences, batch_size: int = 32, **kwargs) -> np.ndarray:
+        if isinstance(sentences, str):
+            return self.encode([sentences])[0]
+        return np.stack([np.random.default_rng(zlib.crc32(sentence.encode())).standard_normal(self.dim)
+                         .astype(np.float32) for sentence in sentences])
+
+
+def memory_mb() -> tuple[float | None, float | None]:
+    """
+    Returns the current and peak resident set size of this process in MB, as reported by /proc/self/status,
+    or None for both where there is no such file.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f)
+    except OSError:
+        return None, None
+    return int(fields['VmRSS'].split()[0]) / 1024, int(fields['VmHWM'].split()[0]) / 1024
+
+
+def reset_peak_memory() -> bool:
+    """
+    Resets the peak resident set size to the current one (Linux 4.0 and later), so that the peak measured after
+    generating the corpus is that of the backend alone.
+    Returns:
+        Whether the peak could be reset; if not, the peak includes generating the corpus and is not reported
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def percentiles(latencies: list[float]) -> dict[str, float]:
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {'mean_ms': float(np.mean(latencies)), 'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+
+
+def time_queries(search, queries: list) -> list[float]:
+    """
+    Times search on each query after one untimed warm-up call.
+    Returns:
+        Latencies in milliseconds
+    """
+    search(queries[0])
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def run_backend(backend: str, n_books: int, n_queries: int, k: int, workdir: str) -> dict:
+    """
+    Builds one backend over a synthetic corpus and measures it.
+    Args:
+        backend (str): one of BACKENDS
+        n_books (int): size of the corpus
+        n_queries (int): number of queries timed
+        k (int): number of books retrieved per query
+        workdir (str): directory for the files the backend saves and loads
+
+    Returns:
+        Build seconds, load seconds (reading the saved backend back and answering a first query with it),
+        memory held and peak memory in MB over that of the generated corpus (which holds the raw embeddings until
+        the store copies them; the peak is None where it cannot be reset), and percentiles of the latency
+        of the backend's own search ('search') and of process_query_and_search with the stub encoder ('end_to_end')
+    """
+    alchemy_database._model = StubEncoder()
+    texts = [f'question {i} about a book' for i in range(n_queries)]
+    query_vecs = alchemy_database._model.encode(texts)
+    result = {'backend': backend, 'books': n_books, 'queries': n_queries, 'k': k, 'load_seconds': None}
+    lexical = index = None
+    if backend == 'load':
+        path = os.path.join(workdir, 'books.db')
+        write_legacy_db(path, n_books)
+        migrate('sqlite:///' + path)
+        rss, _ = memory_mb()
+        peak_reset = reset_peak_memory()
+        start = time.perf_counter()
+        book_df = make_book_df(make_book_db('sqlite:///' + path))
+        result['build_seconds'] = None
+        result['load_seconds'] = time.perf_counter() - start
+        store = book_df.attrs['vector_store']
+        search = store.search
+    else:
+        book_df = synthetic_text_df(n_books, summary_words=100) if backend == 'bm25' \
+            else pd.DataFrame({'id': np.arange(1, n_books + 1), 'title': [f'Book {i}' for i in range(1, n_books + 1)]})
+        embeddings = clustered_embeddings(n_books)
+        rss, _ = memory_mb()
+        peak_reset = reset_peak_memory()
+        start = time.perf_counter()
+        store = VectorStore(embeddings, book_df['id'].to_numpy())
+        del embeddings
+        if backend == 'exact':
+            result['build_seconds'] = time.perf_counter() - start
+            path = os.path.join(workdir, 'embeddings.npy')
+            save_sidecar(store, path, {})
+            start = time.perf_counter()
+            load_sidecar(path, store.ids, {}).search(query_vecs[0], k)
+            result['load_seconds'] = time.perf_counter() - start
+            search = store.search
+        elif backend == 'ivf':
+            start = time.perf_counter()
+            index = IVFIndex.build(store)
+            result['build_seconds'] = time.perf_counter() - start
+            path = os.path.join(workdir, 'ivf.npz')
+            index.save(path)
+            start = time.perf_counter()
+            IVFIndex.load(path, store).search(query_vecs[0], k)
+            result['load_seconds'] = time.perf_counter() - start
+            search = index.search
+        elif backend == 'binary':
+            # rescore from a memmapped sidecar, as main.py does, so that only the codes are held in memory
+            path = os.path.join(workdir, 'embeddings.npy')
+            save_sidecar(store, path, {})
+            store = load_sidecar(path, store.ids, {})
+            start = time.perf_counter()
+            index = QuantizedIndex(store)
+            result['build_seconds'] = time.perf_counter() - start
+            search = index.search
+        elif backend == 'bm25':
+            start = time.perf_counter()
+            lexical = BM25Index.build(book_df)
+            result['build_seconds'] = time.perf_counter() - start
+            path = os.path.join(workdir, 'bm25.npz')
+            lexical.save(path)
+            rng = np.random.default_rng(1)
+            # questions of a few words drawn from the summaries
+            texts = [' '.join(rng.choice(book_df['summary'].iloc[rng.integers(n_books)].split(), 6))
+                     for _ in range(n_queries)]
+            start = time.perf_counter()
+            BM25Index.load(path).search(texts[0], k)
+            result['load_seconds'] = time.perf_counter() - start
+            query_vecs = alchemy_database._model.encode(texts)
+            search = None
+        else:
+            raise ValueError(f"Unknown backend {backend!r}, use one of {', '.join(BACKENDS)}")
+        book_df.attrs['vector_store'] = store
+    current, peak = memory_mb()
+    result['rss_mb'] = None if rss is None else current - rss
+    result['peak_rss_mb'] = peak - rss if rss is not None and peak_reset else None
+    if lexical is not None:
+        result['search'] = percentiles(time_queries(lambda text: lexical.search(text, k), texts))
+    else:
+        result['search'] = percentiles(time_queries(lambda query_vec: search(query_vec, k), list(query_vecs)))
+    result['end_to_end'] = percentiles(time_queries(
+        lambda text: process_query_and_search(text, book_df, k, index, lexical), texts))
+    return result
+
+
+def run_in_subprocess(backend: str, n_books: int, n_queries: int, k: int) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        output = subprocess.run([sys.executable, __file__, '--run', backend, '--sizes', str(n_books),
+                                 '--queries', str(n_queries), '-k', str(k), '--workdir', workdir],
+                                capture_output=True, text=True)
+    if output.returncode != 0:
+        # e.g. killed for running out of memory on the largest corpus
+        return {'backend': backend, 'books': n_books, 'error': output.stderr.strip().splitlines()[-1:]
+                or [f'exit status {output.returncode}']}
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def environment() -> dict:
+    """
+    Describes what the results were measured on, so that runs on different commits or machines can be told apart.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'cpus': os.cpu_count()}
+
+
+def compare(results: list[dict], baseline: list[dict]) -> None:
+    """
+    Prints how the p50 and p99 search latency, build time and memory of each result changed against a baseline run.
+    """
+    previous = {(result['backend'], result['books']): result for result in baseline if 'error' not in result}
+    for result in results:
+        before = previous.get((result['backend'], result['books']))
+        if before is None or 'error' in result:
+            continue
+        changes = []
+        for name, new, old in [('p50', result['search']['p50_ms'], before['search']['p50_ms']),
+                               ('p99', result['search']['p99_ms'], before['search']['p99_ms']),
+                               ('build', result['build_seconds'], before['build_seconds']),
+                               ('peak RSS', result['peak_rss_mb'], before['peak_rss_mb'])]:
+            if new is not None and old:
+                changes.append(f'{name} {new / old - 1:+.0%}')
+        print(f"{result['backend']:>8} {result['books']:>8}: {', '.join(changes)}")
+
+
+def print_result(result: dict) -> None:
+    if 'error' in result:
+        print(f"{result['backend']:>8} {result['books']:>8}: failed, {' '.join(result['error'])}")
+        return
+    timings = [f"{name} {result[f'{name}_seconds']:.2f} s" for name in ('build', 'load')
+               if result[f'{name}_seconds'] is not None]
+    search, end_to_end = result['search'], result['end_to_end']
+    rss = 'unknown' if result['rss_mb'] is None else f"+{result['rss_mb']:.0f} MB"
+    peak = 'unknown' if result['peak_rss_mb'] is None else f"+{result['peak_rss_mb']:.0f} MB"
+    print(f"{result['backend']:>8} {result['books']:>8}: {', '.join(timings)}, "
+          f"RSS {rss} (peak {peak}) | "
+          f"search p50 {search['p50_ms']:.3f} p95 {search['p95_ms']:.3f} p99 {search['p99_ms']:.3f} ms | "
+          f"end to end p50 {end_to_end['p50_ms']:.3f} p99 {end_to_end['p99_ms']:.3f} ms")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='numbers of books in the synthetic corpora')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS,
+                        help='exact: VectorStore, ivf: IVFIndex, binary: QuantizedIndex, bm25: BM25Index, '
+                             'load: make_book_df on a SQLite database')
+    parser.add_argument('--queries', type=int, default=200, help='number of queries timed per backend')
+    parser.add_argument('-k', type=int, default=3, help='number of books retrieved per query')
+    parser.add_argument('-o', '--output', default='bench_results.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with, e.g. from another commit')
+    parser.add_argument('--full', action='store_true',
+                        help=f'run every backend on every size, even beyond {MAX_BOOKS}')
+    parser.add_argument('--run', choices=BACKENDS, help=SUPPRESS)
+    parser.add_argument('--workdir', help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        # a single measurement, run by run_in_subprocess
+        print(json.dumps(run_backend(args.run, args.sizes[0], args.queries, args.k, args.workdir)))
+        sys.exit()
+
+    results = []
+    for n_books in args.sizes:
+        for backend in args.backends:
+            if not args.full and n_books > MAX_BOOKS.get(backend, n_books):
+                continue
+            result = run_in_subprocess(backend, n_books, args.queries, args.k)
+            print_result(result)
+            results.append(result)
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2)
+    print(f'Results written to {args.output}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f)['results'])
@@ -0,0 +1,52 @@
+""" Hit rate, accuracy and latency of the title index against the dense retrieval it replaces"""
+
+import os
+import time
+from argparse import ArgumentParser
+import pandas as pd
+from alchemy_database import make_book_db, make_book_df, process_query_and_search, query_cache
+from benchmark import DATABASE_URL, report, test_set_book_df
+from evaluate import read_test_set
+from title_index import TitleIndex
+
+
+def bench_titles(book_df: pd.DataFrame, queries: list[str], true_contexts: list[dict], k: int) -> None:
+    """
+    Reports how many test questions the title index answers, how often the book it finds is the right one,
+    and its latency against the dense retrieval it replaces.
+    """
+    index = TitleIndex.from_df(book_df)
+    lookups, searches, hits, correct = [], [], 0, 0
+    for query, true in zip(queries, true_contexts):
+        start = time.perf_counter()
+        rows = index.lookup(query, k)
+        lookups.append((time.perf_counter() - start) * 1000)
+        if rows is not None:
+            hits += 1
+            correct += true['title'] in set(book_df['title'].iloc[rows])
+        query_cache.clear()
+        start = time.perf_counter()
+        process_query_and_search(query, book_df, k)
+        searches.append((time.perf_counter() - start) * 1000)
+    print(f'{len(book_df)} books, {len(queries)} queries')
+    report('title lookup', lookups)
+    report('dense', searches)
+    print(f'title index answered {hits}/{len(queries)} questions, '
+          f'{correct}/{hits} of them with the right book among its results')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-f', '--filepath', default='test_data/test_questions.jsonl',
+                        help='the file containing the test set')
+    parser.add_argument('-k', type=int, default=3, help='number of books to retrieve per query')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='search the books of the test set instead of books_db.db even if it exists')
+    args = parser.parse_args()
+
+    queries, true_contexts, _ = read_test_set(args.filepath)
+    if not args.synthetic and os.path.exists('books_db.db'):
+        book_df = make_book_df(make_book_db(DATABASE_URL))
+    else:
+        book_df = test_set_book_df(true_contexts)
+    bench_titles(book_df, queries, true_contexts, args.k)
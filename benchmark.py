@@ -0,0 +1,196 @@
+""" Benchmarks for the retrieval step,
+and the synthetic corpora and timing helpers shared with the bench_*.py scripts"""
+
+import ast
+import os
+import time
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+from alchemy_database import cosine_sim, get_max_sims, make_book_db, make_book_df, get_model, \
+    process_query_and_search, search_many, query_cache
+from llm import create_template_string
+from evaluate import read_test_set
+
+DATABASE_URL = 'sqlite:///books_db.db'
+
+
+def legacy_get_max_sims(data_df: pd.DataFrame, query_vec: np.ndarray, n: int) -> list[dict]:
+    """
+    The original get_max_sims, which scores every row with a Python-level cosine_sim call.
+    Kept here as the baseline for the benchmark.
+    """
+    data_df['sims'] = data_df['embedding'].apply(lambda x: cosine_sim(x, query_vec))
+    return data_df.nlargest(n, 'sims').to_dict('records')
+
+
+def synthetic_book_df(n_books: int, dim: int = 384, seed: int = 0) -> pd.DataFrame:
+    """
+    Makes a dataframe shaped like the output of make_book_df with random embeddings.
+    Args:
+        n_books (int): number of books
+        dim (int): embedding dimension
+        seed (int): random seed
+
+    Returns:
+        DataFrame with id, title and embedding columns
+    """
+    rng = np.random.default_rng(seed)
+    embeddings = rng.standard_normal((n_books, dim))
+    return pd.DataFrame({'id': np.arange(1, n_books + 1),
+                         'title': [f'Book {i}' for i in range(1, n_books + 1)],
+                         'embedding': list(embeddings)})
+
+
+def time_per_query(search, book_df: pd.DataFrame, queries: np.ndarray, k: int) -> list[float]:
+    """
+    Times a search function on each query.
+    Args:
+        search: function with the signature of get_max_sims
+        book_df (pd.DataFrame): dataframe to search
+        queries (numpy array): (Q, dim) matrix of query vectors
+        k (int): number of books to retrieve
+
+    Returns:
+        List of per-query latencies in milliseconds
+    """
+    latencies = []
+    for query_vec in queries:
+        start = time.perf_counter()
+        search(book_df, query_vec, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(name: str, latencies: list[float]) -> None:
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f'{name:>10}: mean {np.mean(latencies):8.3f} ms | p50 {p50:8.3f} ms | '
+          f'p95 {p95:8.3f} ms | p99 {p99:8.3f} ms')
+
+
+def bench_get_max_sims(book_df: pd.DataFrame, n_queries: int, k: int) -> None:
+    """
+    Compares per-query latency of the legacy and the matrix-based get_max_sims.
+    """
+    dim = len(book_df['embedding'].iloc[0])
+    queries = np.random.default_rng(1).standard_normal((n_queries, dim))
+    print(f'{len(book_df)} books, {n_queries} queries, k={k}')
+    # warm-up, which also builds the vector store if it is not already attached
+    get_max_sims(book_df, queries[0], k)
+    report('new', time_per_query(get_max_sims, book_df, queries, k))
+    report('legacy', time_per_query(legacy_get_max_sims, book_df.copy(), queries, k))
+
+
+def bench_search_many(book_df: pd.DataFrame, queries: list[str], k: int, batch_size: int) -> None:
+    """
+    Compares retrieving a list of queries one at a time against retrieving them in batches,
+    and checks that both return the same books.
+    """
+    print(f'{len(book_df)} books, {len(queries)} queries, k={k}, batch size {batch_size}')
+    # warm-up
+    search_many(queries[:1], book_df, k)
+
+    # time the encoder too, not the query embedding cache
+    query_cache.clear()
+    start = time.perf_counter()
+    sequential = [process_query_and_search(query, book_df, k) for query in queries]
+    sequential_time = time.perf_counter() - start
+
+    query_cache.clear()
+    start = time.perf_counter()
+    batched = search_many(queries, book_df, k, batch_size)
+    batched_time = time.perf_counter() - start
+
+    same = all([book['id'] for book in a] == [book['id'] for book in b] for a, b in zip(sequential, batched))
+    print(f'sequential: {sequential_time:.3f} s ({sequential_time / len(queries) * 1000:.2f} ms/query)')
+    print(f'   batched: {batched_time:.3f} s ({batched_time / len(queries) * 1000:.2f} ms/query)')
+    print(f'identical top-{k}: {same}')
+
+
+def test_set_book_df(true_contexts: list[dict]) -> pd.DataFrame:
+    """
+    Makes a dataframe like the output of make_book_df from the books of the test set, for use without books_db.db.
+    """
+    book_df = pd.DataFrame([{key: context[key] for key in ('id', 'title', 'author', 'genres', 'summary', 'pub_date')}
+                            for context in true_contexts]).drop_duplicates('id', ignore_index=True)
+    # the test set stores genres as a dict, the repr of a dict, or an empty string
+    book_df['genres'] = [ast.literal_eval(genres) if isinstance(genres, str) and genres else genres or None
+                         for genres in book_df['genres']]
+    embeddings = get_model().encode([create_template_string(book) for book in book_df.to_dict('records')])
+    book_df['embedding'] = list(np.asarray(embeddings))
+    return book_df
+
+
+def synthetic_text_df(n_books: int, vocabulary_size: int = 50000, summary_words: int = 400, seed: int = 0) \
+        -> pd.DataFrame:
+    """
+    Adds authors and summaries to synthetic_book_df, drawing words from a Zipf-distributed vocabulary
+    so that posting list lengths resemble those of real text.
+    """
+    rng = np.random.default_rng(seed)
+    book_df = synthetic_book_df(n_books, seed=seed)
+    words = np.array([f'w{i}' for i in range(vocabulary_size)])
+    probabilities = 1 / np.arange(1, vocabulary_size + 1)
+    probabilities /= probabilities.sum()
+    book_df['author'] = [f'Author {i % 5000}' for i in range(n_books)]
+    book_df['summary'] = [' '.join(rng.choice(words, rng.poisson(summary_words) + 1, p=probabilities))
+                          for _ in range(n_books)]
+    return book_df
+
+
+def clustered_embeddings(n_rows: int, dim: int = 384, n_topics: int | None = None, seed: int = 0) -> np.ndarray:
+    """
+    Makes random embeddings that are grouped around topic centers, which is closer to real sentence
+    embeddings than uniformly random vectors (approximate indexes rely on that structure).
+    Args:
+        n_rows (int): number of embeddings
+        dim (int): embedding dimension
+        n_topics (int): number of topic centers, defaults to sqrt(n_rows)
+        seed (int): random seed
+
+    Returns:
+        (n_rows, dim) float32 matrix
+    """
+    rng = np.random.default_rng(seed)
+    n_topics = n_topics or max(1, int(np.sqrt(n_rows)))
+    centers = rng.standard_normal((n_topics, dim)).astype(np.float32)
+    embeddings = np.empty((n_rows, dim), dtype=np.float32)
+    for start in range(0, n_rows, 100000):
+        stop = min(n_rows, start + 100000)
+        embeddings[start:stop] = centers[rng.integers(n_topics, size=stop - start)]
+        embeddings[start:stop] += 0.8 * rng.standard_normal((stop - start, dim), dtype=np.float32)
+    return embeddings
+
+
+def recall_at_k(found: list[np.ndarray], exact: list[np.ndarray]) -> float:
+    """
+    Fraction of the exact top-k rows that an approximate search also returned.
+    """
+    hits = sum(len(set(f.tolist()) & set(e.tolist())) for f, e in zip(found, exact))
+    return hits / sum(len(e) for e in exact)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('mode', nargs='?', choices=['sims', 'batch'], default='sims',
+                        help='sims: time get_max_sims against the original implementation, '
+                             'batch: time search_many against one query at a time')
+    parser.add_argument('-f', '--filepath', default='test_data/test_questions.jsonl',
+                        help='test set whose questions are used in batch mode')
+    parser.add_argument('-b', '--batch-size', type=int, default=64, help='batch size in batch mode')
+    parser.add_argument('--books', type=int, default=16000,
+                        help='size of the synthetic corpus, used when there is no database')
+    parser.add_argument('--queries', type=int, default=100, help='number of queries to time')
+    parser.add_argument('-k', type=int, default=3, help='number of books to retrieve per query')
+    parser.add_argument('--synthetic', action='store_true', help='ignore books_db.db even if it exists')
+    args = parser.parse_args()
+
+    if not args.synthetic and os.path.exists('books_db.db'):
+        book_df = make_book_df(make_book_db(DATABASE_URL))
+    else:
+        book_df = synthetic_book_df(args.books)
+    if args.mode == 'sims':
+        bench_get_max_sims(book_df, args.queries, args.k)
+    else:
+        queries = read_test_set(args.filepath)[0]
+        bench_search_many(book_df, queries, args.k, args.batch_size)
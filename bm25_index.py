@@ -0,0 +1,273 @@
+""" In-process BM25 index over the title, author and summary of every book, and its fusion with the dense search"""
+
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from title_index import STOPWORDS, normalize
+from vector_store import VectorStore, top_k
+
+# a word in the title counts as much as three in the summary
+FIELD_WEIGHTS = {'title': 3.0, 'author': 2.0, 'summary': 1.0}
+
+
+def terms(text: str | None) -> list[str]:
+    """
+    Splits text into the normalized words that are indexed, see title_index.normalize. Stopwords are dropped.
+    """
+    return [word for word in normalize(text) if word not in STOPWORDS]
+
+
+def text_fingerprint(data_df: pd.DataFrame, params: dict) -> str:
+    """
+    Hashes the ids and indexed fields of a dataframe together with the index parameters,
+    to tell whether an index was built from them.
+    """
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode())
+    digest.update(np.asarray(data_df['id'], dtype='<i8').tobytes())
+    for field in params['field_weights']:
+        for value in data_df[field]:
+            digest.update(f"\n{value or ''}".encode())
+    return digest.hexdigest()
+
+
+def pack_strings(strings: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Packs strings into their concatenated UTF-8 bytes and the offsets between them,
+    so that a long string does not pad every other one as in a fixed-width numpy string array.
+    """
+    encoded = [string.encode() for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def unpack_strings(data: np.ndarray, offsets: np.ndarray) -> list[str]:
+    """
+    Reverses pack_strings.
+    """
+    buffer = data.tobytes()
+    bounds = offsets.tolist()
+    return [buffer[start:end].decode() for start, end in zip(bounds, bounds[1:])]
+
+
+class BM25Index:
+    """
+    Inverted index scoring books with BM25, with term frequencies summed over the fields by FIELD_WEIGHTS.
+    The postings are stored as arrays: the postings of term i are rows[offsets[i]:offsets[i + 1]],
+    and weights holds the precomputed BM25 contribution of the term to each of those rows,
+    so scoring a query is one scatter-add per query term.
+    fusion, weight and depth are the defaults hybrid_search uses with the index; they are not saved with it.
+    """
+    def __init__(self, vocabulary: list[str], offsets: np.ndarray, rows: np.ndarray, weights: np.ndarray,
+                 n_rows: int, fingerprint: str = ''):
+        """
+        Args:
+            vocabulary (list[str]): the indexed terms
+            offsets (numpy array): term i has the postings offsets[i]:offsets[i + 1]
+            rows (numpy array): row position of every posting, grouped by term
+            weights (numpy array): BM25 contribution of every posting
+            n_rows (int): number of rows in the indexed dataframe
+            fingerprint (str): text_fingerprint of the dataframe the index was built from
+        """
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.rows = rows
+        self.weights = weights
+        self.n_rows = n_rows
+        self.fingerprint = fingerprint
+        self.fusion = 'rrf'
+        self.weight = 0.5
+        self.depth = 100
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        # the index is shared by every thread of a server, so its arrays are read-only
+        for array in (offsets, rows, weights):
+            array.flags.writeable = False
+
+    def __len__(self) -> int:
+        return self.n_rows
+
+    @classmethod
+    def build(cls, data_df: pd.DataFrame, k1: float = 1.2, b: float = 0.75,
+              field_weights: dict[str, float] = FIELD_WEIGHTS) -> "BM25Index":
+        """
+        Indexes the title, author and summary of every row of a dataframe.
+        Args:
+            data_df (pd.DataFrame): dataframe made by make_book_df
+            k1 (float): term frequency saturation
+            b (float): strength of the document length normalization
+            field_weights (dict[str, float]): how much an occurrence in each field counts
+
+        Returns:
+            BM25Index whose rows line up with the rows of data_df
+        """
+        term_ids = {}
+        posting_terms, posting_rows, posting_tfs = [], [], []
+        lengths = np.zeros(len(data_df), dtype=np.float32)
+        fields = [data_df[field].tolist() for field in field_weights]
+        for row, values in enumerate(zip(*fields)):
+            counts = {}
+            for value, weight in zip(values, field_weights.values()):
+                for term in terms(value):
+                    counts[term] = counts.get(term, 0.0) + weight
+                    lengths[row] += weight
+            for term, tf in counts.items():
+                posting_terms.append(term_ids.setdefault(term, len(term_ids)))
+                posting_rows.append(row)
+                posting_tfs.append(tf)
+        posting_terms = np.array(posting_terms, dtype=np.int64)
+        order = np.argsort(posting_terms, kind='stable')
+        rows = np.array(posting_rows, dtype=np.int32)[order]
+        tfs = np.array(posting_tfs, dtype=np.float32)[order]
+        doc_freqs = np.bincount(posting_terms, minlength=len(term_ids))
+        offsets = np.concatenate([[0], np.cumsum(doc_freqs)]).astype(np.int64)
+        idf = np.log1p((len(data_df) - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        norms = k1 * (1 - b + b * lengths / max(float(lengths.mean()) if len(lengths) else 0.0, 1e-9))
+        weights = np.repeat(idf, doc_freqs) * tfs * (k1 + 1) / (tfs + norms[rows])
+        vocabulary = list(term_ids)
+        fingerprint = text_fingerprint(data_df, {'k1': k1, 'b': b, 'field_weights': field_weights})
+        return cls(vocabulary, offsets, rows, weights.astype(np.float32), len(data_df), fingerprint)
+
+    def scores(self, query: str) -> np.ndarray:
+        """
+        Scores every row against a query.
+        Returns:
+            (N,) vector of BM25 scores, zero for rows that share no term with the query
+        """
+        scores = np.zeros(self.n_rows, dtype=np.float32)
+        for term in set(terms(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is not None:
+                start, end = self.offsets[term_id], self.offsets[term_id + 1]
+                # the rows of one term are distinct, so a fancy-indexed += adds every posting
+                scores[self.rows[start:end]] += self.weights[start:end]
+        return scores
+
+    def search(self, query: str, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the k rows with the highest BM25 score for a query.
+        Returns:
+            Row positions and BM25 scores of up to k rows, from highest to lowest score;
+            rows that share no term with the query are left out
+        """
+        return self.best(self.scores(query), k)
+
+    @staticmethod
+    def best(scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Selects the k rows with the highest scores, leaving out rows that scored zero.
+        """
+        rows = top_k(scores, k)
+        rows = rows[scores[rows] > 0]
+        return rows, scores[rows]
+
+    def save(self, path: str) -> None:
+        """
+        Writes the index to a .npz file. The file is written under a temporary name and then renamed,
+        so readers never see a partially written index.
+        """
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        vocabulary, vocabulary_offsets = pack_strings(self.vocabulary)
+        np.savez(tmp_path, vocabulary=vocabulary, vocabulary_offsets=vocabulary_offsets, offsets=self.offsets,
+                 rows=self.rows, weights=self.weights,
+                 meta=np.array(json.dumps({'n_rows': self.n_rows, 'fingerprint': self.fingerprint})))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """
+        Reads an index written by save.
+        """
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            return cls(unpack_strings(data['vocabulary'], data['vocabulary_offsets']), data['offsets'], data['rows'],
+                       data['weights'], meta['n_rows'], meta['fingerprint'])
+
+
+def load_or_build_bm25(path: str, data_df: pd.DataFrame, **build_args) -> BM25Index:
+    """
+    Loads the BM25 index saved at path, or builds and saves one if it is missing or was built from different books.
+    Args:
+        path (str): path of the .npz index file
+        data_df (pd.DataFrame): dataframe the index must cover
+        build_args: arguments for BM25Index.build
+
+    Returns:
+        BM25Index over data_df
+    """
+    params = {'k1': build_args.get('k1', 1.2), 'b': build_args.get('b', 0.75),
+              'field_weights': build_args.get('field_weights', FIELD_WEIGHTS)}
+    if os.path.exists(path):
+        try:
+            index = BM25Index.load(path)
+        except KeyError:
+            # saved before the vocabulary was packed, see pack_strings
+            index = None
+        if index is not None and index.fingerprint == text_fingerprint(data_df, params):
+            return index
+    index = BM25Index.build(data_df, **build_args)
+    index.save(path)
+    return index
+
+
+def reciprocal_rank_fusion(rankings: list[np.ndarray], rrf_k: int = 60) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Merges rankings of rows: every row scores the sum of 1 / (rrf_k + rank) over the rankings it appears in.
+    Args:
+        rankings (list[numpy array]): row positions, each from best to worst
+        rrf_k (int): damping of the lower ranks
+
+    Returns:
+        The rows appearing in any ranking and their fused scores, in no particular order
+    """
+    rows = np.concatenate(rankings)
+    scores = np.concatenate([1.0 / (rrf_k + 1 + np.arange(len(ranking))) for ranking in rankings])
+    candidates, inverse = np.unique(rows, return_inverse=True)
+    return candidates, np.bincount(inverse, weights=scores, minlength=len(candidates))
+
+
+def min_max(scores: np.ndarray) -> np.ndarray:
+    spread = scores.max() - scores.min() if len(scores) else 0
+    return (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+
+
+def hybrid_search(searcher, store: VectorStore, lexical: BM25Index, query: str, query_vec: np.ndarray, k: int,
+                  fusion: str | None = None, weight: float | None = None, depth: int | None = None) \
+        -> tuple[np.ndarray, np.ndarray]:
+    """
+    Combines the dense search with BM25: both retrieve depth rows, and the union is ranked by
+    reciprocal rank fusion or by a weighted sum of the min-max normalized cosine similarity and BM25 scores.
+    Args:
+        searcher: the dense search, a VectorStore or an index over it such as an IVFIndex
+        store (VectorStore): store whose matrix gives the exact cosine similarity of the results
+        lexical (BM25Index): BM25 index over the same rows
+        query (str): user's query
+        query_vec (numpy array): embedding vector representing the query
+        k (int): number of rows to return
+        fusion (str): 'rrf' or 'weighted', defaults to lexical.fusion
+        weight (float): share of the cosine similarity in the weighted sum, defaults to lexical.weight
+        depth (int): number of rows each search retrieves, defaults to lexical.depth
+
+    Returns:
+        Row positions and cosine similarities of the k best rows, from best to worst fused score
+    """
+    fusion = fusion or lexical.fusion
+    weight = lexical.weight if weight is None else weight
+    depth = depth or lexical.depth
+    query_vec = np.asarray(query_vec, dtype=np.float32).ravel()
+    query_vec = query_vec / (np.linalg.norm(query_vec) or 1)
+    dense_rows, _ = searcher.search(query_vec, depth)
+    lexical_scores = lexical.scores(query)
+    lexical_rows, _ = lexical.best(lexical_scores, depth)
+    if fusion == 'rrf':
+        candidates, fused = reciprocal_rank_fusion([dense_rows, lexical_rows])
+    elif fusion == 'weighted':
+        candidates = np.union1d(dense_rows, lexical_rows)
+        fused = (weight * min_max(store.matrix[candidates] @ query_vec)
+                 + (1 - weight) * min_max(lexical_scores[candidates]))
+    else:
+        raise ValueError(f"Unknown fusion {fusion!r}, use 'rrf' or 'weighted'")
+    # ties are broken in favor of the lower row, as in the dense search
+    best = candidates[top_k(fused, k)]
+    return best, store.matrix[best] @ query_vec
@@ -0,0 +1,117 @@
+import math
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from bm25_index import BM25Index, hybrid_search, load_or_build_bm25, pack_strings, reciprocal_rank_fusion, terms, \
+    unpack_strings
+from vector_store import VectorStore
+
+BOOKS = pd.DataFrame({
+    'id': [10, 11, 12, 13],
+    'title': ['Dune', 'The Hobbit', 'Fool Moon', 'Moon Dust'],
+    'author': ['Frank Herbert', 'J. R. R. Tolkien', 'Jim Butcher', None],
+    'summary': ['Paul Atreides leads the Fremen of the desert planet Arrakis.',
+                'Bilbo Baggins joins a company of dwarves to take back their mountain from a dragon.',
+                'Harry Dresden hunts werewolves in Chicago under a full moon.',
+                'Astronauts are trapped under the dust of the moon.']})
+
+
+def naive_bm25(data_df, query, k1=1.2, b=0.75, field_weights=None):
+    field_weights = field_weights or {'title': 3.0, 'author': 2.0, 'summary': 1.0}
+    docs = []
+    for record in data_df.to_dict('records'):
+        counts = {}
+        for field, weight in field_weights.items():
+            for term in terms(record[field]):
+                counts[term] = counts.get(term, 0) + weight
+        docs.append(counts)
+    lengths = [sum(doc.values()) for doc in docs]
+    average = sum(lengths) / len(lengths)
+    scores = []
+    for doc, length in zip(docs, lengths):
+        score = 0.0
+        for term in set(terms(query)):
+            if term in doc:
+                df = sum(term in other for other in docs)
+                idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+                tf = doc[term]
+                score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average))
+        scores.append(score)
+    return np.array(scores)
+
+
+class TestBM25Index(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.index = BM25Index.build(BOOKS)
+
+    def test_postings(self):
+        self.assertEqual(self.index.offsets[-1], len(self.index.rows))
+        moon = self.index.term_ids['moon']
+        self.assertEqual(self.index.rows[self.index.offsets[moon]:self.index.offsets[moon + 1]].tolist(), [2, 3])
+        self.assertNotIn('the', self.index.term_ids)
+
+    def test_scores_match_bm25(self):
+        for query in ['Who leads the Fremen?', 'moon werewolves', 'Tolkien dragon', 'nothing matches']:
+            np.testing.assert_allclose(self.index.scores(query), naive_bm25(BOOKS, query), rtol=1e-5)
+
+    def test_search(self):
+        rows, scores = self.index.search('What hunts under the full moon in Fool Moon?', 3)
+        self.assertEqual(rows.tolist()[:2], [2, 3])
+        self.assertTrue(np.all(np.diff(scores) <= 0))
+        self.assertEqual(len(self.index.search('zzz', 3)[0]), 0)
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'books.bm25.npz')
+            index = load_or_build_bm25(path, BOOKS)
+            loaded = load_or_build_bm25(path, BOOKS)
+            np.testing.assert_array_equal(loaded.scores('dragon moon'), index.scores('dragon moon'))
+            self.assertEqual(loaded.fingerprint, index.fingerprint)
+            # an index of other books is rebuilt
+            changed = BOOKS.assign(summary=BOOKS['summary'].str.replace('dragon', 'wizard'))
+            rebuilt = load_or_build_bm25(path, changed)
+            self.assertNotEqual(rebuilt.fingerprint, index.fingerprint)
+            self.assertEqual(BM25Index.load(path).fingerprint, rebuilt.fingerprint)
+
+
+    def test_pack_strings(self):
+        strings = ['moon', '', 'a' * 100, 'drăgon']
+        data, offsets = pack_strings(strings)
+        self.assertEqual(data.nbytes, sum(len(string.encode()) for string in strings))
+        self.assertListEqual(unpack_strings(data, offsets), strings)
+
+
+class TestFusion(unittest.TestCase):
+    def test_reciprocal_rank_fusion(self):
+        rows, scores = reciprocal_rank_fusion([np.array([5, 1, 2]), np.array([1, 7])], rrf_k=0)
+        fused = dict(zip(rows.tolist(), scores.tolist()))
+        self.assertEqual(fused, {1: 1 / 2 + 1, 2: 1 / 3, 5: 1, 7: 1 / 2})
+
+    def test_hybrid_search(self):
+        lexical = BM25Index.build(BOOKS)
+        # the embeddings point the query at the wrong book, BM25 at the right one
+        store = VectorStore(np.eye(4))
+        query_vec = np.array([1.0, 0.0, 0.0, 0.2])
+        for fusion in ['rrf', 'weighted']:
+            rows, sims = hybrid_search(store, store, lexical, 'Where does Moon Dust take place?', query_vec, 2,
+                                       fusion=fusion)
+            self.assertEqual(rows[0], 3)
+            np.testing.assert_allclose(sims, store.matrix[rows] @ (query_vec / np.linalg.norm(query_vec)),
+                                       rtol=1e-5)
+        with self.assertRaises(ValueError):
+            hybrid_search(store, store, lexical, 'moon', query_vec, 2, fusion='max')
+
+    def test_weight_picks_the_signal(self):
+        lexical = BM25Index.build(BOOKS)
+        store = VectorStore(np.eye(4))
+        query_vec = np.array([1.0, 0.0, 0.0, 0.2])
+        dense, _ = hybrid_search(store, store, lexical, 'Moon Dust', query_vec, 1, fusion='weighted', weight=1.0)
+        sparse, _ = hybrid_search(store, store, lexical, 'Moon Dust', query_vec, 1, fusion='weighted', weight=0.0)
+        self.assertEqual((dense.tolist(), sparse.tolist()), ([0], [3]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,346 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a query for use as a cache key, so that queries differing only in case or whitespace share an entry.
+    """
+    return " ".join(query.casefold().split())
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache holding at most max_size entries, evicting the least recently used entry first.
+    Entries older than ttl seconds are treated as missing.
+    """
+    def __init__(self, max_size: int = 1024, ttl: float | None = None, clock=time.monotonic):
+        """
+        Args:
+            max_size (int): maximum number of entries
+            ttl (float): seconds an entry stays valid, None to keep entries until they are evicted
+            clock: function returning the current time in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored under key and marks it as recently used, or default if there is no valid entry.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= self.clock():
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value) -> None:
+        """
+        Stores value under key, evicting the least recently used entries if the cache is full.
+        """
+        if self.max_size <= 0:
+            return
+        expires = self.clock() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        """
+        Returns the hit, miss, eviction and expiration counters along with the current size.
+        """
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations}
+
+
+class DiskStore:
+    """
+    Key-value store of bytes in a SQLite file, so that cached values survive restarts.
+    When it holds more than max_entries values, the least recently used values are deleted first.
+    The size is only checked every prune_every writes, so the file can briefly hold that many more values.
+    """
+    def __init__(self, path: str, ttl: float | None = None, max_entries: int | None = None,
+                 prune_every: int | None = None, clock=time.time):
+        """
+        Args:
+            path (str): path of the SQLite file, created if it does not exist
+            ttl (float): seconds a value stays valid, None to keep values forever
+            max_entries (int): maximum number of values kept, None for no limit
+            prune_every (int): number of writes between size checks, defaults to a tenth of max_entries (at most 1000)
+            clock: function returning the current time in seconds
+        """
+        self.ttl = ttl
+        self.clock = clock
+        self.max_entries = max_entries
+        if prune_every is None:
+            prune_every = max(1, min(1000, (max_entries or 0) // 10))
+        self.prune_every = prune_every
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS cache "
+                                    "(key TEXT PRIMARY KEY, value BLOB NOT NULL, created REAL NOT NULL)")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(cache)")]
+            if 'accessed' not in columns:
+                # files written before values were evicted by last use
+                self.connection.execute("ALTER TABLE cache ADD COLUMN accessed REAL NOT NULL DEFAULT 0")
+                self.connection.execute("UPDATE cache SET accessed = created")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def get(self, key: str) -> bytes | None:
+        """
+        Returns the value stored under key and marks it as recently used, or None if there is no valid value.
+        """
+        now = self.clock()
+        with self.lock:
+            row = self.connection.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl is not None and row[1] + self.ttl <= now):
+                return None
+            if self.max_entries is not None:
+                with self.connection:
+                    self.connection.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put_many(self, items: dict[str, bytes]) -> None:
+        """
+        Stores several values in one transaction, replacing any values already stored under the same keys.
+        """
+        now = self.clock()
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO cache (key, value, created, accessed) "
+                                        "VALUES (?, ?, ?, ?)",
+                                        [(key, value, now, now) for key, value in items.items()])
+            self.writes += len(items)
+            if self.max_entries is not None and self.writes >= self.prune_every:
+                self.writes = 0
+                excess = self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+                if excess > 0:
+                    # walks the accessed index from the least recently used value instead of sorting the table
+                    self.connection.execute("DELETE FROM cache WHERE rowid IN "
+                                            "(SELECT rowid FROM cache ORDER BY accessed LIMIT ?)", (excess,))
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def clear(self) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM cache")
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class EmbeddingCache:
+    """
+    Cache of query embeddings keyed on the model name and the normalized query text,
+    so that repeated queries skip the encoder. Entries live in an LRUCache and, if a path is given,
+    also in a DiskStore that refills the in-memory cache after a restart.
+    """
+    def __init__(self, model_name: str, max_size: int = 1024, ttl: float | None = None, path: str | None = None,
+                 max_entries: int | None = None):
+        """
+        Args:
+            model_name (str): name of the model the embeddings are computed with
+            max_size (int): maximum number of embeddings kept in memory
+            ttl (float): seconds an embedding stays valid, None to keep embeddings until they are evicted
+            path (str): optional path of a SQLite file to persist the embeddings in
+            max_entries (int): maximum number of embeddings kept in the SQLite file, defaults to max_size
+        """
+        self.model_name = model_name
+        self.memory = LRUCache(max_size, ttl)
+        self.disk = DiskStore(path, ttl, max_size if max_entries is None else max_entries) if path else None
+        self.disk_hits = 0
+
+    def key(self, query: str) -> str:
+        return f"{self.model_name}\n{normalize_query(query)}"
+
+    def encode(self, model, queries: list[str], batch_size: int = 32) -> np.ndarray:
+        """
+        Returns the embeddings of the queries, encoding only the distinct queries that are not cached, in one call.
+        Args:
+            model: SentenceTransformers model to encode uncached queries with
+            queries (list[str]): queries to embed
+            batch_size (int): batch size passed to the model
+
+        Returns:
+            (len(queries), dim) float32 matrix of query embeddings
+        """
+        keys = [self.key(query) for query in queries]
+        found = {}
+        missing = {}
+        for key, query in zip(keys, queries):
+            if key in found or key in missing:
+                continue
+            embedding = self.memory.get(key)
+            if embedding is None and self.disk is not None:
+                blob = self.disk.get(key)
+                if blob is not None:
+                    embedding = np.frombuffer(blob, dtype='<f4')
+                    self.memory.put(key, embedding)
+                    self.disk_hits += 1
+            if embedding is None:
+                missing[key] = query
+            else:
+                found[key] = embedding
+        if missing:
+            encoded = np.asarray(model.encode(list(missing.values()), batch_size=batch_size), dtype=np.float32)
+            new = dict(zip(missing, np.atleast_2d(encoded)))
+            for key, embedding in new.items():
+                embedding.flags.writeable = False
+                self.memory.put(key, embedding)
+            if self.disk is not None:
+                self.disk.put_many({key: embedding.astype('<f4').tobytes() for key, embedding in new.items()})
+            found.update(new)
+        return np.stack([found[key] for key in keys]) if keys else np.zeros((0, 0), dtype=np.float32)
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> dict[str, int]:
+        """
+        Returns the in-memory cache counters, plus the number of misses that were served from disk.
+        """
+        return {**self.memory.stats(), 'disk_hits': self.disk_hits}
+
+
+class CacheMiss(LookupError):
+    """
+    Raised in replay mode when a call has no recorded result.
+    """
+
+
+class ChatCache:
+    """
+    Persistent cache of LLM chat completions, addressed by a hash of the model name, messages and sampling parameters.
+    In 'read-through' mode cached completions are returned and new ones are requested and recorded.
+    In 'record' mode every completion is requested and recorded, overwriting what was cached.
+    In 'replay' mode only cached completions are returned and a missing one raises CacheMiss,
+    so that runs are deterministic and need no network access.
+    """
+    MODES = ('read-through', 'record', 'replay')
+
+    def __init__(self, path: str, mode: str = 'read-through', max_entries: int | None = None):
+        """
+        Args:
+            path (str): path of the SQLite file holding the completions
+            mode (str): 'read-through', 'record' or 'replay'
+            max_entries (int): maximum number of completions kept, None for no limit
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown chat cache mode {mode!r}, expected one of {', '.join(self.MODES)}")
+        self.mode = mode
+        self.store = DiskStore(path, max_entries=max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, messages: list[tuple[str, str]], params: dict) -> str:
+        """
+        Hashes everything that determines a completion.
+        Args:
+            model (str): name of the chat model
+            messages (list[tuple[str, str]]): (role, content) of every message
+            params (dict): sampling parameters, e.g. temperature
+
+        Returns:
+            Hex digest identifying the request
+        """
+        request = json.dumps({'model': model, 'messages': messages, 'params': params},
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def get_or_call(self, key: str, call) -> str:
+        """
+        Returns the completion cached under key, or calls call() to get it, depending on the mode.
+        Args:
+            key (str): key made by ChatCache.key
+            call: function requesting the completion from the LLM
+
+        Returns:
+            The completion text
+        """
+        content = self.lookup(key)
+        if content is None:
+            content = call()
+            self.record(key, content)
+        return content
+
+    def lookup(self, key: str) -> str | None:
+        """
+        Returns the completion cached under key, or None if it has to be requested (always in 'record' mode).
+        Raises CacheMiss in 'replay' mode if there is no cached completion.
+        """
+        if self.mode != 'record':
+            cached = self.store.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached.decode()
+        self.misses += 1
+        if self.mode == 'replay':
+            raise CacheMiss(f"No recorded completion for request {key}")
+        return None
+
+    def record(self, key: str, content: str) -> None:
+        self.store.put_many({key: content.encode()})
+
+    def stats(self) -> dict[str, int]:
+        return {'size': len(self.store), 'hits': self.hits, 'misses': self.misses}
+
+
+def chat_cache_from_env() -> ChatCache | None:
+    """
+    Creates the chat completion cache configured by the BRAG_LLM_CACHE (path of the SQLite file),
+    BRAG_LLM_CACHE_MODE and BRAG_LLM_CACHE_SIZE environment variables, or returns None if BRAG_LLM_CACHE is not set.
+    """
+    path = os.environ.get("BRAG_LLM_CACHE")
+    if not path:
+        return None
+    max_entries = os.environ.get("BRAG_LLM_CACHE_SIZE")
+    return ChatCache(path, os.environ.get("BRAG_LLM_CACHE_MODE", "read-through"),
+                     int(max_entries) if max_entries else None)
+
+
+def embedding_cache_from_env(model_name: str) -> EmbeddingCache:
+    """
+    Creates the query embedding cache configured by the BRAG_QUERY_CACHE_SIZE, BRAG_QUERY_CACHE_TTL,
+    BRAG_QUERY_CACHE_PATH and BRAG_QUERY_CACHE_DISK_SIZE environment variables.
+    """
+    ttl = os.environ.get("BRAG_QUERY_CACHE_TTL")
+    max_entries = os.environ.get("BRAG_QUERY_CACHE_DISK_SIZE")
+    return EmbeddingCache(model_name, max_size=int(os.environ.get("BRAG_QUERY_CACHE_SIZE", 1024)),
+                          ttl=float(ttl) if ttl else None, path=os.environ.get("BRAG_QUERY_CACHE_PATH"),
+                          max_entries=int(max_entries) if max_entries else None)
@@ -0,0 +1,164 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from cache import CacheMiss, ChatCache, DiskStore, EmbeddingCache, LRUCache, normalize_query
+
+
+class CountingModel:
+    """Placeholder encoder that records which sentences it was asked to encode"""
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, sentences, batch_size=32):
+        self.calls.append(list(sentences))
+        return np.array([[len(sentence), 1.0] for sentence in sentences], dtype=np.float32)
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 3, 'misses': 1, 'evictions': 1, 'expirations': 0})
+
+    def test_ttl(self):
+        now = [0.0]
+        cache = LRUCache(max_size=2, ttl=10, clock=lambda: now[0])
+        cache.put('a', 1)
+        now[0] = 9.9
+        self.assertEqual(cache.get('a'), 1)
+        now[0] = 10.0
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(len(cache), 0)
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query("  Who wrote\tDUNE? "), "who wrote dune?")
+
+    def test_repeated_queries_skip_encoder(self):
+        model = CountingModel()
+        cache = EmbeddingCache('model', max_size=10)
+        first = cache.encode(model, ["Who wrote Dune?", "who wrote  dune?", "Macbeth"])
+        second = cache.encode(model, ["Macbeth", "Who wrote Dune?"])
+        self.assertEqual(model.calls, [["Who wrote Dune?", "Macbeth"]])
+        self.assertTrue(np.array_equal(first[0], first[1]))
+        self.assertTrue(np.array_equal(second, first[[2, 0]]))
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_keys_include_model_name(self):
+        self.assertNotEqual(EmbeddingCache('a').key("q"), EmbeddingCache('b').key("q"))
+
+    def test_disk_store_survives_restart(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'queries.db')
+            model = CountingModel()
+            cache = EmbeddingCache('model', path=path)
+            expected = cache.encode(model, ["Who wrote Dune?"])
+            cache.disk.close()
+            restarted = EmbeddingCache('model', path=path)
+            self.assertTrue(np.array_equal(restarted.encode(model, ["who wrote dune?"]), expected))
+            self.assertEqual(len(model.calls), 1)
+            self.assertEqual(restarted.stats()['disk_hits'], 1)
+            restarted.disk.close()
+
+    def test_disk_store_is_bounded(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = EmbeddingCache('model', max_size=2, path=os.path.join(tmp, 'queries.db'))
+            cache.encode(CountingModel(), ["a", "b", "c"])
+            self.assertEqual(len(cache.disk), 2)
+            cache.disk.close()
+
+    def test_disk_store_ttl(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = DiskStore(os.path.join(tmp, 'queries.db'), ttl=-1)
+            store.put_many({'key': b'value'})
+            self.assertIsNone(store.get('key'))
+            store.close()
+
+    def test_disk_store_max_entries(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = DiskStore(os.path.join(tmp, 'queries.db'), max_entries=2)
+            for key in ['a', 'b', 'c']:
+                store.put_many({key: key.encode()})
+            self.assertEqual(len(store), 2)
+            self.assertIsNone(store.get('a'))
+            self.assertEqual(store.get('c'), b'c')
+            store.close()
+
+    def test_disk_store_evicts_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            now = [0.0]
+            store = DiskStore(os.path.join(tmp, 'queries.db'), max_entries=2, clock=lambda: now[0])
+            for key in ['a', 'b', 'c']:
+                now[0] += 1
+                store.put_many({key: key.encode()})
+                if key == 'b':
+                    now[0] += 1
+                    store.get('a')
+            self.assertEqual(store.get('a'), b'a')
+            self.assertIsNone(store.get('b'))
+            store.close()
+
+    def test_disk_store_prunes_periodically(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = DiskStore(os.path.join(tmp, 'queries.db'), max_entries=2, prune_every=3)
+            store.put_many({'a': b'a', 'b': b'b'})
+            store.put_many({'c': b'c'})
+            self.assertEqual(len(store), 2)
+            store.put_many({'d': b'd'})
+            self.assertEqual(len(store), 3)
+            store.close()
+
+
+class TestChatCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'chat.db')
+        self.key = ChatCache.key('mistral', [('user', 'Who wrote Dune?')], {})
+        self.calls = 0
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def call(self):
+        self.calls += 1
+        return f"Frank Herbert ({self.calls})"
+
+    def test_key(self):
+        self.assertEqual(self.key, ChatCache.key('mistral', [('user', 'Who wrote Dune?')], {}))
+        self.assertNotEqual(self.key, ChatCache.key('other', [('user', 'Who wrote Dune?')], {}))
+        self.assertNotEqual(self.key, ChatCache.key('mistral', [('user', 'Who wrote Dune?')], {'temperature': 0}))
+
+    def test_read_through(self):
+        cache = ChatCache(self.path)
+        self.assertEqual(cache.get_or_call(self.key, self.call), "Frank Herbert (1)")
+        self.assertEqual(cache.get_or_call(self.key, self.call), "Frank Herbert (1)")
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cache.stats(), {'size': 1, 'hits': 1, 'misses': 1})
+
+    def test_record_then_replay(self):
+        record = ChatCache(self.path, 'record')
+        record.get_or_call(self.key, self.call)
+        self.assertEqual(record.get_or_call(self.key, self.call), "Frank Herbert (2)")
+        replay = ChatCache(self.path, 'replay')
+        self.assertEqual(replay.get_or_call(self.key, self.call), "Frank Herbert (2)")
+        self.assertEqual(self.calls, 2)
+        other_key = ChatCache.key('mistral', [('user', 'Who wrote Emma?')], {})
+        with self.assertRaises(CacheMiss):
+            replay.get_or_call(other_key, self.call)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            ChatCache(self.path, 'offline')
+
+
+if __name__ == '__main__':
+    unittest.main()
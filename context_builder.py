@@ -0,0 +1,140 @@
+""" Fits the books given to Mistral into a token budget, keeping the passages of their summaries closest to the question"""
+
+import re
+import threading
+import numpy as np
+from alchemy_database import get_model, query_cache
+from cache import LRUCache
+from llm import TOKEN_PATTERN, book_context, count_tokens, create_template_string
+
+# sentences end at a full stop, question or exclamation mark followed by whitespace
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+# passages are made of whole sentences, adding sentences until a passage reaches about this many tokens
+PASSAGE_TOKENS = 64
+
+
+def split_passages(summary: str, passage_tokens: int = PASSAGE_TOKENS) -> list[str]:
+    """
+    Splits a summary into passages of consecutive sentences. A sentence longer than passage_tokens is a passage
+    on its own.
+    Args:
+        summary (str): book summary
+        passage_tokens (int): number of tokens after which a passage is closed
+
+    Returns:
+        The passages, in the order they appear in the summary
+    """
+    passages, sentences, tokens = [], [], 0
+    for sentence in SENTENCE_END.split(summary.strip()):
+        if sentences and tokens + count_tokens(sentence) > passage_tokens:
+            passages.append(" ".join(sentences))
+            sentences, tokens = [], 0
+        sentences.append(sentence)
+        tokens += count_tokens(sentence)
+    if sentences:
+        passages.append(" ".join(sentences))
+    return [passage for passage in passages if passage]
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cuts text after its first max_tokens tokens, as counted by llm.count_tokens.
+    """
+    if max_tokens <= 0:
+        return ""
+    for i, match in enumerate(TOKEN_PATTERN.finditer(text)):
+        if i == max_tokens - 1:
+            return text[:match.end()]
+    return text
+
+
+class ContextBuilder:
+    """
+    Shortens the context of books whose context (see llm.create_template_string) is longer than budget tokens.
+    The summary is split into passages, the passages are ranked by the cosine similarity of their embeddings
+    to the question's, and the best ones that fit are kept in their original order.
+    The passages and embeddings of recently seen summaries are cached, since the same books are retrieved often.
+    """
+    def __init__(self, budget: int, passage_tokens: int = PASSAGE_TOKENS, cache_size: int = 1024, model=None):
+        """
+        Args:
+            budget (int): maximum number of tokens of a book's context
+            passage_tokens (int): size of the passages the summaries are split into
+            cache_size (int): number of summaries whose passages are cached
+            model: SentenceTransformers model for encoding the passages and questions, defaults to get_model()
+        """
+        self.budget = budget
+        self.model = model
+        self.passage_tokens = passage_tokens
+        self.passages = LRUCache(max_size=cache_size)
+        self.lock = threading.Lock()
+        self.books = 0
+        self.trimmed = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+
+    def embedded_passages(self, summary: str) -> tuple[list[str], np.ndarray, np.ndarray]:
+        """
+        Returns the passages of a summary, their token counts and their normalized embeddings.
+        """
+        cached = self.passages.get(summary)
+        if cached is None:
+            passages = split_passages(summary, self.passage_tokens)
+            embeddings = np.array((self.model or get_model()).encode(passages), dtype=np.float32, ndmin=2)
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            cached = (passages, np.array([count_tokens(passage) for passage in passages]), embeddings / norms)
+            self.passages.put(summary, cached)
+        return cached
+
+    def encode_question(self, question: str) -> np.ndarray:
+        """
+        Embeds a question, through the shared query embedding cache when the default encoder is used.
+        The cache is keyed on the default encoder's name, so questions embedded by another model bypass it.
+        """
+        if self.model is None:
+            return query_cache.encode(get_model(), [question])[0]
+        return self.model.encode([question])[0]
+
+    def fit(self, question: str, book: dict) -> dict:
+        """
+        Fits a book's context into the budget.
+        Args:
+            question (str): user's question
+            book (dict): book information dictionary, optionally with its rendered 'context'
+
+        Returns:
+            Copy of book whose 'context' and 'context_tokens' hold the context to give Mistral
+        """
+        context = book_context(book)
+        tokens = count_tokens(context)
+        fitted = context
+        if tokens > self.budget and book.get('summary'):
+            header = create_template_string({**book, 'summary': ''})
+            available = self.budget - count_tokens(header)
+            passages, passage_tokens, embeddings = self.embedded_passages(book['summary'])
+            query_vector = np.asarray(self.encode_question(question), dtype=np.float32)
+            scores = embeddings @ query_vector
+            keep, used = [], 0
+            for i in np.argsort(-scores, kind='stable'):
+                if used + passage_tokens[i] <= available:
+                    keep.append(i)
+                    used += passage_tokens[i]
+            if keep:
+                summary = " ".join(passages[i] for i in sorted(keep))
+            else:
+                # not even the best passage fits, keep as much of it as does
+                summary = truncate_tokens(passages[int(np.argmax(scores))], available)
+            fitted = create_template_string({**book, 'summary': summary})
+        fitted_tokens = count_tokens(fitted)
+        with self.lock:
+            self.books += 1
+            self.trimmed += fitted is not context
+            self.tokens_before += tokens
+            self.tokens_after += fitted_tokens
+        return {**book, 'context': fitted, 'context_tokens': fitted_tokens}
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {'books': self.books, 'trimmed': self.trimmed, 'tokens_before': self.tokens_before,
+                    'tokens_after': self.tokens_after, 'passage_cache': self.passages.stats()}
@@ -0,0 +1,97 @@
+import unittest
+import zlib
+import numpy as np
+from context_builder import ContextBuilder, split_passages, truncate_tokens
+from llm import count_tokens, create_template_string
+
+
+class WordModel:
+    """
+    Embeds a text as its bag of words, so that passages sharing words with the question score higher.
+    """
+    def __init__(self):
+        self.encoded = 0
+
+    def encode(self, data, batch_size=32):
+        self.encoded += len(data)
+        embeddings = np.zeros((len(data), 64), dtype=np.float32)
+        for row, text in enumerate(data):
+            for word in text.lower().replace('.', ' ').replace('?', ' ').split():
+                embeddings[row, zlib.crc32(word.encode()) % 64] += 1
+        return embeddings
+
+
+SUMMARY = ("Paul Atreides moves with his family to the desert planet Arrakis. " * 6 +
+           "The sandworms of Arrakis guard the spice melange. " * 6 +
+           "Paul's mother Jessica belongs to the Bene Gesserit sisterhood. " * 6)
+
+
+def book(summary=SUMMARY):
+    return {'id': 1, 'title': 'Dune', 'author': 'Frank Herbert', 'pub_date': '1965', 'genres': None,
+            'summary': summary}
+
+
+class TestPassages(unittest.TestCase):
+    def test_split_passages(self):
+        passages = split_passages(SUMMARY, passage_tokens=40)
+        self.assertEqual(" ".join(passages), SUMMARY.strip())
+        self.assertTrue(all(count_tokens(passage) <= 40 for passage in passages))
+        self.assertEqual(split_passages("One sentence without an end"), ["One sentence without an end"])
+        self.assertEqual(split_passages(""), [])
+
+    def test_long_sentence_is_its_own_passage(self):
+        sentence = "word " * 100 + "end."
+        self.assertEqual(split_passages(f"Short one. {sentence} Short two.", passage_tokens=20),
+                         ["Short one.", sentence, "Short two."])
+
+    def test_truncate_tokens(self):
+        self.assertEqual(truncate_tokens("The sandworms guard the spice.", 3), "The sandworm")
+        self.assertEqual(truncate_tokens("Short.", 10), "Short.")
+        self.assertEqual(truncate_tokens("Short.", 0), "")
+
+
+class TestContextBuilder(unittest.TestCase):
+    def test_short_context_is_kept(self):
+        builder = ContextBuilder(1000, model=WordModel())
+        fitted = builder.fit("Where does Dune take place?", book())
+        self.assertEqual(fitted['context'], create_template_string(book()))
+        self.assertEqual(builder.stats()['trimmed'], 0)
+        self.assertEqual(builder.model.encoded, 0)
+
+    def test_long_context_is_fitted(self):
+        builder = ContextBuilder(80, passage_tokens=30, model=WordModel())
+        fitted = builder.fit("What do the sandworms guard?", book())
+        self.assertLessEqual(fitted['context_tokens'], 80)
+        self.assertEqual(fitted['context_tokens'], count_tokens(fitted['context']))
+        self.assertTrue(fitted['context'].startswith("Dune was written by Frank Herbert in 1965."))
+        self.assertIn("sandworms", fitted['context'])
+        self.assertNotIn("Bene Gesserit", fitted['context'])
+        stats = builder.stats()
+        self.assertEqual((stats['books'], stats['trimmed']), (1, 1))
+        self.assertLess(stats['tokens_after'], stats['tokens_before'])
+
+    def test_passages_are_cached(self):
+        model = WordModel()
+        builder = ContextBuilder(80, passage_tokens=30, model=model)
+        builder.fit("What do the sandworms guard?", book())
+        encoded = model.encoded
+        fitted = builder.fit("Who is Paul's mother?", book())
+        # only the new question is encoded
+        self.assertEqual(model.encoded, encoded + 1)
+        self.assertIn("Jessica", fitted['context'])
+
+    def test_custom_model_does_not_share_query_cache(self):
+        for model in (WordModel(), WordModel()):
+            ContextBuilder(80, passage_tokens=30, model=model).fit("What do the sandworms guard?", book())
+            # every model embeds the question itself rather than reusing another model's embedding
+            self.assertEqual(model.encoded, len(split_passages(SUMMARY, 30)) + 1)
+
+    def test_passage_larger_than_budget_is_truncated(self):
+        builder = ContextBuilder(40, model=WordModel())
+        fitted = builder.fit("What do the sandworms guard?", book("sandworms " * 200 + "guard the spice."))
+        self.assertLessEqual(fitted['context_tokens'], 40)
+        self.assertIn("sandworms", fitted['context'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,42 +1,153 @@
 """ Code for creating the database"""
 
-import pandas as pd
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sentence_transformers import SentenceTransformer
-import numpy as np
 import json
-from alchemy_database import Base, add_book
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from typing import Iterator
+import numpy as np
+import pandas as pd
+from sqlalchemy import delete, insert, update
+from sqlalchemy.orm import Session
+from alchemy_database import Book, book_rows, content_hash, context_columns, get_model, make_book_db
+from llm import TEMPLATE_VERSION, create_template_string
+
+COLUMNS = ['wikipedia_id', 'freebase_id', 'title', 'author', 'pub_date', 'genres', 'summary']
+
+
+def read_books(filepath: str, chunk_size: int) -> Iterator[list[dict]]:
+    """
+    Streams the book summaries from the Kaggle TSV, chunk_size books at a time,
+    so that memory use does not depend on the size of the file.
+
+    Args:
+        filepath (str): path of booksummaries.txt
+        chunk_size (int): number of books per chunk
+    Returns:
+        Iterator over lists of book dictionaries with wikipedia_id, freebase_id, title, author, genres,
+        summary and pub_date
+    """
+    # read everything as strings so that dtypes do not change from chunk to chunk (e.g. years parsed as floats)
+    reader = pd.read_csv(filepath, header=None, names=COLUMNS, delimiter="\t", encoding='UTF8', dtype=str,
+                         chunksize=chunk_size)
+    for chunk in reader:
+        chunk = chunk.replace({np.nan: None})
+        books = []
+        for row in chunk.itertuples(index=False):
+            books.append({'wikipedia_id': int(row.wikipedia_id),
+                          'freebase_id': row.freebase_id,
+                          'title': row.title,
+                          'author': row.author,
+                          'genres': json.loads(row.genres) if row.genres is not None else None,
+                          'summary': row.summary,
+                          'pub_date': row.pub_date})
+        yield books
+
+
+def ingest(model, db: Session, filepath: str, chunk_size: int = 2048, batch_size: int = 128,
+           delete_missing: bool = True) -> Counter:
+    """
+    Brings the database in line with the TSV, one chunk (and one transaction) at a time,
+    reporting progress and throughput after each chunk.
+    Books are matched on their wikipedia_id, and only books that are new or whose embedding input
+    (see content_hash) changed are embedded and written. Since every chunk is committed,
+    rerunning an interrupted ingest skips everything that was already written.
+    Books written before wikipedia_id was stored are matched on their content_hash instead.
+    Unchanged books whose context was rendered with an older TEMPLATE_VERSION only get their context rewritten.
+
+    Args:
+        model: SentenceTransformers model for encoding document embeddings
+        db (Session): database to fill
+        filepath (str): path of booksummaries.txt
+        chunk_size (int): number of books read, embedded and committed together
+        batch_size (int): number of books encoded together by the model
+        delete_missing (bool): whether to delete books that are no longer in the TSV once every chunk is written
+    Returns:
+        Counter with the number of books added, updated, unchanged and deleted
+    """
+    existing = {}
+    unkeyed = {}
+    stale_contexts = set()
+    for book_id, wikipedia_id, book_hash, context_version in db.query(Book.id, Book.wikipedia_id, Book.content_hash,
+                                                                      Book.context_version):
+        if wikipedia_id is not None:
+            existing[wikipedia_id] = (book_id, book_hash)
+        elif book_hash is not None:
+            unkeyed[book_hash] = book_id
+        if context_version != TEMPLATE_VERSION:
+            stale_contexts.add(book_id)
+    seen = set()
+    counts = Counter()
+    start = time.perf_counter()
+    total = 0
+    for books in read_books(filepath, chunk_size):
+        new_books, changed_books, keyed = [], [], []
+        for book in books:
+            if book['wikipedia_id'] in seen:
+                continue
+            seen.add(book['wikipedia_id'])
+            text = create_template_string(book)
+            book_hash = content_hash(text)
+            current = existing.get(book['wikipedia_id'])
+            if current is None and book_hash in unkeyed:
+                # the same book stored without its wikipedia_id; only the key needs to be filled in
+                book_id = unkeyed.pop(book_hash)
+                keyed.append({'id': book_id,
+                              'wikipedia_id': book['wikipedia_id'],
+                              'freebase_id': book['freebase_id'],
+                              **(context_columns(text) if book_id in stale_contexts else {})})
+            elif current is None:
+                new_books.append(book)
+            elif current[1] != book_hash:
+                changed_books.append((current[0], book))
+            else:
+                if current[0] in stale_contexts:
+                    # the embedding is still valid, only the stored context needs rendering again
+                    keyed.append({'id': current[0], **context_columns(text)})
+                counts['unchanged'] += 1
+        rows = book_rows(model, new_books + [book for _, book in changed_books], batch_size)
+        if new_books:
+            db.execute(insert(Book), rows[:len(new_books)])
+        if changed_books:
+            db.execute(update(Book), [{**row, 'id': book_id}
+                                      for (book_id, _), row in zip(changed_books, rows[len(new_books):])])
+        # a bulk update needs the same columns in every row
+        for columns in {tuple(row) for row in keyed}:
+            db.execute(update(Book), [row for row in keyed if tuple(row) == columns])
+        db.commit()
+        counts['added'] += len(new_books)
+        counts['updated'] += len(changed_books)
+        counts['unchanged'] += sum('wikipedia_id' in row for row in keyed)
+        total += len(books)
+        elapsed = time.perf_counter() - start
+        print(f"{total} books processed in {elapsed:.1f} s ({total / elapsed:.1f} books/sec), "
+              f"{counts['added']} added, {counts['updated']} updated, {counts['unchanged']} unchanged", flush=True)
+
+    if delete_missing:
+        missing = [book_id for wikipedia_id, (book_id, _) in existing.items() if wikipedia_id not in seen]
+        missing += list(unkeyed.values())
+        # delete in slices to stay below SQLite's limit on the number of bound parameters
+        for i in range(0, len(missing), 500):
+            db.execute(delete(Book).where(Book.id.in_(missing[i:i + 500])))
+        db.commit()
+        counts['deleted'] = len(missing)
+        print(f"{len(missing)} books deleted")
+    return counts
+
 
 if __name__ == '__main__':
-    # read in book summaries from kaggle dataset found at
+    parser = ArgumentParser()
+    # book summaries from the kaggle dataset found at
     # https://www.kaggle.com/datasets/ymaricar/cmu-book-summary-dataset
-    df = pd.read_csv("booksummaries.txt", header=None, delimiter="\t", encoding='UTF8')
-    df = df.rename(columns={
-        0: 'wikipedia_id',
-        1: 'freebase_id',
-        2: 'title',
-        3: 'author',
-        4: 'pub_date',
-        5: 'genres',
-        6: 'summary'
-    })
-    df = df.replace({np.nan: None})
-    print(df.head(3))
-
-    # create database session
-    DATABASE_URL = "sqlite:///books_db.db"
-    engine = create_engine(DATABASE_URL, echo=True)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    Base.metadata.create_all(bind=engine)
-    db = SessionLocal()
-
-    # embedding model
-    model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
-
-    # add all books in the df to the database
-    for index, row in df.iterrows():
-        genres = None
-        if row['genres'] is not None:
-            genres = json.loads(row['genres'])
-        add_book(model, db, row['title'], row['author'], genres, row['summary'], row['pub_date'])
+    parser.add_argument('-f', '--filepath', default='booksummaries.txt', help='the Kaggle book summaries TSV')
+    parser.add_argument('--db-url', default='sqlite:///books_db.db', help='url of the database to fill')
+    parser.add_argument('--chunk-size', type=int, default=2048,
+                        help='the number of books read, embedded and committed together')
+    parser.add_argument('-b', '--batch-size', type=int, default=128,
+                        help='the number of books encoded together by the model')
+    parser.add_argument('--keep-missing', action='store_true',
+                        help="don't delete books from the database that are no longer in the TSV")
+    args = parser.parse_args()
+
+    db = make_book_db(args.db_url)
+    ingest(get_model(), db, args.filepath, args.chunk_size, args.batch_size, delete_missing=not args.keep_missing)
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+from alchemy_database import Book, add_book, make_book_db, make_book_df
+from create_database import ingest, read_books
+from llm import TEMPLATE_VERSION
+
+TSV = ("1\t/m/01\tBook One\tAuthor One\t1999\t{\"/m/02\": \"Fiction\"}\tFirst summary.\n"
+       "2\t/m/03\tBook Two\t\t2001-05-04\t\tSecond summary.\n"
+       "3\t/m/04\tBook Three\tAuthor Three\t\t\tThird summary.\n")
+
+
+class Model:
+    def __init__(self):
+        self.encoded = 0
+
+    def encode(self, data, batch_size=32):
+        if isinstance(data, str):
+            return [1.0, float(len(data)), 0.0]
+        self.encoded += len(data)
+        return [[1.0, float(len(text)), 0.0] for text in data]
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self.tmpdir.name, 'booksummaries.txt')
+        with open(self.filepath, 'w') as f:
+            f.write(TSV)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_read_books_in_chunks(self):
+        chunks = list(read_books(self.filepath, 2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(chunks[0][0]['genres'], {'/m/02': 'Fiction'})
+        self.assertEqual(chunks[0][0]['pub_date'], '1999')
+        self.assertIsNone(chunks[0][1]['author'])
+        self.assertIsNone(chunks[1][0]['pub_date'])
+
+    def write_tsv(self, contents):
+        with open(self.filepath, 'w') as f:
+            f.write(contents)
+
+    def test_ingest(self):
+        db = make_book_db("sqlite:///:memory:")
+        counts = ingest(Model(), db, self.filepath, chunk_size=2, batch_size=2)
+        self.assertEqual(counts['added'], 3)
+        df = make_book_df(db)
+        self.assertEqual(list(df['title']), ['Book One', 'Book Two', 'Book Three'])
+        self.assertEqual([book.wikipedia_id for book in db.query(Book).order_by(Book.id)], [1, 2, 3])
+
+    def test_rerun_skips_unchanged_books(self):
+        db = make_book_db("sqlite:///:memory:")
+        ingest(Model(), db, self.filepath, chunk_size=2)
+        model = Model()
+        counts = ingest(model, db, self.filepath, chunk_size=2)
+        self.assertEqual(model.encoded, 0)
+        self.assertEqual(counts['unchanged'], 3)
+
+    def test_rerun_renders_stale_contexts(self):
+        db = make_book_db("sqlite:///:memory:")
+        ingest(Model(), db, self.filepath, chunk_size=2)
+        db.query(Book).filter_by(wikipedia_id=2).update({'context': 'old', 'context_version': None})
+        db.commit()
+        model = Model()
+        counts = ingest(model, db, self.filepath, chunk_size=2)
+        self.assertEqual(model.encoded, 0)
+        self.assertEqual(counts['unchanged'], 3)
+        book = db.query(Book).filter_by(wikipedia_id=2).one()
+        self.assertEqual(book.context_version, TEMPLATE_VERSION)
+        self.assertTrue(book.context.startswith("Book Two"))
+
+    def test_rerun_updates_and_deletes(self):
+        db = make_book_db("sqlite:///:memory:")
+        ingest(Model(), db, self.filepath, chunk_size=2)
+        ids = {book.wikipedia_id: book.id for book in db.query(Book)}
+        self.write_tsv(TSV.replace("Second summary.", "A new second summary.").replace(
+            "3\t/m/04\tBook Three\tAuthor Three\t\t\tThird summary.\n",
+            "4\t/m/05\tBook Four\tAuthor Four\t\t\tFourth summary.\n"))
+        model = Model()
+        counts = ingest(model, db, self.filepath, chunk_size=2)
+        self.assertEqual(model.encoded, 2)
+        self.assertEqual((counts['added'], counts['updated'], counts['unchanged'], counts['deleted']), (1, 1, 1, 1))
+        books = {book.wikipedia_id: book for book in db.query(Book)}
+        self.assertEqual(sorted(books), [1, 2, 4])
+        self.assertEqual(books[2].id, ids[2])
+        self.assertEqual(books[2].summary, "A new second summary.")
+
+    def test_books_without_key_are_matched_on_content(self):
+        db = make_book_db("sqlite:///:memory:")
+        add_book(Model(), db, "Book One", "Author One", {"/m/02": "Fiction"}, "First summary.", "1999")
+        model = Model()
+        counts = ingest(model, db, self.filepath)
+        self.assertEqual(model.encoded, 2)
+        self.assertEqual(counts['added'], 2)
+        self.assertEqual(db.query(Book).filter_by(title="Book One").one().wikipedia_id, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,10 @@
 # code adapted from COSI 132A spring 2023
 
 from argparse import ArgumentParser
-from sentence_transformers import SentenceTransformer
 from elasticsearch_dsl import Search, connections
 from elasticsearch_dsl.query import ScriptScore, Query
+from alchemy_database import MODEL_NAME, get_model
+from cache import embedding_cache_from_env
 
 # set an elasticsearch connection to your localhost
 with open('es_password.txt') as f:
@@ -12,7 +13,7 @@ with open('es_password.txt') as f:
 connections.create_connection(hosts=['https://localhost:9200'], timeout=100, alias="default",
                               basic_auth=('elastic', es_password), verify_certs=False)
 
-model = SentenceTransformer("all-MiniLM-L6-v2")
+query_cache = embedding_cache_from_env(MODEL_NAME)
 
 
 def generate_query(q_vector: list[float], scoring_function: str) -> Query:
@@ -74,9 +75,8 @@ def process_query_and_search(query: str, index_name: str, k: int = 1, scoring_fu
     Returns:
         List representing the top k documents
     """
-    # get the query embedding and convert it to a list
-    embeddings = model.encode([query])
-    query_vector = embeddings.tolist()[0]
+    # get the query embedding, from the cache if the query was seen before, and convert it to a list
+    query_vector = query_cache.encode(get_model(), [query])[0].tolist()
     # ElasticSearch Query scored with specified function
     query_vector = generate_query(query_vector, scoring_function)
     # search
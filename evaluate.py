@@ -1,14 +1,25 @@
 from alchemy_database import *
 from argparse import ArgumentParser
-from falcon_evaluate.evaluate import FalconEvaluator
-from falcon_evaluate.utils import MetricsAggregator
+from bm25_index import load_or_build_bm25
+from context_builder import ContextBuilder
+from reranker import RERANKERS, make_reranker
 import json
-from llm import get_answer
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import llm
+from llm import book_context, count_tokens, get_answer, get_prompt
+from rate_limit import TokenBucket
+import numpy as np
 import pandas as pd
 from rouge_score import rouge_scorer
 
 
 DATABASE_URL = 'sqlite:///books_db.db'
+# fields of the predicted books written to the checkpoint, enough to score them with evaluate_contexts
+CHECKPOINT_FIELDS = ['id', 'title', 'author', 'genres', 'summary', 'pub_date', 'sims']
 
 
 def read_test_set(filepath: str) -> tuple[list[str], list[dict[str, str]], list[str]]:
@@ -30,24 +41,104 @@ def read_test_set(filepath: str) -> tuple[list[str], list[dict[str, str]], list[
     return queries, true_contexts, true_answers
 
 
-def run_pipeline(queries: list[str], book_df: pd.DataFrame) -> tuple[list[dict[str, str]], list[str]]:
+def read_checkpoint(path: str, queries: list[str], settings: dict) -> dict[int, dict]:
+    """Reads the predictions an earlier run wrote to a checkpoint file.
+
+    Args:
+        path (str): JSONL checkpoint written by run_pipeline
+        queries (list[str]): list of queries
+        settings (dict): settings of the current run
+
+    Returns:
+        dict[int, dict]: checkpointed records by query position; records of other queries or settings are left out,
+        as is a last line cut short by a crash
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            i = record['index']
+            if record['settings'] == settings and i < len(queries) and record['question'] == queries[i]:
+                records[i] = record
+    return records
+
+
+def run_pipeline(queries: list[str], book_df: pd.DataFrame, batch_size: int = 64, lexical=None,
+                 context_builder=None, reranker=None, candidates: int = 3, workers: int = 4,
+                 checkpoint: str | None = None) -> tuple[list[dict[str, str]], list[str], list[dict[str, float]]]:
     """Runs retrieval and generation pipeline on a set of queries.
 
+    Retrieval is batched, then the queries are reranked and answered by a pool of workers. With a checkpoint file,
+    each query's prediction is appended to it as soon as it is answered, and queries already in it are not run again,
+    so a run that stopped halfway can be resumed.
+
     Args:
         queries (list[str]): list of queries
         book_df (pd.DataFrame): dataframe containing book information
+        batch_size (int): number of queries retrieved together
+        lexical: optional BM25Index fused with the embedding search
+        context_builder: optional ContextBuilder fitting each book's context to a token budget
+        reranker: optional Reranker choosing among the retrieved books; without one the most similar book is used
+        candidates (int): number of books retrieved for the reranker
+        workers (int): number of queries reranked and answered at the same time, default 4
+        checkpoint (str): optional JSONL file the predictions are written to and resumed from
 
     Returns:
-        tuple[list[dict[str, str]], list[str]]: lists of predicted contexts and predicted answers
+        tuple[list[dict[str, str]], list[str], list[dict[str, float]]]: lists of predicted contexts,
+        predicted answers, and the prompt tokens, context tokens before fitting, seconds of each answer
+        and seconds of each rerank, all in the order of queries
     """
-    pred_contexts = []
-    pred_answers = []
-    for query in queries:
-        context = process_query_and_search(query, book_df)[0]
-        answer = get_answer(query, context)
-        pred_contexts.append(context)
-        pred_answers.append(answer)
-    return pred_contexts, pred_answers
+    settings = {'candidates': candidates if reranker is not None else 1,
+                'reranker': reranker.name if reranker is not None else None,
+                'lexical': [lexical.fingerprint, lexical.fusion, lexical.weight] if lexical is not None else None,
+                'context_tokens': context_builder.budget if context_builder is not None else None,
+                'prompt_version': llm.PROMPT_VERSION, 'model': llm.model}
+    records = read_checkpoint(checkpoint, queries, settings) if checkpoint else {}
+    pending = [i for i in range(len(queries)) if i not in records]
+    if records:
+        print(f"Resuming from {checkpoint}: {len(records)} of {len(queries)} queries already answered")
+    results = search_many([queries[i] for i in pending], book_df, k=settings['candidates'], batch_size=batch_size,
+                          lexical=lexical)
+    lock = threading.Lock()
+
+    def run(i: int, docs: list[dict]) -> dict:
+        query = queries[i]
+        start = time.perf_counter()
+        context = reranker.choose(query, docs) if reranker is not None else docs[0]
+        rerank_seconds = time.perf_counter() - start
+        full_tokens = count_tokens(book_context(context))
+        fitted = context_builder.fit(query, context) if context_builder is not None else context
+        start = time.perf_counter()
+        answer = get_answer(query, fitted)
+        usage = {'prompt_tokens': sum(count_tokens(message.content) for message in get_prompt(query, fitted)),
+                 'full_context_tokens': full_tokens,
+                 'seconds': time.perf_counter() - start,
+                 'rerank_seconds': rerank_seconds}
+        record = {'index': i, 'question': query, 'settings': settings, 'answer': answer, 'usage': usage,
+                  'context': {field: context.get(field) for field in CHECKPOINT_FIELDS}}
+        if checkpoint:
+            with lock, open(checkpoint, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        return record
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(run, i, docs) for i, docs in zip(pending, results)]
+        try:
+            for future in as_completed(futures):
+                record = future.result()
+                records[record['index']] = record
+        except BaseException:
+            # queries already running are finished and checkpointed, the others are dropped
+            pool.shutdown(cancel_futures=True)
+            raise
+    ordered = [records[i] for i in range(len(queries))]
+    return ([record['context'] for record in ordered], [record['answer'] for record in ordered],
+            [record['usage'] for record in ordered])
 
 
 def evaluate_contexts(true_contexts: list[dict[str, str]], pred_contexts: list[dict[str, str]]) -> float:
@@ -77,6 +168,77 @@ def evaluate_contexts(true_contexts: list[dict[str, str]], pred_contexts: list[d
     return sum(scores) / len(scores)
 
 
+def retrieval_ranks(true_ids: np.ndarray, retrieved_ids: list[np.ndarray]) -> np.ndarray:
+    """Finds where the right book of each query was ranked.
+
+    Args:
+        true_ids (np.ndarray): id of the right book of each query
+        retrieved_ids (list[np.ndarray]): ids of the books retrieved for each query, from most to least similar
+
+    Returns:
+        np.ndarray: rank of the right book of each query, from 1, or 0 if it was not retrieved
+    """
+    ranks = np.zeros(len(true_ids), dtype=int)
+    for i, (true_id, ids) in enumerate(zip(true_ids, retrieved_ids)):
+        found = np.flatnonzero(ids == true_id)
+        if len(found):
+            ranks[i] = found[0] + 1
+    return ranks
+
+
+def retrieval_metrics(ranks: np.ndarray, ks: list[int]) -> dict[str, float]:
+    """Computes recall@k and mean reciprocal rank from retrieval_ranks.
+
+    Args:
+        ranks (np.ndarray): rank of the right book of each query, 0 if it was not retrieved
+        ks (list[int]): cutoffs of the recall, at most the number of books retrieved per query
+
+    Returns:
+        dict[str, float]: share of queries whose book was among the first k for each k, and the mean reciprocal rank
+        (counting books that were not retrieved as 0)
+    """
+    metrics = {f'recall@{k}': float(np.mean((ranks > 0) & (ranks <= k))) for k in ks}
+    metrics['mrr'] = float(np.mean(np.where(ranks > 0, 1 / np.maximum(ranks, 1), 0.0)))
+    return metrics
+
+
+def evaluate_retrieval(queries: list[str], true_contexts: list[dict[str, str]], book_df: pd.DataFrame,
+                       ks: tuple[int, ...] = (1, 3, 10), batch_size: int = 64, lexical=None,
+                       misses_path: str | None = None) -> dict[str, float]:
+    """Evaluates the retrieval step alone, without calling Mistral.
+
+    All queries are encoded in batches and ranked against the whole corpus once, retrieving max(ks) books each.
+
+    Args:
+        queries (list[str]): list of queries
+        true_contexts (list[dict[str, str]]): list of ground truth contexts for each query
+        book_df (pd.DataFrame): dataframe containing book information
+        ks (tuple[int, ...]): cutoffs of the recall
+        batch_size (int): number of queries retrieved together
+        lexical: optional BM25Index fused with the embedding search
+        misses_path (str): optional JSONL file listing every query whose book was not ranked first
+
+    Returns:
+        dict[str, float]: recall@k for each k, mean reciprocal rank, and the evaluate_contexts score of the first books
+    """
+    rows, scores = search_rows_many(queries, book_df, k=max(ks), batch_size=batch_size, lexical=lexical)
+    # the ranks only need the ids, so books are not turned into dictionaries one query at a time
+    ids, titles = book_df['id'].to_numpy(), book_df['title'].to_numpy()
+    ranks = retrieval_ranks(np.array([true['id'] for true in true_contexts]), [ids[query_rows] for query_rows in rows])
+    metrics = retrieval_metrics(ranks, ks)
+    first = np.array([query_rows[0] for query_rows in rows])
+    metrics['context_score'] = evaluate_contexts(true_contexts, book_df.iloc[first].to_dict('records'))
+    if misses_path:
+        with open(misses_path, 'w') as f:
+            for query, true, query_rows, query_scores, rank in zip(queries, true_contexts, rows, scores, ranks):
+                if rank != 1:
+                    retrieved = [{'id': int(ids[row]), 'title': titles[row], 'sims': round(float(score), 4)}
+                                 for row, score in zip(query_rows, query_scores)]
+                    f.write(json.dumps({'question': query, 'id': true['id'], 'title': true['title'],
+                                        'rank': int(rank) or None, 'retrieved': retrieved}) + '\n')
+    return metrics
+
+
 def evaluate_answers(queries: list[str], true_answers: list[str], pred_answers: list[str]) -> float:
     """Evaluates generation step of pipeline.
 
@@ -88,6 +250,9 @@ def evaluate_answers(queries: list[str], true_answers: list[str], pred_answers:
     Returns:
         float: score representing generation performance
     """
+    # falcon_evaluate imports torch and textstat, which takes seconds, so only generation runs import it
+    from falcon_evaluate.evaluate import FalconEvaluator
+    from falcon_evaluate.utils import MetricsAggregator
     df = pd.DataFrame({'prompt': queries,
                        'reference': true_answers,
                        'Mistral': pred_answers})
@@ -105,16 +270,75 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--filepath',
                         help='the file containing the test set',
                         default='test_questions.jsonl')
+    parser.add_argument('-b', '--batch-size',
+                        help='the number of queries to encode and retrieve together',
+                        type=int, default=64)
+    parser.add_argument('--bm25',
+                        help='path of a BM25 index (built there if missing) to fuse with the embedding search, '
+                             'e.g. books_db.bm25.npz')
+    parser.add_argument('--fusion', choices=['rrf', 'weighted'], default='rrf',
+                        help='how the BM25 and embedding results are combined')
+    parser.add_argument('--reranker', choices=list(RERANKERS),
+                        help='choose among the retrieved books with this reranker instead of taking the most similar')
+    parser.add_argument('--candidates', type=int, default=3, help='number of books retrieved for the reranker')
+    parser.add_argument('--context-tokens', type=int,
+                        help='fit the context of each book to this many tokens, to compare the answers, '
+                             'prompt sizes and latency with those of the full contexts')
+    parser.add_argument('--retrieval-only', action='store_true',
+                        help='only evaluate the retrieval, with recall@k and MRR, without calling Mistral')
+    parser.add_argument('--recall-at', type=int, nargs='+', default=[1, 3, 10],
+                        help='cutoffs of the recall in --retrieval-only mode')
+    parser.add_argument('--misses', default='retrieval_misses.jsonl',
+                        help='JSONL file listing the questions whose book was not ranked first, '
+                             'in --retrieval-only mode')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='number of queries reranked and answered at the same time')
+    parser.add_argument('--rate', type=float,
+                        help='most Mistral requests per second, e.g. 1 for the free tier (default: BRAG_LLM_RATE)')
+    parser.add_argument('--retries', type=int,
+                        help='times a failed Mistral request is retried with backoff (default: BRAG_LLM_RETRIES)')
+    parser.add_argument('--checkpoint',
+                        help='JSONL file each prediction is written to as it completes; '
+                             'rerunning with the same file resumes where the last run stopped')
     args = parser.parse_args()
+    if args.rate:
+        llm.rate_limiter = TokenBucket(args.rate)
+    if args.retries is not None:
+        llm.retries = args.retries
 
     db = make_book_db(DATABASE_URL)
     book_df = make_book_df(db)
+    lexical = None
+    if args.bm25:
+        lexical = load_or_build_bm25(args.bm25, book_df)
+        lexical.fusion = args.fusion
 
     queries, true_contexts, true_answers = read_test_set(args.filepath)
-    pred_contexts, pred_answers = run_pipeline(queries, book_df)
+    if args.retrieval_only:
+        start = time.perf_counter()
+        metrics = evaluate_retrieval(queries, true_contexts, book_df, args.recall_at, args.batch_size, lexical,
+                                     args.misses)
+        print(f"{len(queries)} questions retrieved in {time.perf_counter() - start:.1f} s")
+        for name, value in metrics.items():
+            print(f"{name}: {value:.4f}")
+        print(f"Questions whose book was not ranked first are listed in {args.misses}")
+        sys.exit()
+
+    context_builder = ContextBuilder(args.context_tokens) if args.context_tokens else None
+    reranker = make_reranker(args.reranker) if args.reranker else None
+    pred_contexts, pred_answers, usage = run_pipeline(queries, book_df, args.batch_size, lexical, context_builder,
+                                                      reranker, args.candidates, args.workers, args.checkpoint)
 
     context_score = evaluate_contexts(true_contexts, pred_contexts)
     answer_score = evaluate_answers(queries, true_answers, pred_answers)
 
     print("Retrieval performance: " + str(context_score))
     print("Generation performance: " + str(answer_score))
+    usage = pd.DataFrame(usage)
+    print(f"Prompt tokens per question: {usage['prompt_tokens'].mean():.0f} "
+          f"(book contexts of {usage['full_context_tokens'].mean():.0f} tokens before fitting)")
+    print(f"Answer latency: p50 {usage['seconds'].median():.2f} s, mean {usage['seconds'].mean():.2f} s")
+    if reranker is not None:
+        print(f"Rerank latency ({reranker.name}, {args.candidates} books): "
+              f"p50 {usage['rerank_seconds'].median() * 1000:.0f} ms, "
+              f"mean {usage['rerank_seconds'].mean() * 1000:.0f} ms")
@@ -1,6 +1,27 @@
+import json
+import os
+import tempfile
+import time
 import unittest
 import warnings
-from evaluate import evaluate_contexts, evaluate_answers
+from unittest import mock
+import numpy as np
+import pandas as pd
+from evaluate import evaluate_contexts, evaluate_answers, evaluate_retrieval, retrieval_metrics, retrieval_ranks, \
+    run_pipeline
+
+BOOKS = {f'Question {i}?': [{'id': i, 'title': f'Book {i}', 'author': None, 'genres': None, 'pub_date': None,
+                             'summary': f'Summary {i}.', 'sims': 0.5}] for i in range(8)}
+
+
+def fake_search(queries, book_df, k=1, batch_size=64, lexical=None):
+    return [BOOKS[query] for query in queries]
+
+
+def slow_answer(question, context):
+    # later questions finish first
+    time.sleep(0.01 * (8 - context['id']))
+    return f"Answer from {context['title']}"
 
 
 class TestEvaluateContext(unittest.TestCase):
@@ -103,6 +124,83 @@ class TestEvaluateContext(unittest.TestCase):
         self.assertEqual(0.25, score)
 
 
+class TestEvaluateRetrieval(unittest.TestCase):
+    def test_ranks_and_metrics(self):
+        ranks = retrieval_ranks(np.array([1, 2, 3, 4]),
+                                [np.array([1, 5, 6]), np.array([5, 2, 6]), np.array([5, 6, 3]), np.array([5, 6, 7])])
+        self.assertEqual(ranks.tolist(), [1, 2, 3, 0])
+        metrics = retrieval_metrics(ranks, [1, 3])
+        self.assertEqual((metrics['recall@1'], metrics['recall@3']), (0.25, 0.75))
+        self.assertAlmostEqual(metrics['mrr'], (1 + 1 / 2 + 1 / 3) / 4)
+
+    def test_evaluate_retrieval(self):
+        books = pd.DataFrame([record for docs in BOOKS.values() for record in docs])
+        queries = list(BOOKS)[:3]
+        true_contexts = [BOOKS[query][0] for query in queries]
+        # the second query ranks its book third, the third query does not find it
+        rows = [np.array([0, 4, 5]), np.array([4, 5, 1]), np.array([6, 7, 4])]
+        with mock.patch('evaluate.search_rows_many', return_value=(rows, [np.ones(3)] * 3)), \
+                tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'misses.jsonl')
+            metrics = evaluate_retrieval(queries, true_contexts, books, (1, 3), misses_path=path)
+            with open(path) as f:
+                misses = [json.loads(line) for line in f]
+        self.assertEqual((metrics['recall@1'], metrics['recall@3']), (1 / 3, 2 / 3))
+        self.assertEqual([(miss['id'], miss['rank']) for miss in misses], [(1, 3), (2, None)])
+        self.assertEqual([book['title'] for book in misses[1]['retrieved']], ['Book 6', 'Book 7', 'Book 4'])
+        self.assertLess(metrics['context_score'], 1)
+
+
+@mock.patch('evaluate.search_many', fake_search)
+class TestRunPipeline(unittest.TestCase):
+    def test_results_in_input_order(self):
+        queries = list(BOOKS)
+        with mock.patch('evaluate.get_answer', slow_answer):
+            contexts, answers, usage = run_pipeline(queries, None, workers=4)
+        self.assertEqual([context['title'] for context in contexts], [f'Book {i}' for i in range(8)])
+        self.assertEqual(answers, [f'Answer from Book {i}' for i in range(8)])
+        self.assertEqual(len(usage), 8)
+
+    def test_resume_from_checkpoint(self):
+        queries = list(BOOKS)
+
+        def failing_answer(question, context):
+            if context['id'] == 5:
+                raise ConnectionError("Mistral is down")
+            return f"Answer from {context['title']}"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'predictions.jsonl')
+            with mock.patch('evaluate.get_answer', failing_answer), self.assertRaises(ConnectionError):
+                run_pipeline(queries, None, workers=1, checkpoint=path)
+            with open(path) as f:
+                done = [json.loads(line)['index'] for line in f]
+            # the query after the failed one may have started before the run stopped
+            self.assertEqual(done[:5], [0, 1, 2, 3, 4])
+            self.assertNotIn(5, done)
+            # a crash can leave half a line
+            with open(path, 'a') as f:
+                f.write('{"index": 5, "quest')
+            answered = []
+
+            def answer(question, context):
+                answered.append(question)
+                return f"Answer from {context['title']}"
+
+            with mock.patch('evaluate.get_answer', answer):
+                contexts, answers, _ = run_pipeline(queries, None, workers=4, checkpoint=path)
+            self.assertEqual(sorted(answered), sorted(query for i, query in enumerate(queries) if i not in done))
+            self.assertEqual(answers, [f'Answer from Book {i}' for i in range(8)])
+            self.assertEqual(contexts[0], BOOKS[queries[0]][0])
+            # a run with other settings starts over
+            answered.clear()
+            reranker = mock.Mock(choose=lambda query, docs: docs[0])
+            reranker.name = 'cross-encoder'
+            with mock.patch('evaluate.get_answer', answer):
+                run_pipeline(queries[:3], None, checkpoint=path, reranker=reranker, candidates=3)
+            self.assertEqual(sorted(answered), queries[:3])
+
+
 class TestEvaluateAnswer(unittest.TestCase):
     @classmethod
     def setUpClass(self):
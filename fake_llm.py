@@ -0,0 +1,125 @@
+""" Offline stand-in for the Mistral client, for load tests and tests that must not use the network"""
+
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from mistralai.exceptions import MistralAPIStatusException, MistralException
+
+# the question llm.choose_best_book asks, and how many contexts it offers
+CHOICE_QUESTION = re.compile(r"which context \(1 to (\d+)\)")
+# the book context in a prompt made by llm.get_prompt
+ANSWER_CONTEXT = re.compile(r"Context:\n(.*?)\n---\n", re.DOTALL)
+
+
+class FakeMistralClient:
+    """
+    Answers chat and chat_stream like mistralai's MistralClient, without a network.
+    Replies depend only on the messages: a choice between contexts names context 1 for a share agree of
+    the questions and another context for the rest, and an answer repeats the first sentence of its context.
+    Latencies are lognormal around the given medians, and a share error_rate of the calls fails with a
+    retryable status error, like a rate-limited or overloaded API.
+    """
+    def __init__(self, answer_ms: float = 400, rerank_ms: float = 300, sigma: float = 0.3,
+                 error_rate: float = 0.0, agree: float = 0.8, timeout: float | None = None, seed: int = 0,
+                 sleep=time.sleep):
+        """
+        Args:
+            answer_ms (float): median latency of an answer, in milliseconds
+            rerank_ms (float): median latency of a choice between contexts, in milliseconds
+            sigma (float): standard deviation of the logarithm of the latencies, 0 for fixed latencies
+            error_rate (float): share of the calls that fail with a 429 or 503 status
+            agree (float): share of the questions for which context 1, the most similar book, is chosen
+            timeout (float): seconds after which a call fails like a timed out request, None for no limit
+            seed (int): random seed of the latencies and errors
+            sleep: function waiting a number of seconds
+        """
+        self.answer_ms = answer_ms
+        self.rerank_ms = rerank_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.agree = agree
+        self.timeout = timeout
+        self.sleep = sleep
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    @classmethod
+    def from_env(cls, timeout: float | None = None) -> "FakeMistralClient":
+        """
+        Creates a client configured by BRAG_FAKE_LLM_ANSWER_MS, BRAG_FAKE_LLM_RERANK_MS, BRAG_FAKE_LLM_SIGMA,
+        BRAG_FAKE_LLM_ERROR_RATE, BRAG_FAKE_LLM_AGREE and BRAG_FAKE_LLM_SEED.
+        """
+        return cls(answer_ms=float(os.environ.get("BRAG_FAKE_LLM_ANSWER_MS", 400)),
+                   rerank_ms=float(os.environ.get("BRAG_FAKE_LLM_RERANK_MS", 300)),
+                   sigma=float(os.environ.get("BRAG_FAKE_LLM_SIGMA", 0.3)),
+                   error_rate=float(os.environ.get("BRAG_FAKE_LLM_ERROR_RATE", 0)),
+                   agree=float(os.environ.get("BRAG_FAKE_LLM_AGREE", 0.8)),
+                   timeout=timeout, seed=int(os.environ.get("BRAG_FAKE_LLM_SEED", 0)))
+
+    def reply(self, messages: list) -> str:
+        """
+        Returns the reply to a conversation, which depends only on its last message.
+        """
+        prompt = messages[-1].content
+        choice = CHOICE_QUESTION.search(prompt)
+        if choice:
+            n_contexts = int(choice[1])
+            question = prompt[choice.end():]
+            # a fixed fraction of every question's checksum range picks the first context
+            draw = zlib.crc32(question.encode()) / 2 ** 32
+            if draw < self.agree or n_contexts == 1:
+                return "Context 1"
+            return f"Context {2 + int((draw - self.agree) / (1 - self.agree) * (n_contexts - 1))}"
+        context = ANSWER_CONTEXT.search(prompt)
+        if context:
+            first_sentence = re.split(r"(?<=[.!?])\s", context[1].strip(), maxsplit=1)[0]
+            return f"According to the context, {first_sentence}"
+        return "This is a placeholder reply from the fake Mistral backend."
+
+    def wait(self, messages: list) -> float:
+        """
+        Samples the latency of a call, sleeps it, and raises the error the call fails with, if any.
+        Returns:
+            Seconds slept
+        """
+        median_ms = self.rerank_ms if CHOICE_QUESTION.search(messages[-1].content) else self.answer_ms
+        with self.lock:
+            self.calls += 1
+            seconds = median_ms / 1000 * self.rng.lognormvariate(0, self.sigma) if self.sigma else median_ms / 1000
+            failed = self.rng.random() < self.error_rate
+            status = self.rng.choice([429, 503])
+            self.errors += failed
+        if self.timeout is not None and seconds > self.timeout:
+            self.sleep(self.timeout)
+            raise MistralException("Unexpected exception (ReadTimeout): the fake request timed out")
+        if failed:
+            # an overloaded API answers errors sooner than replies
+            self.sleep(seconds / 10)
+            raise MistralAPIStatusException(f"Status: {status}. Message: fake error", status)
+        return seconds
+
+    def chat(self, model: str, messages: list, **params) -> SimpleNamespace:
+        self.sleep(self.wait(messages))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(role='assistant',
+                                                                               content=self.reply(messages)))],
+                               model=model)
+
+    def chat_stream(self, model: str, messages: list, **params):
+        seconds = self.wait(messages)
+        words = self.reply(messages).split(" ")
+        for i, word in enumerate(words):
+            # the latency is spread over the words, as tokens are generated one after the other
+            self.sleep(seconds / len(words))
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word if i == 0
+                                                                                 else " " + word))],
+                                  model=model)
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {'calls': self.calls, 'errors': self.errors}
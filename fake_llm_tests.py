@@ -0,0 +1,64 @@
+import unittest
+from unittest import mock
+from mistralai.exceptions import MistralAPIStatusException, MistralException
+import llm
+from fake_llm import FakeMistralClient
+from llm import choose_best_book, get_answer, get_prompt, stream_answer
+
+BOOKS = [{'id': i, 'title': title, 'context': context} for i, (title, context) in enumerate([
+    ('Dune', 'Dune was written by Frank Herbert. Paul Atreides leads the Fremen.'),
+    ('The Hobbit', 'The Hobbit was written by J. R. R. Tolkien. Bilbo fights a dragon.'),
+    ('Fool Moon', 'Fool Moon was written by Jim Butcher. Harry Dresden hunts werewolves.')])]
+
+
+def fake_client(**options):
+    return FakeMistralClient(**{'answer_ms': 0, 'rerank_ms': 0, 'sigma': 0, **options}, sleep=lambda seconds: None)
+
+
+class TestFakeMistralClient(unittest.TestCase):
+    def test_answer_is_deterministic(self):
+        with mock.patch('llm._client', fake_client()), mock.patch('llm.chat_cache', None):
+            answer = get_answer('Who leads the Fremen?', BOOKS[0])
+            self.assertEqual(answer, 'According to the context, Dune was written by Frank Herbert.')
+            self.assertEqual(get_answer('Who leads the Fremen?', BOOKS[0]), answer)
+            self.assertEqual(''.join(stream_answer('Who leads the Fremen?', BOOKS[0])), answer)
+
+    def test_choice_share(self):
+        questions = [f'Question number {i}?' for i in range(1000)]
+        with mock.patch('llm._client', fake_client(agree=0.8)), mock.patch('llm.chat_cache', None):
+            chosen = [choose_best_book(question, BOOKS)['id'] for question in questions]
+            self.assertEqual(chosen[:50], [choose_best_book(question, BOOKS)['id'] for question in questions[:50]])
+        self.assertAlmostEqual(chosen.count(0) / len(chosen), 0.8, delta=0.05)
+        self.assertEqual(set(chosen), {0, 1, 2})
+        with mock.patch('llm._client', fake_client(agree=1.0)), mock.patch('llm.chat_cache', None):
+            self.assertEqual({choose_best_book(question, BOOKS)['id'] for question in questions[:50]}, {0})
+
+    def test_errors_are_retried(self):
+        client = fake_client(error_rate=1.0)
+        with self.assertRaises(MistralAPIStatusException):
+            client.chat(llm.model, get_prompt('Who?', BOOKS[0]))
+        client.error_rate = 0.5
+        with mock.patch('llm._client', client), mock.patch('llm.chat_cache', None), \
+                mock.patch('llm.retries', 10), mock.patch('rate_limit.backoff_delay', return_value=0), \
+                self.assertLogs('llm', 'WARNING'):
+            for i in range(20):
+                get_answer(f'Question {i}?', BOOKS[0])
+        self.assertGreater(client.stats()['errors'], 1)
+
+    def test_latency_and_timeout(self):
+        slept = []
+        client = FakeMistralClient(answer_ms=400, rerank_ms=100, sigma=0, sleep=slept.append)
+        client.chat(llm.model, get_prompt('Who?', BOOKS[0]))
+        self.assertEqual(slept, [0.4])
+        client.timeout = 0.2
+        with self.assertRaises(MistralException):
+            client.chat(llm.model, get_prompt('Who?', BOOKS[0]))
+        self.assertEqual(slept[-1], 0.2)
+
+    def test_backend_setting(self):
+        with mock.patch('llm._client', None), mock.patch('llm.backend', 'fake'):
+            self.assertIsInstance(llm.get_client(), FakeMistralClient)
+
+
+if __name__ == '__main__':
+    unittest.main()
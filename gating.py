@@ -0,0 +1,141 @@
+""" Decides when retrieval is confident enough to skip asking the LLM to choose between the retrieved books"""
+
+import threading
+from argparse import ArgumentParser
+import numpy as np
+
+
+class ConfidenceGate:
+    """
+    Skips the rerank step when the best retrieved book scores at least threshold
+    and beats the second best by at least margin. A criterion set to None is not checked,
+    and a gate with neither criterion never skips.
+    The gate also keeps a running average of the rerank latency to estimate the time saved by skipping.
+    """
+    def __init__(self, threshold: float | None = None, margin: float | None = None):
+        """
+        Args:
+            threshold (float): minimum cosine similarity of the best book
+            margin (float): minimum difference between the cosine similarities of the best and second best books
+        """
+        self.threshold = threshold
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.skipped = 0
+        self.reranked = 0
+        self.rerank_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold is not None or self.margin is not None
+
+    def is_confident(self, docs: list[dict]) -> bool:
+        """
+        Checks the similarity scores ('sims') of retrieved books, ordered from most to least similar.
+        """
+        if not self.enabled or not docs:
+            return False
+        top = docs[0]['sims']
+        second = docs[1]['sims'] if len(docs) > 1 else -1.0
+        if self.threshold is not None and top < self.threshold:
+            return False
+        return self.margin is None or top - second >= self.margin
+
+    def record_rerank(self, seconds: float) -> None:
+        with self.lock:
+            self.reranked += 1
+            self.rerank_seconds += seconds
+
+    def record_skip(self) -> float:
+        """
+        Counts a skipped rerank and returns the time it is estimated to have saved, in seconds.
+        """
+        with self.lock:
+            self.skipped += 1
+            saved = self.rerank_seconds / self.reranked if self.reranked else 0.0
+            self.saved_seconds += saved
+            return saved
+
+    def stats(self) -> dict[str, float]:
+        return {'skipped': self.skipped, 'reranked': self.reranked, 'saved_seconds': self.saved_seconds}
+
+
+def calibrate(top_scores: np.ndarray, margins: np.ndarray, correct: np.ndarray,
+              min_precision: float = 1.0) -> tuple[float | None, float | None, int]:
+    """
+    Finds the threshold and margin that skip the most reranks while keeping the top-1 accuracy
+    of the skipped queries at or above min_precision. Among equally good settings the strictest one is kept.
+    Args:
+        top_scores (numpy array): cosine similarity of the best retrieved book for each query
+        margins (numpy array): difference between the best and second best similarity for each query
+        correct (numpy array): whether the best retrieved book was the right one for each query
+        min_precision (float): required fraction of skipped queries whose best retrieved book was right
+
+    Returns:
+        Threshold, margin and number of skipped queries; threshold and margin are None if nothing can be skipped
+    """
+    top_scores = np.asarray(top_scores)
+    # queries from the largest margin to the smallest; the queries skipped for a margin are a prefix of this order
+    order = np.argsort(-np.asarray(margins), kind='stable')
+    margins, top_scores = np.asarray(margins)[order], top_scores[order]
+    # a setting is precise enough when the skipped queries' weights (1 - min_precision if correct,
+    # -min_precision if not) sum to at least 0
+    weights = np.asarray(correct, dtype=np.float64)[order] - min_precision
+    # a margin includes every query with that margin, so prefixes can only end with the last of them
+    group_ends = np.append(margins[1:] != margins[:-1], True)
+    best = (None, None, 0)
+    # the first threshold to skip n queries is the highest, which is less likely to skip a wrong book
+    for threshold in np.unique(top_scores)[::-1]:
+        skipped = top_scores >= threshold
+        counts = np.cumsum(skipped)
+        precise = group_ends & (np.cumsum(np.where(skipped, weights, 0.0)) >= -1e-9) & (counts > best[2])
+        if precise.any():
+            # of the prefixes skipping the most queries, the first has the highest margin
+            end = np.flatnonzero(precise & (counts == counts[precise].max()))[0]
+            best = (float(threshold), float(margins[end]), int(counts[end]))
+    return best
+
+
+if __name__ == '__main__':
+    import os
+    from alchemy_database import make_book_db, make_book_df, search_many
+    from bm25_index import load_or_build_bm25
+    from evaluate import read_test_set
+
+    parser = ArgumentParser()
+    parser.add_argument('-f', '--filepath', default='test_data/test_questions.jsonl',
+                        help='the file containing the test set')
+    parser.add_argument('--db-url', default='sqlite:///books_db.db', help='url of the database')
+    parser.add_argument('-p', '--min-precision', type=float, default=1.0,
+                        help='required top-1 accuracy of the questions whose rerank is skipped')
+    parser.add_argument('-k', type=int, default=int(os.environ.get('BRAG_RERANK_CANDIDATES', 3)),
+                        help='number of books retrieved per question, as BRAG_RERANK_CANDIDATES')
+    # the gate sees the books in the order the server retrieves them, so calibrate it on the same retrieval
+    parser.add_argument('--bm25', default=os.environ.get('BRAG_BM25_INDEX'),
+                        help='BM25 index fused with the embedding search, as BRAG_BM25_INDEX')
+    parser.add_argument('--fusion', choices=['rrf', 'weighted'], default=os.environ.get('BRAG_HYBRID_FUSION', 'rrf'),
+                        help='fusion of the BM25 and embedding searches, as BRAG_HYBRID_FUSION')
+    parser.add_argument('--weight', type=float, default=float(os.environ.get('BRAG_HYBRID_WEIGHT', 0.5)),
+                        help='share of the cosine similarity in the weighted fusion, as BRAG_HYBRID_WEIGHT')
+    args = parser.parse_args()
+
+    book_df = make_book_df(make_book_db(args.db_url))
+    lexical = None
+    if args.bm25:
+        lexical = load_or_build_bm25(args.bm25, book_df)
+        lexical.fusion, lexical.weight = args.fusion, args.weight
+    queries, true_contexts, _ = read_test_set(args.filepath)
+    results = search_many(queries, book_df, k=args.k, lexical=lexical)
+    top_scores = np.array([docs[0]['sims'] for docs in results])
+    # as in ConfidenceGate.is_confident, a lone book leads a missing second one by its similarity + 1
+    margins = np.array([docs[0]['sims'] - (docs[1]['sims'] if len(docs) > 1 else -1.0) for docs in results])
+    correct = np.array([docs[0]['title'] == true['title'] for docs, true in zip(results, true_contexts)])
+    threshold, margin, n_skipped = calibrate(top_scores, margins, correct, args.min_precision)
+
+    print(f"Top-1 retrieval accuracy: {correct.mean():.3f} on {len(queries)} questions")
+    if threshold is None:
+        print(f"No setting keeps the accuracy of skipped questions at {args.min_precision}, leave the gate off")
+    else:
+        print(f"Skips {n_skipped}/{len(queries)} reranks with")
+        print(f"BRAG_GATE_THRESHOLD={threshold} BRAG_GATE_MARGIN={margin}")
@@ -0,0 +1,72 @@
+import unittest
+import numpy as np
+from gating import ConfidenceGate, calibrate
+
+
+def docs(*scores):
+    return [{'title': f'Book {i}', 'sims': score} for i, score in enumerate(scores)]
+
+
+class TestConfidenceGate(unittest.TestCase):
+    def test_disabled_never_skips(self):
+        gate = ConfidenceGate()
+        self.assertFalse(gate.enabled)
+        self.assertFalse(gate.is_confident(docs(0.99, 0.1, 0.0)))
+
+    def test_threshold_and_margin(self):
+        gate = ConfidenceGate(threshold=0.5, margin=0.1)
+        self.assertTrue(gate.is_confident(docs(0.7, 0.55, 0.2)))
+        self.assertFalse(gate.is_confident(docs(0.7, 0.65, 0.2)))
+        self.assertFalse(gate.is_confident(docs(0.45, 0.1, 0.0)))
+
+    def test_margin_only(self):
+        gate = ConfidenceGate(margin=0.1)
+        self.assertTrue(gate.is_confident(docs(0.3, 0.1)))
+        self.assertTrue(gate.is_confident(docs(0.3)))
+
+    def test_saved_time(self):
+        gate = ConfidenceGate(margin=0.1)
+        gate.record_rerank(0.4)
+        gate.record_rerank(0.6)
+        self.assertAlmostEqual(gate.record_skip(), 0.5)
+        self.assertEqual(gate.stats(), {'skipped': 1, 'reranked': 2, 'saved_seconds': 0.5})
+
+
+class TestCalibrate(unittest.TestCase):
+    def test_skips_only_correct_queries(self):
+        top_scores = np.array([0.9, 0.8, 0.7, 0.6, 0.5])
+        margins = np.array([0.3, 0.05, 0.2, 0.25, 0.1])
+        correct = np.array([True, False, True, True, False])
+        threshold, margin, n_skipped = calibrate(top_scores, margins, correct)
+        self.assertEqual(n_skipped, 3)
+        self.assertEqual((threshold, margin), (0.6, 0.2))
+
+    def test_min_precision(self):
+        top_scores = np.array([0.9, 0.8, 0.7])
+        margins = np.array([0.3, 0.3, 0.3])
+        correct = np.array([True, False, True])
+        self.assertEqual(calibrate(top_scores, margins, correct)[2], 1)
+        self.assertEqual(calibrate(top_scores, margins, correct, min_precision=0.6)[2], 3)
+
+    def test_same_as_every_setting(self):
+        rng = np.random.default_rng(0)
+        for min_precision in (1.0, 0.9, 0.75):
+            top_scores = rng.integers(0, 20, 300) / 20
+            margins = rng.integers(0, 10, 300) / 20
+            correct = rng.random(300) < 0.5 + top_scores / 2
+            expected = (None, None, 0)
+            for threshold in np.unique(top_scores):
+                for margin in np.unique(margins):
+                    skipped = (top_scores >= threshold) & (margins >= margin)
+                    if skipped.any() and correct[skipped].mean() >= min_precision and (
+                            skipped.sum() > expected[2] or (skipped.sum() == expected[2]
+                                                            and (threshold, margin) >= expected[:2])):
+                        expected = (float(threshold), float(margin), int(skipped.sum()))
+            self.assertEqual(calibrate(top_scores, margins, correct, min_precision), expected)
+
+    def test_nothing_to_skip(self):
+        self.assertEqual(calibrate(np.array([0.9]), np.array([0.3]), np.array([False])), (None, None, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,157 @@
-from mistralai.client import MistralClient
+import logging
+import os
+import re
+import threading
+from collections.abc import Iterator
+from mistralai.exceptions import MistralAPIException, MistralAPIStatusException, MistralException
 from mistralai.models.chat_completion import ChatMessage
 from string import Template
-from llm_secret import key
 from utils import dict_to_commas
+from cache import chat_cache_from_env
+from rate_limit import TokenBucket, call_with_retries
 
-api_key = key
 model = "open-mistral-7b"
+# bump whenever a prompt in this module changes, so that cached answers from the old prompts are not reused
+PROMPT_VERSION = 2
+# bump whenever create_template_string changes, so that contexts stored with the books are rebuilt
+TEMPLATE_VERSION = 1
+# subword tokenizers split long words into several tokens, roughly one per four characters
+TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+ORDINALS = ["first", "second", "third", "fourth", "fifth", "sixth", "seventh", "eighth", "ninth", "tenth"]
+# the context a reply to choose_best_book names, as a number or an ordinal
+CHOICE_PATTERN = re.compile(r"\b(\d+|" + "|".join(ORDINALS) + r")\b", re.IGNORECASE)
 
-client = MistralClient(api_key=api_key)
+logger = logging.getLogger(__name__)
+
+# seconds before a request to the Mistral API is abandoned
+timeout = int(os.environ.get("BRAG_LLM_TIMEOUT", 30))
+# "mistral" for the Mistral API, "fake" for the offline stand-in of fake_llm.py
+backend = os.environ.get("BRAG_LLM_BACKEND", "mistral")
+# name the chat cache files replies under, so that replies of the fake backend are never taken for Mistral's
+cache_model = model if backend == "mistral" else f"{backend}/{model}"
+# times a request failing with a rate limit, server or network error is sent again, with exponential backoff
+retries = int(os.environ.get("BRAG_LLM_RETRIES", 2))
+# requests per second sent to Mistral by all the threads of the process, 0 for no limit
+_rate = float(os.environ.get("BRAG_LLM_RATE", 0))
+rate_limiter = TokenBucket(_rate, burst=int(os.environ.get("BRAG_LLM_BURST", 1))) if _rate > 0 else None
+
+_client = None
+_client_lock = threading.Lock()
+# optional on-disk cache of completions, see chat_cache_from_env
+chat_cache = chat_cache_from_env()
+
+
+def get_client():
+    """Returns the Mistral client, creating it on first use
+
+    The API key is read from `key` in llm_secret.py, or else from the MISTRAL_API_KEY environment variable,
+    so that code which never calls Mistral does not need either.
+    With BRAG_LLM_BACKEND=fake, the offline stand-in of fake_llm.py is used instead, e.g. for load tests.
+
+    Returns:
+        MistralClient: the client
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None and backend == "fake":
+                from fake_llm import FakeMistralClient
+                _client = FakeMistralClient.from_env(timeout=timeout)
+            elif _client is None:
+                from mistralai.client import MistralClient
+                try:
+                    from llm_secret import key
+                except ImportError:
+                    key = os.environ.get("MISTRAL_API_KEY")
+                # the client's own retries sleep up to a minute without jitter, chat retries instead
+                _client = MistralClient(api_key=key, timeout=timeout, max_retries=0)
+    return _client
+
+
+def __getattr__(name: str):
+    # keeps llm.client working without creating the client when the module is imported
+    if name == 'client':
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def retryable(error: Exception) -> bool:
+    """Tells whether a failed Mistral request may succeed if it is sent again
+
+    Rate limits (429), server errors (5xx), timeouts and connection errors are retried;
+    other API errors, such as an invalid key, are not.
+
+    Args:
+        error (Exception): what the client raised
+
+    Returns:
+        bool: whether to retry
+    """
+    if isinstance(error, MistralAPIStatusException):
+        return True
+    return isinstance(error, MistralException) and not isinstance(error, MistralAPIException)
+
+
+def log_retry(attempt: int, error: Exception, delay: float) -> None:
+    logger.warning("Mistral request failed (%r), retry %d of %d in %.1f s", error, attempt, retries, delay)
+
+
+def chat(messages: list[ChatMessage], **params) -> str:
+    """Gets Mistral's reply to a conversation, from the chat cache if it is enabled
+
+    Requests wait for rate_limiter if it is set, and failed requests are retried up to retries times.
+
+    Args:
+        messages (list[ChatMessage]): the conversation
+        params: sampling parameters for the chat endpoint, e.g. temperature
+
+    Returns:
+        str: content of Mistral's reply
+    """
+    def request() -> str:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        chat_response = get_client().chat(model=model, messages=messages, **params)
+        return chat_response.choices[0].message.content
+
+    def call() -> str:
+        return call_with_retries(request, retries, retryable, on_retry=log_retry)
+
+    if chat_cache is None:
+        return call()
+    key = chat_cache.key(cache_model, [(message.role, message.content) for message in messages], params)
+    return chat_cache.get_or_call(key, call)
+
+
+def chat_stream(messages: list[ChatMessage], **params) -> Iterator[str]:
+    """Streams Mistral's reply to a conversation as it is generated
+
+    Args:
+        messages (list[ChatMessage]): the conversation
+        params: sampling parameters for the chat endpoint, e.g. temperature
+
+    Returns:
+        Iterator[str]: pieces of Mistral's reply, in order; a cached reply comes as a single piece
+    """
+    # a stream is rate limited but not retried, since part of the reply may already have been sent
+    key = None
+    if chat_cache is not None:
+        key = chat_cache.key(cache_model, [(message.role, message.content) for message in messages], params)
+        cached = chat_cache.lookup(key)
+        if cached is not None:
+            yield cached
+            return
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+    parts = []
+    for chunk in get_client().chat_stream(model=model, messages=messages, **params):
+        content = chunk.choices[0].delta.content
+        if content:
+            parts.append(content)
+            yield content
+    # only complete replies are cached
+    if key is not None:
+        chat_cache.record(key, "".join(parts))
 
 
 def get_prompt(question: str, context: dict[str, str | dict[str, str]]) -> list[ChatMessage]:
@@ -22,7 +166,7 @@ def get_prompt(question: str, context: dict[str, str | dict[str, str]]) -> list[
     """
     instruction = """Answer only the question asked; the response should be concise and relevant to the question."""
 
-    prompt = ("""Context:\n""" + create_template_string(context) +
+    prompt = ("""Context:\n""" + book_context(context) +
               f"""\n---\nNow here is the question you need to answer.\nQuestion: {question}""")
 
     message = [ChatMessage(role='system', content=instruction), ChatMessage(role='user', content=prompt)]
@@ -58,6 +202,32 @@ def create_template_string(context: dict) -> str:
     return prompt_template.substitute(values)
 
 
+def book_context(context: dict) -> str:
+    """Gets the text describing a book, using the copy stored with the book if there is one
+
+    Args:
+        context (dict): book information, optionally with its rendered 'context'
+
+    Returns:
+        str: output of create_template_string for the book
+    """
+    return context.get('context') or create_template_string(context)
+
+
+def count_tokens(text: str) -> int:
+    """Estimates the number of tokens Mistral's tokenizer splits a text into
+
+    Every run of up to four letters or digits and every punctuation mark counts as one token.
+
+    Args:
+        text (str): the text
+
+    Returns:
+        int: estimated number of tokens
+    """
+    return len(TOKEN_PATTERN.findall(text))
+
+
 def get_answer(question: str, context: dict[str, str | dict[str, str]]) -> str:
     """Gets Mistral output
 
@@ -69,47 +239,69 @@ def get_answer(question: str, context: dict[str, str | dict[str, str]]) -> str:
         str: Mistral output
     """
     message = get_prompt(question, context)
-    chat_response = client.chat(
-        model=model,
-        messages=message,
-    )
-    return chat_response.choices[0].message.content
+    return chat(message)
+
+
+def stream_answer(question: str, context: dict[str, str | dict[str, str]]) -> Iterator[str]:
+    """Streams Mistral output
+
+    Args:
+        question (str): user's question
+        context (dict[str, str | dict[str, str]]): context related to question extracted from database
+
+    Returns:
+        Iterator[str]: pieces of Mistral output, in order
+    """
+    return chat_stream(get_prompt(question, context))
+
+
+def parse_choice(reply: str, n_contexts: int) -> int | None:
+    """Finds the context a reply to choose_best_book names
+
+    The first number or ordinal ("2", "Context 2", "the second") within range counts.
+
+    Args:
+        reply (str): Mistral's reply
+        n_contexts (int): number of contexts Mistral chose from
+
+    Returns:
+        int | None: position of the chosen context, or None if the reply names none
+    """
+    for match in CHOICE_PATTERN.finditer(reply):
+        word = match[1].lower()
+        number = int(word) if word.isdigit() else ORDINALS.index(word) + 1
+        if 1 <= number <= n_contexts:
+            return number - 1
+    return None
 
 
 def choose_best_book(question: str, contexts: list[dict[str, str]]) -> dict[str, str | dict]:
     """
-    Asks Mistral to choose the best book data out of the three returned by the retrieval system.
+    Asks Mistral to choose the best book data out of those returned by the retrieval system.
+    If the reply names no context, the first one is chosen and a warning is logged.
 
     Args:
         question (str) : The question posed by the user
-        contexts (list[dict]) : The book data retrieved, len == 3
+        contexts (list[dict]) : The book data retrieved, from most to least similar
 
     Returns:
         The context dictionary representing the most salient book
     """
+    if len(contexts) == 1:
+        return contexts[0]
     instruction = "Answer only the question asked; the response should be concise and relevant to the question."
     prompt = ""
     for i, context in enumerate(contexts):
-        if i == 0:
-            prompt += "First Context:\n"
-        elif i == 1:
-            prompt += "Second Context:\n"
-        elif i == 2:
-            prompt += "Third Context:\n"
-        prompt += create_template_string(context)
+        prompt += f"Context {i + 1}:\n"
+        prompt += book_context(context)
         prompt += "\n---------\n"
-    prompt += f"""Based on these three contexts, which context (first, second, or third) most correctly answers the following question? 
+    prompt += f"""Based on these {len(contexts)} contexts, which context (1 to {len(contexts)}) most correctly answers the following question? Reply with the number of the context only.
 Question: {question}
 """
     message = [ChatMessage(role='system', content=instruction), ChatMessage(role='user', content=prompt)]
-    chat_response = client.chat(
-        model=model,
-        messages=message,
-    )
-    answer = chat_response.choices[0].message.content
-    if "second" in answer:
-        return contexts[1]
-    elif "third" in answer:
-        return contexts[2]
-    else:
+    answer = chat(message)
+    choice = parse_choice(answer, len(contexts))
+    if choice is None:
+        logger.warning("Could not tell which context Mistral chose from %r, using the first one", answer)
         return contexts[0]
+    return contexts[choice]
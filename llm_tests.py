@@ -1,5 +1,8 @@
 import unittest
-from llm import get_prompt
+from unittest import mock
+from mistralai.exceptions import MistralAPIException, MistralAPIStatusException, MistralConnectionException
+import llm
+from llm import book_context, count_tokens, create_template_string, get_prompt, parse_choice
 
 
 class TestGetPrompt(unittest.TestCase):
@@ -140,5 +143,49 @@ class TestGetPrompt(unittest.TestCase):
         self.assertEqual(expected, output)
 
 
+class TestBookContext(unittest.TestCase):
+    def test_stored_context_is_used(self):
+        context = {'title': 'Macbeth', 'author': None, 'pub_date': None, 'genres': None, 'summary': 'A summary.'}
+        self.assertEqual(book_context(context), create_template_string(context))
+        self.assertEqual(book_context({**context, 'context': 'Stored.'}), 'Stored.')
+
+    def test_count_tokens(self):
+        self.assertEqual(count_tokens(''), 0)
+        self.assertEqual(count_tokens('It is a work of fiction.'), 8)
+        self.assertEqual(count_tokens('Shakespearean'), 4)
+
+
+class TestParseChoice(unittest.TestCase):
+    def test_numbers_and_ordinals(self):
+        self.assertEqual(parse_choice('2', 3), 1)
+        self.assertEqual(parse_choice('Context 3 answers the question.', 3), 2)
+        self.assertEqual(parse_choice('The Second context.', 3), 1)
+        self.assertEqual(parse_choice('Context 7', 10), 6)
+
+    def test_out_of_range_or_missing(self):
+        # 1965 is a year, not a context
+        self.assertEqual(parse_choice('The book from 1965, context 1.', 3), 0)
+        self.assertIsNone(parse_choice('The fourth one.', 3))
+        self.assertIsNone(parse_choice('None of them.', 3))
+
+
+class TestRetries(unittest.TestCase):
+    def test_retryable(self):
+        self.assertTrue(llm.retryable(MistralAPIStatusException('rate limited', 429)))
+        self.assertTrue(llm.retryable(MistralConnectionException('refused')))
+        self.assertFalse(llm.retryable(MistralAPIException('unauthorized', 401)))
+        self.assertFalse(llm.retryable(ValueError()))
+
+    def test_chat_retries(self):
+        reply = mock.MagicMock()
+        reply.choices[0].message.content = 'Hamlet'
+        client = mock.Mock()
+        client.chat.side_effect = [MistralAPIStatusException('rate limited', 429), reply]
+        with mock.patch('llm.get_client', return_value=client), mock.patch('llm.chat_cache', None), \
+                mock.patch('rate_limit.backoff_delay', return_value=0), self.assertLogs('llm', 'WARNING'):
+            self.assertEqual(llm.chat(get_prompt('Who?', {'title': 'Hamlet', 'context': 'A play.'})), 'Hamlet')
+        self.assertEqual(client.chat.call_count, 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,99 @@
+""" Sends questions to a running server from several threads and reports throughput and latency,
+overall and for each stage of the server's pipeline"""
+
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+import urllib.request
+from argparse import ArgumentParser
+import numpy as np
+from evaluate import read_test_set
+from metrics import LatencyRecorder, parse_server_timing
+
+
+def post_query(url: str, query: str, timeout: float) -> tuple[bool, dict[str, float]]:
+    """
+    Submits a question through the search form and reads the whole response.
+    Returns whether the server answered with status 200, and the seconds of each stage in its Server-Timing header.
+    """
+    data = urllib.parse.urlencode({'query': query}).encode()
+    try:
+        with urllib.request.urlopen(url, data=data, timeout=timeout) as response:
+            response.read()
+            return response.status == 200, parse_server_timing(response.headers.get('Server-Timing'))
+    except (OSError, http.client.HTTPException):
+        # URLError and TimeoutError are OSErrors too, as are connections reset while the response is read
+        return False, {}
+
+
+def run_load(url: str, queries: list[str], concurrency: int, duration: float, timeout: float = 120,
+             unique: bool = False) -> dict:
+    """
+    Keeps concurrency requests in flight for duration seconds.
+    Args:
+        url (str): url of the search form
+        queries (list[str]): questions to send, in turn
+        concurrency (int): number of client threads
+        duration (float): seconds to keep sending requests
+        timeout (float): seconds before a request counts as failed
+        unique (bool): make every question unique, so that the server's answer cache is never hit
+
+    Returns:
+        Dictionary with the request and error counts, requests per second, latency percentiles in milliseconds,
+        and the count and percentiles of each stage the server reported
+    """
+    latencies = []
+    stages = LatencyRecorder(window=10 ** 7)
+    errors = []
+    counter = iter(range(10 ** 9))
+    lock = threading.Lock()
+    end = time.perf_counter() + duration
+
+    def client():
+        while time.perf_counter() < end:
+            with lock:
+                n = next(counter)
+            query = queries[n % len(queries)]
+            if unique:
+                query = f"{query} ({n})"
+            start = time.perf_counter()
+            ok, timings = post_query(url, query, timeout)
+            with lock:
+                (latencies if ok else errors).append(time.perf_counter() - start)
+            for name, seconds in timings.items():
+                stages.record(name, seconds)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000 if latencies else (float('nan'),) * 3
+    return {'concurrency': concurrency, 'requests': len(latencies), 'errors': len(errors),
+            'requests_per_second': len(latencies) / elapsed, 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99,
+            'stages': stages.summary()}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:8080/', help='url of the search form')
+    parser.add_argument('-f', '--filepath', default='test_data/test_questions.jsonl',
+                        help='test set whose questions are sent')
+    parser.add_argument('-c', '--concurrency', type=int, nargs='+', default=[1, 4, 16],
+                        help='numbers of concurrent clients to measure, one run each')
+    parser.add_argument('-d', '--duration', type=float, default=20, help='seconds per run')
+    parser.add_argument('--unique', action='store_true',
+                        help="make every question unique so that the server's answer cache is never hit")
+    args = parser.parse_args()
+
+    queries = read_test_set(args.filepath)[0]
+    for concurrency in args.concurrency:
+        result = run_load(args.url, queries, concurrency, args.duration, unique=args.unique)
+        print(json.dumps(result))
+        for name, stage in sorted(result['stages'].items()):
+            print(f"  {name:>16}: {stage['count']:6d} x | p50 {stage['p50_ms']:9.1f} ms | "
+                  f"p95 {stage['p95_ms']:9.1f} ms | p99 {stage['p99_ms']:9.1f} ms")
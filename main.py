@@ -1,13 +1,272 @@
-from flask import Flask, request, render_template
-from llm import get_answer, dict_to_commas, choose_best_book
+import hmac
+import json
+import os
+import time
+from flask import Flask, request, render_template, abort, jsonify, Response, stream_with_context, url_for, g, \
+    has_request_context, make_response
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+import numpy as np
+import alchemy_database
+import llm
+from llm import get_answer, dict_to_commas, stream_answer
 from utils import convert_date
-from alchemy_database import make_book_db, make_book_df, process_query_and_search
+from alchemy_database import make_book_db, make_book_df, process_query_and_search, corpus_version, get_model, \
+    rows_to_records, MODEL_NAME
+from ann_index import load_or_build_ivf
+from bm25_index import load_or_build_bm25
+from cache import LRUCache, normalize_query
+from context_builder import ContextBuilder
+from gating import ConfidenceGate
+from metrics import LatencyRecorder, server_timing
+from pipeline import executor, sequential_answer, speculative_answer, wait_for
+from quantized_index import QuantizedIndex
+from reranker import make_reranker
+from title_index import TitleIndex
+from vector_store import get_vector_store
 
 app = Flask(__name__)
+# signs the links to /stream; set BRAG_SECRET_KEY when running several server processes so that they share it
+app.secret_key = os.environ.get("BRAG_SECRET_KEY") or os.urandom(32)
 # instantiate SQLAlchemy database
 DATABASE_URL = "sqlite:///books_db.db"
+# set to binary to scan compact codes of the embeddings and rescore the best candidates exactly
+QUANTIZATION = os.environ.get("BRAG_QUANTIZATION")
+# set to e.g. books_db.embeddings.npy so that all server processes memory-map one shared copy of the embeddings;
+# quantization always uses one, so that the full-precision embeddings stay on disk
+EMBEDDING_SIDECAR = os.environ.get("BRAG_EMBEDDING_SIDECAR") or ("books_db.embeddings.npy" if QUANTIZATION else None)
+# requests only read the books loaded here, which are never modified afterwards, so they need no database session
 db = make_book_db(DATABASE_URL)
-book_df = make_book_df(db)
+book_df = make_book_df(db, EMBEDDING_SIDECAR)
+db.close()
+# changes whenever the books or their embeddings change
+CORPUS_VERSION = corpus_version(book_df)
+# set to e.g. books_db.ivf.npz to search an approximate (IVF) index instead of every book;
+# the index is built and saved there if it is missing or out of date
+ANN_INDEX = os.environ.get("BRAG_ANN_INDEX")
+search_index = None
+if ANN_INDEX:
+    search_index = load_or_build_ivf(ANN_INDEX, get_vector_store(book_df), CORPUS_VERSION,
+                                     nprobe=int(os.environ.get("BRAG_ANN_NPROBE", 16)))
+elif QUANTIZATION:
+    search_index = QuantizedIndex(get_vector_store(book_df), QUANTIZATION,
+                                  n_candidates=int(os.environ.get("BRAG_QUANTIZATION_CANDIDATES", 200)))
+
+# set to e.g. books_db.bm25.npz to fuse the embedding search with BM25 over the titles, authors and summaries;
+# the index is built and saved there if it is missing or out of date
+BM25_INDEX = os.environ.get("BRAG_BM25_INDEX")
+lexical_index = None
+if BM25_INDEX:
+    lexical_index = load_or_build_bm25(BM25_INDEX, book_df)
+    # rrf (reciprocal rank fusion) or weighted (BRAG_HYBRID_WEIGHT * cosine + the rest * BM25, both min-max scaled)
+    lexical_index.fusion = os.environ.get("BRAG_HYBRID_FUSION", "rrf")
+    lexical_index.weight = float(os.environ.get("BRAG_HYBRID_WEIGHT", 0.5))
+
+# set to 1 to answer questions that name a book's title from that book without searching the embeddings;
+# off by default until its precision on real questions is measured with bench_titles.py
+TITLE_INDEX = os.environ.get("BRAG_TITLE_INDEX", "0") != "0"
+title_index = TitleIndex.from_df(book_df) if TITLE_INDEX else None
+# set to e.g. 400 to shorten the context of each book given to Mistral to at most that many tokens,
+# keeping the passages of its summary closest to the question
+CONTEXT_TOKENS = int(os.environ.get("BRAG_CONTEXT_TOKENS", 0))
+context_builder = ContextBuilder(CONTEXT_TOKENS) if CONTEXT_TOKENS > 0 else None
+
+# choose between the retrieved books with Mistral (llm) or a local cross-encoder (cross-encoder)
+RERANKER = os.environ.get("BRAG_RERANKER", "llm")
+reranker = make_reranker(RERANKER)
+# number of books retrieved and reranked per question
+RERANK_CANDIDATES = int(os.environ.get("BRAG_RERANK_CANDIDATES", 3))
+
+# answers to recent questions, keyed on everything that can change an answer besides the question itself
+ANSWER_CACHE_VERSION = "\n".join([CORPUS_VERSION, MODEL_NAME, llm.model, str(llm.PROMPT_VERSION),
+                                  ANN_INDEX or QUANTIZATION or "exact", f"titles={TITLE_INDEX}",
+                                  f"bm25={lexical_index.fusion},{lexical_index.weight}" if lexical_index else "dense",
+                                  f"context_tokens={CONTEXT_TOKENS}", f"rerank={RERANKER},{RERANK_CANDIDATES}"])
+answer_cache = LRUCache(max_size=int(os.environ.get("BRAG_ANSWER_CACHE_SIZE", 1024)),
+                        ttl=float(os.environ.get("BRAG_ANSWER_CACHE_TTL", 3600)))
+# skip the rerank when the best book clearly beats the others, calibrate the values with gating.py
+GATE_THRESHOLD = os.environ.get("BRAG_GATE_THRESHOLD")
+GATE_MARGIN = os.environ.get("BRAG_GATE_MARGIN")
+rerank_gate = ConfidenceGate(float(GATE_THRESHOLD) if GATE_THRESHOLD else None,
+                             float(GATE_MARGIN) if GATE_MARGIN else None)
+# start answering from the top-ranked book while the rerank runs, set to 0 to run the calls one after the other
+SPECULATIVE = os.environ.get("BRAG_SPECULATIVE", "1") != "0"
+# seconds to wait for the rerank before answering from the top-ranked book
+RERANK_TIMEOUT = float(os.environ.get("BRAG_RERANK_TIMEOUT", 10))
+# seconds after which a request that has no answer yet fails
+ANSWER_TIMEOUT = float(os.environ.get("BRAG_ANSWER_TIMEOUT", 60))
+# render the book right away and stream the answer into the page as it is generated
+STREAMING = os.environ.get("BRAG_STREAMING", "0") != "0"
+# seconds for which a link to /stream is accepted, so that a saved link cannot be replayed later
+STREAM_LINK_MAX_AGE = float(os.environ.get("BRAG_STREAM_LINK_MAX_AGE", 300))
+stream_links = URLSafeTimedSerializer(app.secret_key, salt="stream")
+latencies = LatencyRecorder()
+# the /admin routes are disabled unless a token is set
+ADMIN_TOKEN = os.environ.get("BRAG_ADMIN_TOKEN")
+
+
+def record_stage(name: str, seconds: float) -> None:
+    """
+    Records how long a stage of request handling took, for /admin/latency and, during a request,
+    for the Server-Timing header of its response.
+    """
+    latencies.record(name, seconds)
+    if has_request_context():
+        g.setdefault("stages", []).append((name, seconds))
+
+
+def warm_up() -> None:
+    """
+    Loads the encoder, runs it once, creates the Mistral client and loads the reranker, so that the first request
+    is not slowed down by loading them. Called when the server starts unless BRAG_WARM_UP=0.
+    """
+    start = time.perf_counter()
+    get_model().encode(["warm up"])
+    llm.get_client()
+    reranker.warm_up()
+    app.logger.info("Warmed up in %.1f s", time.perf_counter() - start)
+
+
+def log_gate_decision(docs: list[dict], skipped: bool, saved: float = 0.0) -> None:
+    best = docs[0]["sims"]
+    second = docs[1]["sims"] if len(docs) > 1 else float("nan")
+    if skipped:
+        app.logger.info("Skipped the rerank (best %.3f, second %.3f), saved about %.0f ms",
+                        best, second, saved * 1000)
+    elif rerank_gate.enabled:
+        app.logger.info("Ran the rerank (best %.3f, second %.3f)", best, second)
+
+
+def cached_answer(query: str) -> tuple[dict, str] | None:
+    """
+    Returns the book and answer cached for a query, or None if it was not answered recently.
+    """
+    cached = answer_cache.get((ANSWER_CACHE_VERSION, normalize_query(query)))
+    if cached is None:
+        return None
+    book_id, llm_output = cached
+    return book_by_id(book_id), llm_output
+
+
+def book_by_id(book_id: int) -> dict:
+    return book_df.iloc[get_vector_store(book_df).id_to_row[book_id]].to_dict()
+
+
+def fit_contexts(query: str, docs: list[dict]) -> list[dict]:
+    """
+    Shortens the contexts of the books to the token budget if one is set, and logs the number of context tokens
+    the request will send to Mistral.
+    """
+    if context_builder is None:
+        app.logger.info("Prompt contexts: %d tokens", sum(doc["context_tokens"] for doc in docs))
+        return docs
+    start = time.perf_counter()
+    fitted = [context_builder.fit(query, doc) for doc in docs]
+    record_stage("context_fitting", time.perf_counter() - start)
+    app.logger.info("Prompt contexts: %d tokens, %d before fitting them to %d tokens per book",
+                    sum(doc["context_tokens"] for doc in fitted), sum(doc["context_tokens"] for doc in docs),
+                    CONTEXT_TOKENS)
+    return fitted
+
+
+def retrieve(query: str) -> list[dict]:
+    """
+    Retrieves the books a query names by title, or otherwise the RERANK_CANDIDATES books most similar to it,
+    with their contexts fitted to the token budget.
+    Books found by title get a similarity of 1.
+    Args:
+        query (str): user's question
+
+    Returns:
+        List of book information dictionaries, from most to least similar
+    """
+    start = time.perf_counter()
+    docs = None
+    if title_index is not None:
+        rows = title_index.lookup(query, RERANK_CANDIDATES)
+        record_stage("title_lookup", time.perf_counter() - start)
+        if rows is not None:
+            docs = rows_to_records(book_df, rows, np.ones(len(rows)))
+    if docs is None:
+        docs = process_query_and_search(query, book_df, RERANK_CANDIDATES, search_index, lexical_index)
+        record_stage("dense_retrieval", time.perf_counter() - start)
+    return fit_contexts(query, docs)
+
+
+def answer_query(query: str) -> tuple[dict, str]:
+    """
+    Runs the RAG pipeline for a query, or returns the cached result if the same query was answered recently.
+    Args:
+        query (str): user's question
+
+    Returns:
+        The chosen book's information dictionary and the LLM's answer
+    """
+    cached = cached_answer(query)
+    if cached is not None:
+        return cached
+    # retrieve the best books
+    docs = retrieve(query)
+    start = time.perf_counter()
+    if len(docs) == 1:
+        # the query named the book
+        doc = docs[0]
+        llm_output = get_answer(query, doc)
+        record_stage("answer", time.perf_counter() - start)
+    elif rerank_gate.is_confident(docs):
+        doc = docs[0]
+        log_gate_decision(docs, True, rerank_gate.record_skip())
+        llm_output = get_answer(query, doc)
+        record_stage("answer", time.perf_counter() - start)
+    else:
+        # select top book with the reranker and answer from it
+        if SPECULATIVE:
+            doc, llm_output, info = speculative_answer(query, docs, reranker.choose, get_answer,
+                                                       RERANK_TIMEOUT, ANSWER_TIMEOUT)
+        else:
+            doc, llm_output, info = sequential_answer(query, docs, reranker.choose, get_answer)
+        rerank_gate.record_rerank(info["rerank_seconds"])
+        record_stage("rerank", info["rerank_seconds"])
+        # the time spent waiting for the answer once the book was chosen
+        record_stage("answer", info["seconds"] - info["rerank_seconds"])
+        log_gate_decision(docs, False)
+        if info["rerank_timed_out"]:
+            app.logger.warning("The rerank timed out after %.1f s, answered from the top-ranked book",
+                               RERANK_TIMEOUT)
+            # the fallback answer is not cached, so the question is reranked again once the reranker recovers
+            return doc, llm_output
+    answer_cache.put((ANSWER_CACHE_VERSION, normalize_query(query)), (doc["id"], llm_output))
+    return doc, llm_output
+
+
+def choose_book(query: str) -> tuple[dict, bool]:
+    """
+    Retrieves the books for a query (see retrieve) and chooses one of them, without answering the query.
+    Args:
+        query (str): user's question
+
+    Returns:
+        The chosen book's information dictionary, and whether the rerank timed out
+        so that the top-ranked book was chosen instead
+    """
+    docs = retrieve(query)
+    if len(docs) == 1:
+        return docs[0], False
+    if rerank_gate.is_confident(docs):
+        log_gate_decision(docs, True, rerank_gate.record_skip())
+        return docs[0], False
+    start = time.perf_counter()
+    timed_out = False
+    try:
+        doc = wait_for(executor.submit(reranker.choose, query, docs), start + RERANK_TIMEOUT)
+    except TimeoutError:
+        app.logger.warning("The rerank timed out after %.1f s, answering from the top-ranked book",
+                           RERANK_TIMEOUT)
+        doc, timed_out = docs[0], True
+    seconds = time.perf_counter() - start
+    rerank_gate.record_rerank(seconds)
+    record_stage("rerank", seconds)
+    log_gate_decision(docs, False)
+    return doc, timed_out
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -16,10 +275,20 @@ def index():
         return render_template("index.html")
     else:
         query = request.form["query"]
-        # retrieve best three books
-        docs = process_query_and_search(query, book_df, 3)
-        # select top book via llm
-        doc = choose_best_book(query, docs)
+        start = time.perf_counter()
+        stream_url = None
+        try:
+            cached = cached_answer(query) if STREAMING else None
+            if cached is not None:
+                doc, llm_output = cached
+            elif STREAMING:
+                (doc, timed_out), llm_output = choose_book(query), ""
+                # answers from the top-ranked book after a rerank timeout are not cached
+                stream_url = url_for("stream", token=stream_links.dumps([query, int(doc["id"]), not timed_out]))
+            else:
+                doc, llm_output = answer_query(query)
+        except TimeoutError:
+            abort(504)
         # format data for nice printing on frontend
         author = doc["author"] if doc["author"] else "N/A"
         genres = dict_to_commas(doc["genres"]) if doc["genres"] else "N/A"
@@ -30,19 +299,105 @@ def index():
                 date = doc["pub_date"]
         else:
             date = "N/A"
-        llm_output = get_answer(query, doc)
 
-        return render_template(
+        page = render_template(
             "results.html",
             query=query,
             generation=llm_output,
+            stream_url=stream_url,
             title=doc["title"],
             author=author,
             genres=genres,
             date=date,
             summary=doc["summary"]
         )
+        record_stage("results_page", time.perf_counter() - start)
+        response = make_response(page)
+        response.headers["Server-Timing"] = server_timing(g.get("stages", []))
+        return response
+
+
+@app.route("/stream")
+def stream():
+    """
+    Streams the answer to a question from a book as Server-Sent Events: one message per piece of the answer
+    (a JSON string), then a 'done' event. The question and book come from a link signed by the / route.
+    """
+    try:
+        query, book_id, cache = stream_links.loads(request.args.get("token", ""), max_age=STREAM_LINK_MAX_AGE)
+    except BadSignature:
+        # also raised as SignatureExpired for links older than STREAM_LINK_MAX_AGE
+        abort(400)
+    if book_id not in get_vector_store(book_df).id_to_row:
+        # the book is gone since the link was made, e.g. after the database was reloaded
+        abort(404)
+    start = time.perf_counter()
+    doc = fit_contexts(query, [book_by_id(book_id)])[0]
+
+    def events():
+        # a comment line, so that the client gets the first byte before Mistral is even called
+        yield ": answer\n\n"
+        record_stage("stream_ttfb", time.perf_counter() - start)
+        parts = []
+        try:
+            for piece in stream_answer(query, doc):
+                if not parts:
+                    record_stage("stream_ttft", time.perf_counter() - start)
+                parts.append(piece)
+                yield f"data: {json.dumps(piece)}\n\n"
+        except Exception:
+            app.logger.exception("Streaming the answer failed")
+            yield "event: failed\ndata: {}\n\n"
+        else:
+            if cache:
+                answer_cache.put((ANSWER_CACHE_VERSION, normalize_query(query)), (book_id, "".join(parts)))
+            record_stage("stream_total", time.perf_counter() - start)
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def check_admin_token() -> None:
+    """
+    Rejects the request unless it carries the admin token in the X-Admin-Token header.
+    """
+    if not ADMIN_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN):
+        abort(403)
+
+
+@app.route("/admin/cache", methods=["GET"])
+def cache_stats():
+    check_admin_token()
+    return jsonify(answers=answer_cache.stats(), query_embeddings=alchemy_database.query_cache.stats(),
+                   llm_completions=llm.chat_cache.stats() if llm.chat_cache is not None else None,
+                   rerank_gate=rerank_gate.stats(),
+                   title_index=title_index.stats() if title_index is not None else None,
+                   contexts=context_builder.stats() if context_builder is not None else None)
+
+
+@app.route("/admin/latency", methods=["GET"])
+def latency_stats():
+    check_admin_token()
+    return jsonify(latencies.summary())
+
+
+@app.route("/admin/cache/clear", methods=["POST"])
+def clear_cache():
+    """
+    Drops every cached answer, e.g. after the prompts were edited without restarting the server.
+    """
+    check_admin_token()
+    stats = answer_cache.stats()
+    answer_cache.clear()
+    return jsonify(cleared=stats["size"])
+
 
+if os.environ.get("BRAG_WARM_UP", "1") != "0":
+    warm_up()
 
 if __name__ == "__main__":
-    app.run(debug=True, port=8080, host="0.0.0.0")
+    # development server; use wsgi.py with a production server such as gunicorn otherwise
+    app.run(debug=os.environ.get("BRAG_DEBUG") == "1", threaded=True, port=8080, host="0.0.0.0")
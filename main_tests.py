@@ -0,0 +1,55 @@
+import importlib
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+from alchemy_database import add_book, make_book_db
+
+
+class TestStreamLinks(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        # Placeholder for the sentence encoder, main is imported without warming up the real one
+        class Model:
+            def encode(self, data):
+                return [1.0, 2.0, 3.0]
+
+        # main loads books_db.db from the working directory when it is imported
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        db = make_book_db("sqlite:///books_db.db")
+        add_book(Model(), db, "Title 1", "Author 1", {"Genre": "Fiction"}, "Summary 1", "2022-01-01")
+        db.close()
+        env = {"BRAG_WARM_UP": "0", "BRAG_STREAMING": "1", "BRAG_SECRET_KEY": "test"}
+        with mock.patch.dict(os.environ, env):
+            sys.modules.pop("main", None)
+            self.main = importlib.import_module("main")
+        self.client = self.main.app.test_client()
+        self.book_id = int(self.main.book_df["id"].iloc[0])
+
+    @classmethod
+    def tearDownClass(self):
+        sys.modules.pop("main", None)
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def test_bad_signature(self):
+        token = self.main.stream_links.dumps(["question", self.book_id, True]) + "x"
+        self.assertEqual(self.client.get("/stream", query_string={"token": token}).status_code, 400)
+
+    def test_expired_link(self):
+        # sign the link as if it had been made before the maximum age
+        with mock.patch("time.time", return_value=time.time() - self.main.STREAM_LINK_MAX_AGE - 10):
+            token = self.main.stream_links.dumps(["question", self.book_id, True])
+        self.assertEqual(self.client.get("/stream", query_string={"token": token}).status_code, 400)
+
+    def test_unknown_book(self):
+        token = self.main.stream_links.dumps(["question", self.book_id + 1000, True])
+        self.assertEqual(self.client.get("/stream", query_string={"token": token}).status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
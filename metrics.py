@@ -0,0 +1,59 @@
+import threading
+from collections import deque
+import numpy as np
+
+
+class LatencyRecorder:
+    """
+    Keeps the most recent durations of named stages of request handling, and summarizes them as percentiles.
+    """
+    def __init__(self, window: int = 1000):
+        """
+        Args:
+            window (int): number of most recent durations kept per stage
+        """
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.samples.setdefault(name, deque(maxlen=self.window)).append(seconds)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """
+        Returns the count and the p50, p95 and p99 durations in milliseconds of each stage.
+        """
+        with self.lock:
+            samples = {name: np.array(values) * 1000 for name, values in self.samples.items()}
+        return {name: {'count': len(values),
+                       **dict(zip(['p50_ms', 'p95_ms', 'p99_ms'], np.percentile(values, [50, 95, 99]).tolist()))}
+                for name, values in samples.items()}
+
+
+def server_timing(stages: list[tuple[str, float]]) -> str:
+    """
+    Formats the durations of the stages of a request as a Server-Timing header, e.g. "rerank;dur=312.5".
+    Args:
+        stages (list[tuple[str, float]]): name and seconds of each stage
+
+    Returns:
+        Header value, with the durations in milliseconds
+    """
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages)
+
+
+def parse_server_timing(header: str | None) -> dict[str, float]:
+    """
+    Reads the durations of a Server-Timing header.
+    Returns:
+        Seconds of each named stage; durations of a stage named more than once are added up
+    """
+    stages = {}
+    for metric in (header or "").split(","):
+        name, *params = [part.strip() for part in metric.split(";")]
+        for param in params:
+            key, _, value = param.partition("=")
+            if name and key == "dur":
+                stages[name] = stages.get(name, 0.0) + float(value) / 1000
+    return stages
@@ -0,0 +1,38 @@
+import unittest
+from metrics import LatencyRecorder, parse_server_timing, server_timing
+
+
+class TestLatencyRecorder(unittest.TestCase):
+    def test_summary(self):
+        latencies = LatencyRecorder()
+        for ms in range(1, 101):
+            latencies.record('answer', ms / 1000)
+        latencies.record('retrieval', 0.002)
+        summary = latencies.summary()
+        self.assertEqual(summary['answer']['count'], 100)
+        self.assertAlmostEqual(summary['answer']['p50_ms'], 50.5)
+        self.assertAlmostEqual(summary['retrieval']['p99_ms'], 2.0)
+
+    def test_window(self):
+        latencies = LatencyRecorder(window=2)
+        for seconds in [10.0, 0.001, 0.001]:
+            latencies.record('answer', seconds)
+        self.assertEqual(latencies.summary()['answer']['count'], 2)
+        self.assertAlmostEqual(latencies.summary()['answer']['p99_ms'], 1.0)
+
+
+class TestServerTiming(unittest.TestCase):
+    def test_round_trip(self):
+        header = server_timing([('dense_retrieval', 0.0123), ('rerank', 0.3), ('rerank', 0.1)])
+        self.assertEqual(header, 'dense_retrieval;dur=12.3, rerank;dur=300.0, rerank;dur=100.0')
+        stages = parse_server_timing(header)
+        self.assertAlmostEqual(stages['dense_retrieval'], 0.0123)
+        self.assertAlmostEqual(stages['rerank'], 0.4)
+
+    def test_other_metrics(self):
+        self.assertEqual(parse_server_timing('cache;desc="hit", db;dur=2'), {'db': 0.002})
+        self.assertEqual(parse_server_timing(None), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
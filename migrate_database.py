@@ -0,0 +1,138 @@
+""" Converts a books database written by an older version of the code to the current storage format"""
+
+import pickle
+from argparse import ArgumentParser
+import numpy as np
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import Connection
+from alchemy_database import EMBEDDING_MAGIC, content_hash, context_columns, decode_genres, encode_embedding, \
+    encode_genres
+from llm import TEMPLATE_VERSION, create_template_string
+
+# columns added to the books table after it was first created, in the order they were added
+ADDED_COLUMNS = [("wikipedia_id", "INTEGER"), ("freebase_id", "TEXT"), ("content_hash", "TEXT"),
+                 ("context", "TEXT"), ("context_tokens", "INTEGER"), ("context_version", "INTEGER")]
+
+
+def is_current_embedding(blob: bytes | None) -> bool:
+    return blob is not None and blob[:len(EMBEDDING_MAGIC)] == EMBEDDING_MAGIC
+
+
+def add_missing_columns(connection: Connection) -> list[str]:
+    """
+    Adds the columns the books table is missing, along with their indexes.
+    Args:
+        connection (Connection): connection to the database
+
+    Returns:
+        Names of the columns that were added
+    """
+    existing = {column["name"] for column in inspect(connection).get_columns("books")}
+    added = []
+    for name, column_type in ADDED_COLUMNS:
+        if name not in existing:
+            connection.execute(text(f"ALTER TABLE books ADD COLUMN {name} {column_type}"))
+            added.append(name)
+    connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_books_wikipedia_id ON books (wikipedia_id)"))
+    return added
+
+
+def convert_pickles(connection: Connection, batch_size: int) -> set[int]:
+    """
+    Rewrites pickled genres and embeddings as JSON and raw float32 bytes.
+    Args:
+        connection (Connection): connection to the database
+        batch_size (int): number of rows rewritten per UPDATE statement
+
+    Returns:
+        Ids of the rows that were converted
+    """
+    rows = connection.execute(text("SELECT id, genres, embedding FROM books")).all()
+    updates = []
+    for book_id, genres, embedding in rows:
+        if is_current_embedding(embedding) and not isinstance(genres, bytes):
+            continue
+        if isinstance(genres, bytes):
+            genres = encode_genres(pickle.loads(genres))
+        if not is_current_embedding(embedding):
+            embedding = encode_embedding(np.asarray(pickle.loads(embedding)))
+        updates.append({"id": book_id, "genres": genres, "embedding": embedding})
+    for i in range(0, len(updates), batch_size):
+        connection.execute(text("UPDATE books SET genres = :genres, embedding = :embedding WHERE id = :id"),
+                           updates[i:i + batch_size])
+    return {row["id"] for row in updates}
+
+
+def book_text(row) -> str:
+    return create_template_string({"title": row.title, "author": row.author, "genres": decode_genres(row.genres),
+                                   "summary": row.summary, "pub_date": row.pub_date})
+
+
+def fill_content_hashes(connection: Connection, batch_size: int) -> set[int]:
+    """
+    Computes the content_hash of rows that do not have one yet, assuming they were embedded with the current model.
+    Args:
+        connection (Connection): connection to the database
+        batch_size (int): number of rows rewritten per UPDATE statement
+
+    Returns:
+        Ids of the rows that were updated
+    """
+    rows = connection.execute(text("SELECT id, title, author, genres, summary, pub_date FROM books "
+                                   "WHERE content_hash IS NULL")).all()
+    updates = [{"id": row.id, "content_hash": content_hash(book_text(row))} for row in rows]
+    for i in range(0, len(updates), batch_size):
+        connection.execute(text("UPDATE books SET content_hash = :content_hash WHERE id = :id"),
+                           updates[i:i + batch_size])
+    return {row["id"] for row in updates}
+
+
+def fill_contexts(connection: Connection, batch_size: int) -> set[int]:
+    """
+    Renders the context of rows that have none or whose context was rendered with an older TEMPLATE_VERSION.
+    Args:
+        connection (Connection): connection to the database
+        batch_size (int): number of rows rewritten per UPDATE statement
+
+    Returns:
+        Ids of the rows that were updated
+    """
+    rows = connection.execute(text("SELECT id, title, author, genres, summary, pub_date FROM books "
+                                   "WHERE context_version IS NULL OR context_version != :version"),
+                              {"version": TEMPLATE_VERSION}).all()
+    updates = [{"id": row.id, **context_columns(book_text(row))} for row in rows]
+    for i in range(0, len(updates), batch_size):
+        connection.execute(text("UPDATE books SET context = :context, context_tokens = :context_tokens, "
+                                "context_version = :context_version WHERE id = :id"), updates[i:i + batch_size])
+    return {row["id"] for row in updates}
+
+
+def migrate(db_url: str, batch_size: int = 1000) -> int:
+    """
+    Brings a books database up to the current schema and storage format, in place.
+    Only run this on database files you trust, since it has to unpickle the old values.
+    Args:
+        db_url (str): url of the database to migrate
+        batch_size (int): number of rows rewritten per UPDATE statement
+
+    Returns:
+        Number of rows that were changed
+    """
+    engine = create_engine(db_url)
+    with engine.begin() as connection:
+        add_missing_columns(connection)
+        changed = (convert_pickles(connection, batch_size) | fill_content_hashes(connection, batch_size)
+                   | fill_contexts(connection, batch_size))
+    if engine.dialect.name == 'sqlite':
+        # reclaim the space freed by the smaller embeddings
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text("VACUUM"))
+    return len(changed)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--db-url', default='sqlite:///books_db.db', help='url of the database to migrate')
+    args = parser.parse_args()
+    n_converted = migrate(args.db_url)
+    print(f"Converted {n_converted} books to the current storage format")
@@ -0,0 +1,73 @@
+import os
+import pickle
+import tempfile
+import unittest
+import numpy as np
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from alchemy_database import Book, make_book_db, make_book_df
+from llm import TEMPLATE_VERSION, create_template_string
+from migrate_database import migrate
+
+
+class TestMigrate(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_url = "sqlite:///" + os.path.join(self.tmpdir.name, "books.db")
+        engine = create_engine(self.db_url)
+        # write two books into the original schema, the way the pickle-based version of add_book did
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE books (id INTEGER PRIMARY KEY, title TEXT, author TEXT, "
+                                    "genres BLOB, summary TEXT, pub_date TEXT, embedding BLOB)"))
+            connection.execute(text("INSERT INTO books (title, author, genres, summary, pub_date, embedding) "
+                                    "VALUES (:title, :author, :genres, :summary, :pub_date, :embedding)"),
+                               [{"title": "Title 1", "author": "Author 1", "genres": pickle.dumps({"0": "Fiction"}),
+                                 "summary": "Summary 1", "pub_date": "2022",
+                                 "embedding": pickle.dumps(np.array([1.0, 2.0, 3.0], dtype=np.float32))},
+                                {"title": "Title 2", "author": None, "genres": pickle.dumps(None),
+                                 "summary": "Summary 2", "pub_date": None,
+                                 "embedding": pickle.dumps(np.array([4.0, 5.0, 6.0], dtype=np.float32))}])
+        engine.dispose()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_migrate(self):
+        # the old schema lacks the newer columns
+        with self.assertRaises(OperationalError):
+            make_book_df(make_book_db(self.db_url))
+        self.assertEqual(migrate(self.db_url), 2)
+        df = make_book_df(make_book_db(self.db_url))
+        self.assertEqual(list(df["genres"]), [{"0": "Fiction"}, None])
+        self.assertTrue(np.array_equal(np.stack(df["embedding"]), [[1, 2, 3], [4, 5, 6]]))
+
+    def test_new_columns(self):
+        migrate(self.db_url)
+        db = make_book_db(self.db_url)
+        books = db.query(Book).order_by(Book.id).all()
+        self.assertTrue(all(book.content_hash for book in books))
+        self.assertTrue(all(book.wikipedia_id is None for book in books))
+        self.assertTrue(all(book.context_version == TEMPLATE_VERSION for book in books))
+        self.assertEqual(books[0].context, create_template_string({"title": "Title 1", "author": "Author 1",
+                                                                   "genres": {"0": "Fiction"},
+                                                                   "summary": "Summary 1", "pub_date": "2022"}))
+
+    def test_stale_contexts(self):
+        migrate(self.db_url)
+        engine = create_engine(self.db_url)
+        with engine.begin() as connection:
+            connection.execute(text("UPDATE books SET context = 'old', context_version = :version WHERE id = 1"),
+                               {"version": TEMPLATE_VERSION - 1})
+        engine.dispose()
+        self.assertEqual(migrate(self.db_url), 1)
+        book = make_book_db(self.db_url).get(Book, 1)
+        self.assertNotEqual(book.context, 'old')
+        self.assertEqual(book.context_version, TEMPLATE_VERSION)
+
+    def test_migrate_twice(self):
+        migrate(self.db_url)
+        self.assertEqual(migrate(self.db_url), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+""" Runs the two LLM calls of answering a question concurrently"""
+
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+# threads waiting on the Mistral API; every request needs up to two of them at a time
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get("BRAG_LLM_WORKERS", 16)), thread_name_prefix='llm')
+
+
+def same_book(a: dict, b: dict) -> bool:
+    return a is b or ('id' in a and a.get('id') == b.get('id'))
+
+
+def wait_for(future: Future, deadline: float | None):
+    """
+    Returns the result of a future, or cancels it and raises TimeoutError if it is not done by the deadline.
+    A call that is already running cannot be interrupted, but its result is then ignored.
+    """
+    try:
+        return future.result(timeout=None if deadline is None else max(0.0, deadline - time.perf_counter()))
+    except FutureTimeoutError:
+        # before Python 3.11 this is not the built-in TimeoutError
+        future.cancel()
+        raise TimeoutError("LLM call did not finish in time") from None
+
+
+def speculative_answer(query: str, docs: list[dict], choose, answer, rerank_timeout: float | None = None,
+                       timeout: float | None = None, pool: ThreadPoolExecutor = executor) -> tuple[dict, str, dict]:
+    """
+    Chooses the best of the retrieved books and answers the query from it, starting to answer from the
+    top-ranked book while the choice is being made. If the choice confirms the top-ranked book, that answer is used;
+    otherwise it is abandoned and the query is answered again from the chosen book.
+    Args:
+        query (str): user's question
+        docs (list[dict]): retrieved books, from most to least similar
+        choose: function (query, docs) -> the best book, e.g. llm.choose_best_book
+        answer: function (query, book) -> the answer, e.g. llm.get_answer
+        rerank_timeout (float): seconds to wait for choose before settling for the top-ranked book
+        timeout (float): seconds from the start by which the answer must be ready
+        pool (ThreadPoolExecutor): executor running the calls
+
+    Returns:
+        The chosen book, the answer, and a dictionary of timings and whether the speculative answer was used
+
+    Raises:
+        TimeoutError: if the answer is not ready in time
+    """
+    start = time.perf_counter()
+    deadline = None if timeout is None else start + timeout
+    rerank = pool.submit(choose, query, docs)
+    speculative = pool.submit(answer, query, docs[0])
+    info = {'rerank_timed_out': False}
+    try:
+        rerank_deadline = None if rerank_timeout is None else start + rerank_timeout
+        if deadline is not None:
+            rerank_deadline = deadline if rerank_deadline is None else min(rerank_deadline, deadline)
+        doc = wait_for(rerank, rerank_deadline)
+    except TimeoutError:
+        doc = docs[0]
+        info['rerank_timed_out'] = True
+    info['rerank_seconds'] = time.perf_counter() - start
+    info['agreed'] = same_book(doc, docs[0])
+    if info['agreed']:
+        generation = speculative
+    else:
+        speculative.cancel()
+        generation = pool.submit(answer, query, doc)
+    llm_output = wait_for(generation, deadline)
+    info['seconds'] = time.perf_counter() - start
+    return doc, llm_output, info
+
+
+def sequential_answer(query: str, docs: list[dict], choose, answer) -> tuple[dict, str, dict]:
+    """
+    Chooses the best of the retrieved books and then answers the query from it, one call after the other.
+    Takes the same arguments as speculative_answer and returns the same values.
+    """
+    start = time.perf_counter()
+    doc = choose(query, docs)
+    rerank_seconds = time.perf_counter() - start
+    llm_output = answer(query, doc)
+    return doc, llm_output, {'rerank_timed_out': False, 'rerank_seconds': rerank_seconds,
+                             'agreed': same_book(doc, docs[0]), 'seconds': time.perf_counter() - start}
@@ -0,0 +1,65 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import sequential_answer, speculative_answer
+
+BOOKS = [{'id': 1, 'title': 'Dune'}, {'id': 2, 'title': 'Emma'}, {'id': 3, 'title': 'Macbeth'}]
+
+
+class TestSpeculativeAnswer(unittest.TestCase):
+    def setUp(self):
+        self.pool = ThreadPoolExecutor(max_workers=4)
+        self.answered = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.pool.shutdown(wait=True)
+
+    def answer(self, delay=0.0):
+        def answer(query, doc):
+            time.sleep(delay)
+            with self.lock:
+                self.answered.append(doc['title'])
+            return f"From {doc['title']}"
+        return answer
+
+    @staticmethod
+    def choose(index, delay=0.0):
+        def choose(query, docs):
+            time.sleep(delay)
+            return docs[index]
+        return choose
+
+    def test_agreement_overlaps_calls(self):
+        start = time.perf_counter()
+        doc, output, info = speculative_answer("q", BOOKS, self.choose(0, 0.2), self.answer(0.2), pool=self.pool)
+        self.assertLess(time.perf_counter() - start, 0.35)
+        self.assertEqual(doc, BOOKS[0])
+        self.assertEqual(output, "From Dune")
+        self.assertTrue(info['agreed'])
+        self.assertEqual(self.answered, ['Dune'])
+
+    def test_disagreement_answers_again(self):
+        doc, output, info = speculative_answer("q", BOOKS, self.choose(2, 0.05), self.answer(0.1), pool=self.pool)
+        self.assertEqual(doc, BOOKS[2])
+        self.assertEqual(output, "From Macbeth")
+        self.assertFalse(info['agreed'])
+
+    def test_rerank_timeout_uses_top_book(self):
+        doc, output, info = speculative_answer("q", BOOKS, self.choose(1, 0.5), self.answer(),
+                                               rerank_timeout=0.05, pool=self.pool)
+        self.assertEqual(doc, BOOKS[0])
+        self.assertTrue(info['rerank_timed_out'])
+
+    def test_answer_timeout(self):
+        with self.assertRaises(TimeoutError):
+            speculative_answer("q", BOOKS, self.choose(0), self.answer(0.5), timeout=0.05, pool=self.pool)
+
+    def test_sequential(self):
+        doc, output, info = sequential_answer("q", BOOKS, self.choose(1), self.answer())
+        self.assertEqual((doc, output, info['agreed']), (BOOKS[1], "From Emma", False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import numpy as np
+from vector_store import VectorStore, top_k
+
+
+def popcount64(x: np.ndarray) -> np.ndarray:
+    """
+    Counts the set bits of every element of a uint64 array (SWAR bit counting).
+    """
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+# numpy >= 2.0 counts bits natively
+popcount = getattr(np, 'bitwise_count', popcount64)
+
+
+def pack_signs(vectors: np.ndarray) -> np.ndarray:
+    """
+    Packs the sign bits of each row into uint64 words, padding the rows with zero bits to a whole number of words.
+    """
+    bits = np.packbits(np.atleast_2d(vectors) > 0, axis=1)
+    padding = -bits.shape[1] % 8
+    if padding:
+        bits = np.pad(bits, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(bits).view(np.uint64)
+
+
+class QuantizedIndex:
+    """
+    Two-stage search over a VectorStore: a scan over compact codes picks n_candidates rows,
+    which are then rescored exactly with the store's full-precision vectors.
+    Only the sign of every dimension is kept, packed 64 per word (32x smaller than float32),
+    and candidates are ranked by Hamming distance computed with XOR and popcount.
+    Only the candidates' rows of the full-precision matrix are read, so it should stay on disk in a memmapped sidecar;
+    otherwise the codes are held on top of the whole matrix.
+    """
+    MODES = ('binary',)
+
+    def __init__(self, store: VectorStore, mode: str = 'binary', n_candidates: int = 200, block_size: int = 2048):
+        """
+        Args:
+            store (VectorStore): the store to index and rescore with
+            mode (str): 'binary', the only kind of code
+            n_candidates (int): number of rows rescored exactly per query
+            block_size (int): number of codes scanned at a time, small enough for the intermediates to stay in cache
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown quantization mode {mode!r}, expected 'binary'")
+        self.store = store
+        self.mode = mode
+        self.n_candidates = n_candidates
+        self.block_size = block_size
+        matrix = store.matrix
+        self.codes = np.empty((len(matrix), -(-matrix.shape[1] // 64)), dtype=np.uint64)
+        # pack a block at a time, so that a memmapped matrix is read once without holding a boolean copy of it
+        for start in range(0, len(matrix), 8192):
+            self.codes[start:start + 8192] = pack_signs(matrix[start:start + 8192])
+        # the index is shared by every thread of a server, so its arrays are read-only
+        self.codes.flags.writeable = False
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory held by the codes, which is all the index needs besides the full-precision matrix.
+        """
+        return self.codes.nbytes
+
+    def candidate_scores(self, query: np.ndarray) -> np.ndarray:
+        """
+        Approximate similarity of a normalized query to every row, computed from the codes alone:
+        minus the number of dimensions whose signs differ.
+        """
+        query_code = pack_signs(query)
+        distances = np.empty(len(self.codes), dtype=np.int32)
+        for start in range(0, len(self.codes), self.block_size):
+            block = self.codes[start:start + self.block_size]
+            distances[start:start + len(block)] = popcount(np.bitwise_xor(block, query_code)).sum(axis=1)
+        return -distances
+
+    def search(self, query_vec: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the k rows most similar to the query vector among the best n_candidates by code similarity.
+        Args:
+            query_vec (numpy array): embedding vector representing the query
+            k (int): number of rows to return
+
+        Returns:
+            Store row positions and exact cosine similarities of the k best rows, from most to least similar
+        """
+        query = np.asarray(query_vec, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        candidates = np.sort(top_k(self.candidate_scores(query), max(k, self.n_candidates)))
+        scores = self.store.matrix[candidates] @ query
+        best = top_k(scores, k)
+        return candidates[best], scores[best]
+
+    def search_many(self, query_vecs: np.ndarray, k: int) -> tuple[list[np.ndarray], list[np.ndarray]]:
+        """
+        Runs search for each of several query vectors.
+        Args:
+            query_vecs (numpy array): (Q, dim) matrix of query embeddings
+            k (int): number of rows to return per query
+
+        Returns:
+            Lists of store row positions and exact cosine similarities for each query
+        """
+        results = [self.search(query_vec, k) for query_vec in np.atleast_2d(query_vecs)]
+        return [rows for rows, _ in results], [scores for _, scores in results]
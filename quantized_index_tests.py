@@ -0,0 +1,53 @@
+import unittest
+import numpy as np
+from quantized_index import QuantizedIndex, pack_signs, popcount64
+from vector_store import VectorStore
+
+
+class TestQuantizedIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        rng = np.random.default_rng(0)
+        self.store = VectorStore(rng.standard_normal((3000, 64)))
+        self.queries = rng.standard_normal((20, 64))
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            QuantizedIndex(self.store, 'int8')
+
+    def test_code_sizes(self):
+        self.assertEqual(QuantizedIndex(self.store, 'binary').codes.shape, (3000, 1))
+        self.assertLess(QuantizedIndex(self.store, 'binary').nbytes, self.store.matrix.nbytes / 30)
+
+    def test_popcount(self):
+        values = np.array([0, 1, 0b1011, 2 ** 64 - 1], dtype=np.uint64)
+        self.assertListEqual(popcount64(values).tolist(), [0, 1, 3, 64])
+
+    def test_pack_signs_pads_to_words(self):
+        codes = pack_signs(np.array([[1.0, -1.0, 1.0]]))
+        self.assertEqual(codes.shape, (1, 1))
+        self.assertEqual(int(popcount64(codes).sum()), 2)
+
+    def test_hamming_distances(self):
+        index = QuantizedIndex(self.store, block_size=100)
+        query = self.store.matrix[0]
+        distances = ((self.store.matrix > 0) != (query > 0)).sum(axis=1)
+        self.assertListEqual(index.candidate_scores(query).tolist(), (-distances).tolist())
+
+    def test_rescored_results_are_exact(self):
+        index = QuantizedIndex(self.store, n_candidates=len(self.store))
+        for query in self.queries:
+            rows, scores = index.search(query, 3)
+            exact_rows, exact_scores = self.store.search(query, 3)
+            self.assertListEqual(rows.tolist(), exact_rows.tolist())
+            np.testing.assert_allclose(scores, exact_scores, rtol=1e-5)
+
+    def test_recall(self):
+        index = QuantizedIndex(self.store, n_candidates=500)
+        hits = sum(len(set(index.search(query, 3)[0].tolist()) & set(self.store.search(query, 3)[0].tolist()))
+                   for query in self.queries)
+        self.assertGreaterEqual(hits / (3 * len(self.queries)), 0.95)
+
+
+if __name__ == '__main__':
+    unittest.main()
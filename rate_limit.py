@@ -0,0 +1,87 @@
+""" Rate limiting and retrying of the requests sent to the Mistral API"""
+
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket shared by the threads of a process: tokens are added at rate per second, up to burst,
+    and every request takes one, waiting until there is one to take.
+    """
+    def __init__(self, rate: float, burst: int = 1, clock=time.monotonic, sleep=time.sleep):
+        """
+        Args:
+            rate (float): requests per second in the long run
+            burst (int): number of requests that can be sent at once after a pause
+            clock: function returning the current time in seconds
+            sleep: function waiting a number of seconds
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(self.burst)
+        self.updated = clock()
+        self.lock = threading.Lock()
+        self.waited = 0.0
+
+    def acquire(self) -> float:
+        """
+        Takes a token, waiting for one if the bucket is empty.
+        Returns:
+            Seconds waited
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the token is taken now, and the bucket goes into debt until it is refilled
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += wait
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 8.0) -> float:
+    """
+    Seconds to wait before retry number attempt (from 1): exponential with full jitter,
+    so that threads which failed together do not retry together.
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def call_with_retries(call, retries: int, retryable, base: float = 0.5, cap: float = 8.0, sleep=time.sleep,
+                      on_retry=None):
+    """
+    Calls call, calling it again after a backoff_delay when it raises an error that retryable accepts,
+    at most retries more times.
+    Args:
+        call: function without arguments
+        retries (int): number of retries after the first attempt
+        retryable: function (exception) -> whether the call may succeed if it is made again
+        base (float): delay before the first retry, before jitter
+        cap (float): longest delay, before jitter
+        sleep: function waiting a number of seconds
+        on_retry: optional function (attempt, exception, delay) called before every retry, e.g. for logging
+
+    Returns:
+        What call returned
+    """
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except Exception as error:
+            attempt += 1
+            if attempt > retries or not retryable(error):
+                raise
+            delay = backoff_delay(attempt, base, cap)
+            if on_retry is not None:
+                on_retry(attempt, error, delay)
+            sleep(delay)
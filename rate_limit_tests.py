@@ -0,0 +1,90 @@
+import threading
+import unittest
+from rate_limit import TokenBucket, backoff_delay, call_with_retries
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, clock=clock, sleep=clock.sleep)
+        waits = [bucket.acquire() for _ in range(5)]
+        self.assertEqual(waits, [0, 0.5, 0.5, 0.5, 0.5])
+        self.assertEqual(clock.now, 2.0)
+
+    def test_burst_after_a_pause(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1, burst=3, clock=clock, sleep=clock.sleep)
+        clock.now = 100.0
+        self.assertEqual([bucket.acquire() for _ in range(4)], [0, 0, 0, 1.0])
+
+    def test_threads_share_the_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, clock=clock, sleep=lambda seconds: None)
+        threads = [threading.Thread(target=bucket.acquire) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the waits are handed out in turn, 0.1 s apart
+        self.assertAlmostEqual(bucket.waited, sum(0.1 * i for i in range(8)))
+
+    def test_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(0)
+
+
+class TestRetries(unittest.TestCase):
+    def test_retries_until_success(self):
+        calls, sleeps = [], []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ConnectionError("reset")
+            return "ok"
+
+        result = call_with_retries(flaky, 3, lambda error: isinstance(error, ConnectionError), sleep=sleeps.append)
+        self.assertEqual((result, len(calls), len(sleeps)), ("ok", 3, 2))
+
+    def test_gives_up(self):
+        calls = []
+
+        def failing():
+            calls.append(1)
+            raise ConnectionError("reset")
+
+        with self.assertRaises(ConnectionError):
+            call_with_retries(failing, 2, lambda error: True, sleep=lambda seconds: None)
+        self.assertEqual(len(calls), 3)
+
+    def test_other_errors_are_not_retried(self):
+        calls = []
+
+        def failing():
+            calls.append(1)
+            raise ValueError("bad request")
+
+        with self.assertRaises(ValueError):
+            call_with_retries(failing, 5, lambda error: isinstance(error, ConnectionError), sleep=lambda s: None)
+        self.assertEqual(len(calls), 1)
+
+    def test_backoff_delay(self):
+        for attempt in range(1, 10):
+            self.assertLessEqual(backoff_delay(attempt, base=0.5, cap=8), min(8, 0.5 * 2 ** (attempt - 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
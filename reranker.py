@@ -0,0 +1,119 @@
+""" Rerankers choosing the book that best answers a question among the retrieved ones"""
+
+import threading
+from abc import ABC, abstractmethod
+import numpy as np
+import llm
+from llm import book_context
+
+# a MiniLM cross-encoder trained on MS MARCO passage ranking, small enough to score a few books on a CPU
+CROSS_ENCODER_NAME = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+
+
+class Reranker(ABC):
+    """
+    Scores how well each retrieved book answers a question and chooses the best one.
+    Subclasses implement scores; choose picks the highest score, preferring the higher-ranked book on ties.
+    """
+    name = ''
+
+    @abstractmethod
+    def scores(self, question: str, contexts: list[dict]) -> np.ndarray:
+        """
+        Args:
+            question (str): user's question
+            contexts (list[dict]): retrieved books, from most to least similar
+
+        Returns:
+            One score per book, higher is better
+        """
+
+    def choose(self, question: str, contexts: list[dict]) -> dict:
+        """
+        Returns the book that best answers the question, e.g. as the choose function of pipeline.speculative_answer.
+        """
+        if len(contexts) == 1:
+            return contexts[0]
+        return contexts[int(np.argmax(self.scores(question, contexts)))]
+
+    def warm_up(self) -> None:
+        """
+        Loads whatever the reranker needs, so that the first request does not wait for it.
+        """
+
+
+class LLMReranker(Reranker):
+    """
+    Asks Mistral to choose, see llm.choose_best_book. The chosen book scores 1 and the others 0.
+    """
+    name = 'llm'
+
+    def scores(self, question: str, contexts: list[dict]) -> np.ndarray:
+        chosen = self.choose(question, contexts)
+        return np.array([float(context is chosen) for context in contexts])
+
+    def choose(self, question: str, contexts: list[dict]) -> dict:
+        return llm.choose_best_book(question, contexts)
+
+    def warm_up(self) -> None:
+        llm.get_client()
+
+
+class CrossEncoderReranker(Reranker):
+    """
+    Scores every (question, context) pair with a local cross-encoder, in one batch.
+    Unlike the LLM reranker, it costs no network round trip and can rank any number of books.
+    """
+    name = 'cross-encoder'
+
+    def __init__(self, model_name: str = CROSS_ENCODER_NAME, model=None, batch_size: int = 32,
+                 max_length: int = 512):
+        """
+        Args:
+            model_name (str): name of the SentenceTransformers CrossEncoder to load on first use
+            model: an already loaded CrossEncoder, or anything with the same predict method
+            batch_size (int): number of pairs scored together
+            max_length (int): number of tokens of each pair the model reads, the rest of the context is cut off
+        """
+        self.model_name = model_name
+        self.model = model
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.lock = threading.Lock()
+
+    def get_model(self):
+        """
+        Returns the cross-encoder, loading it on first use. sentence_transformers imports torch,
+        so the import is deferred too.
+        """
+        if self.model is None:
+            with self.lock:
+                if self.model is None:
+                    from sentence_transformers import CrossEncoder
+                    self.model = CrossEncoder(self.model_name, max_length=self.max_length)
+        return self.model
+
+    def scores(self, question: str, contexts: list[dict]) -> np.ndarray:
+        pairs = [(question, book_context(context)) for context in contexts]
+        return np.asarray(self.get_model().predict(pairs, batch_size=self.batch_size, show_progress_bar=False),
+                          dtype=np.float32).ravel()
+
+    def warm_up(self) -> None:
+        self.scores("warm up", [{"context": "warm up"}])
+
+
+RERANKERS = {'llm': LLMReranker, 'cross-encoder': CrossEncoderReranker}
+
+
+def make_reranker(name: str) -> Reranker:
+    """
+    Creates a reranker by name.
+    Args:
+        name (str): 'llm' or 'cross-encoder'
+
+    Returns:
+        The reranker
+    """
+    if name not in RERANKERS:
+        raise ValueError(f"Unknown reranker {name!r}, use one of {', '.join(RERANKERS)}")
+    return RERANKERS[name]()
@@ -0,0 +1,67 @@
+import unittest
+from unittest import mock
+import numpy as np
+from reranker import CrossEncoderReranker, LLMReranker, make_reranker
+
+BOOKS = [{'title': title, 'context': context} for title, context in [
+    ('Dune', 'Paul Atreides leads the Fremen of the desert planet Arrakis.'),
+    ('The Hobbit', 'Bilbo Baggins joins a company of dwarves to fight a dragon.'),
+    ('Fool Moon', 'Harry Dresden hunts werewolves in Chicago.'),
+    ('Moon Dust', 'Astronauts are trapped under the dust of the moon.')]]
+
+
+class OverlapModel:
+    """
+    Scores a pair by the number of words the question and context share.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, pairs, batch_size=32, show_progress_bar=False):
+        self.calls.append(list(pairs))
+        return np.array([len(set(question.lower().split()) & set(context.lower().rstrip('.').split()))
+                         for question, context in pairs], dtype=np.float32)
+
+
+class TestCrossEncoderReranker(unittest.TestCase):
+    def test_scores_all_candidates_in_one_batch(self):
+        model = OverlapModel()
+        reranker = CrossEncoderReranker(model=model)
+        chosen = reranker.choose('who hunts werewolves in chicago', BOOKS)
+        self.assertEqual(chosen['title'], 'Fool Moon')
+        self.assertEqual(len(model.calls), 1)
+        self.assertEqual([context for _, context in model.calls[0]], [book['context'] for book in BOOKS])
+
+    def test_ties_keep_the_retrieval_order(self):
+        reranker = CrossEncoderReranker(model=OverlapModel())
+        self.assertEqual(reranker.choose('no shared words', BOOKS)['title'], 'Dune')
+
+    def test_single_candidate_is_not_scored(self):
+        model = OverlapModel()
+        self.assertIs(CrossEncoderReranker(model=model).choose('dragon', BOOKS[1:2]), BOOKS[1])
+        self.assertEqual(model.calls, [])
+
+
+class TestLLMReranker(unittest.TestCase):
+    def test_mistral_chooses(self):
+        with mock.patch('llm.chat', return_value='Context 2') as chat:
+            reranker = LLMReranker()
+            self.assertIs(reranker.choose('who fights a dragon', BOOKS[:3]), BOOKS[1])
+            self.assertEqual(reranker.scores('who fights a dragon', BOOKS[:3]).tolist(), [0.0, 1.0, 0.0])
+        self.assertIn('Context 3:', chat.call_args[0][0][1].content)
+
+    def test_unreadable_reply_picks_the_first(self):
+        with mock.patch('llm.chat', return_value='I cannot tell.'), self.assertLogs('llm', 'WARNING'):
+            self.assertIs(LLMReranker().choose('who fights a dragon', BOOKS[:3]), BOOKS[0])
+
+
+class TestMakeReranker(unittest.TestCase):
+    def test_by_name(self):
+        self.assertIsInstance(make_reranker('llm'), LLMReranker)
+        self.assertIsInstance(make_reranker('cross-encoder'), CrossEncoderReranker)
+        with self.assertRaises(ValueError):
+            make_reranker('bm25')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+""" Finds the books a question names by their title, so that retrieval can skip the encoder and the vector search"""
+
+import re
+import threading
+import time
+import unicodedata
+import numpy as np
+import pandas as pd
+
+# a word, possibly with apostrophes inside it (curly ones are straightened first)
+WORD_PATTERN = re.compile(r"[^\W_]+(?:'[^\W_]+)*")
+# a phrase in straight or curly double quotes
+QUOTED_PATTERN = re.compile(r'"[^"]+"|“[^”]+”')
+# words that do not identify a title on their own, e.g. the novel "It" would otherwise match most questions
+STOPWORDS = frozenset("""a an and are as at be by did do does for from had has have he her him his how i in is it its
+me my no not of on or she so that the their them they this to was we were what when where which who whom whose why
+will with you your""".split())
+
+
+def tokenize(text: str) -> list[tuple[str, bool, bool]]:
+    """
+    Splits text into normalized words: lower case, without accents or apostrophes.
+    Args:
+        text (str): title, author or question
+
+    Returns:
+        List of (normalized word, whether the word was capitalized in text, whether it was in double quotes)
+    """
+    text = text.replace("’", "'").replace("‘", "'")
+    quotes = [match.span() for match in QUOTED_PATTERN.finditer(text)]
+    words = []
+    for match in WORD_PATTERN.finditer(text):
+        word = match[0]
+        plain = unicodedata.normalize("NFKD", word).encode("ascii", "ignore").decode() or word
+        quoted = any(start < match.start() and match.end() < end for start, end in quotes)
+        words.append((plain.lower().replace("'", ""), word[0].isupper(), quoted))
+    return words
+
+
+def normalize(text: str | None) -> tuple[str, ...]:
+    return tuple(word for word, _, _ in tokenize(text)) if text else ()
+
+
+def names_title(tokens: list[tuple[str, bool, bool]], start: int, end: int) -> bool:
+    """
+    Whether the words tokens[start:end], which spell a title, are written as one: in double quotes,
+    or with every word besides stopwords capitalized. A single capitalized word must not also be the first word
+    of the question, where any word is capitalized.
+    """
+    span = tokens[start:end]
+    if all(word in STOPWORDS for word, _, _ in span):
+        return False
+    if all(quoted for _, _, quoted in span):
+        return True
+    if end - start == 1 and start == 0 and len(tokens) > 1:
+        return False
+    return all(capitalized or word in STOPWORDS for word, capitalized, _ in span)
+
+
+def title_variants(title: str) -> set[tuple[str, ...]]:
+    """
+    Returns the ways a question may refer to a title: in full, without a subtitle after a colon,
+    and without a parenthesized suffix such as "(novel)".
+    """
+    variants = {title, title.split(":")[0], re.sub(r"\s*\([^)]*\)\s*$", "", title)}
+    return {normalize(variant) for variant in variants} - {()}
+
+
+class Trie:
+    """
+    Maps sequences of words to the rows of the books they name, and finds the longest sequence in a question.
+    """
+    def __init__(self):
+        self.root = {}
+
+    def add(self, words: tuple[str, ...], row: int) -> None:
+        node = self.root
+        for word in words:
+            node = node.setdefault(word, {})
+        # None cannot be a word, so it marks the end of a sequence
+        node.setdefault(None, []).append(row)
+
+    def matches(self, words: list[str]) -> list[tuple[int, int, list[int]]]:
+        """
+        Finds every sequence in the trie that occurs in words.
+        Returns:
+            List of (start, end, rows) with words[start:end] being the sequence
+        """
+        found = []
+        for start in range(len(words)):
+            node = self.root
+            for end in range(start, len(words)):
+                node = node.get(words[end])
+                if node is None:
+                    break
+                if None in node:
+                    found.append((start, end + 1, node[None]))
+        return found
+
+
+class TitleIndex:
+    """
+    Index of normalized book titles and authors. A question that names a title, such as
+    "Who is the main character of Fool Moon by Jim Butcher?", is resolved to the books with that title
+    (the longest title mentioned wins), narrowed down to the author if one is named too.
+    Titles only count when the question quotes them or capitalizes every word besides stopwords,
+    so that "what happens on the island" does not name "The Island"; single-word titles must also not be the first
+    word of the question, and titles made only of stopwords never count.
+    The index keeps counts of lookups, hits and the time spent looking up.
+    """
+    def __init__(self, titles: list[str | None], authors: list[str | None]):
+        """
+        Args:
+            titles (list[str]): title of the book in each row
+            authors (list[str]): author of the book in each row, or None
+        """
+        self.titles = Trie()
+        self.authors = Trie()
+        self.book_authors = [normalize(author) for author in authors]
+        for row, (title, author) in enumerate(zip(titles, self.book_authors)):
+            for variant in title_variants(title or ""):
+                self.titles.add(variant, row)
+            if author:
+                self.authors.add(author, row)
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.ambiguous = 0
+        self.seconds = 0.0
+
+    def __len__(self) -> int:
+        return len(self.book_authors)
+
+    @classmethod
+    def from_df(cls, data_df: pd.DataFrame) -> "TitleIndex":
+        """
+        Builds an index whose rows line up with the rows of a dataframe made by make_book_df.
+        """
+        return cls(data_df["title"].tolist(), data_df["author"].tolist())
+
+    def find(self, query: str) -> list[int]:
+        """
+        Finds the books a question names by title.
+        Args:
+            query (str): user's question
+
+        Returns:
+            Rows of the books with the longest title mentioned in the question, in row order; empty if none is
+        """
+        tokens = tokenize(query)
+        words = [word for word, _, _ in tokens]
+        best = None
+        for start, end, rows in self.titles.matches(words):
+            if not names_title(tokens, start, end):
+                continue
+            # prefer the longest title, then the first one mentioned
+            if best is None or end - start > best[1] - best[0]:
+                best = (start, end, rows)
+        if best is None:
+            return []
+        rows = sorted(set(best[2]))
+        if len(rows) > 1:
+            # several books share the title, keep those by an author the question names
+            authors = {self.book_authors[row] for _, _, author_rows in self.authors.matches(words)
+                       for row in author_rows}
+            rows = [row for row in rows if self.book_authors[row] in authors] or rows
+        return rows
+
+    def lookup(self, query: str, max_books: int) -> np.ndarray | None:
+        """
+        Finds the books a question names by title and records the lookup in the statistics.
+        Args:
+            query (str): user's question
+            max_books (int): the most books to return; if more books have the title, the lookup is a miss
+
+        Returns:
+            Rows of the named books, or None if the question names no title or too many books have it
+        """
+        start = time.perf_counter()
+        rows = self.find(query)
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.lookups += 1
+            self.seconds += seconds
+            if len(rows) > max_books:
+                self.ambiguous += 1
+            elif rows:
+                self.hits += 1
+        return np.array(rows, dtype=np.intp) if 0 < len(rows) <= max_books else None
+
+    def stats(self) -> dict[str, float]:
+        with self.lock:
+            return {'books': len(self), 'lookups': self.lookups, 'hits': self.hits, 'ambiguous': self.ambiguous,
+                    'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+                    'mean_lookup_ms': self.seconds / self.lookups * 1000 if self.lookups else 0.0}
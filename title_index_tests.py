@@ -0,0 +1,73 @@
+import unittest
+import numpy as np
+import pandas as pd
+from title_index import TitleIndex, normalize, title_variants
+
+
+class TestNormalize(unittest.TestCase):
+    def test_normalize(self):
+        self.assertEqual(normalize("Ender’s Game"), ("enders", "game"))
+        self.assertEqual(normalize("Madeleine L'Engle"), ("madeleine", "lengle"))
+        self.assertEqual(normalize("Les Misérables"), ("les", "miserables"))
+        self.assertEqual(normalize(None), ())
+
+    def test_title_variants(self):
+        self.assertEqual(title_variants("Ali and Nino: A Love Story"),
+                         {("ali", "and", "nino", "a", "love", "story"), ("ali", "and", "nino")})
+        self.assertEqual(title_variants("Eclipse (novel)"), {("eclipse", "novel"), ("eclipse",)})
+
+
+class TestTitleIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = TitleIndex.from_df(pd.DataFrame({
+            "title": ["Eclipse", "Eclipse", "Ender's Game", "The Game", "It", "Mistborn: The Well of Ascension"],
+            "author": ["Stephenie Meyer", "John Banville", "Orson Scott Card", "Diana Wynne Jones", "Stephen King",
+                       None]}))
+
+    def test_longest_title_wins(self):
+        self.assertEqual(self.index.find("What school does Ender attend in Ender’s Game?"), [2])
+        self.assertEqual(self.index.find("Who is the main character of The Game?"), [3])
+
+    def test_subtitle(self):
+        self.assertEqual(self.index.find("Who is the main character of Mistborn?"), [5])
+        self.assertEqual(self.index.find("Who is the main character of Mistborn: The Well of Ascension?"), [5])
+
+    def test_author_narrows_shared_title(self):
+        self.assertEqual(self.index.find("Where does Eclipse take place?"), [0, 1])
+        self.assertEqual(self.index.find("Where does Eclipse by Stephenie Meyer take place?"), [0])
+        # an author who wrote none of the books does not remove them
+        self.assertEqual(self.index.find("Where does Eclipse by Jim Butcher take place?"), [0, 1])
+
+    def test_single_words_must_be_capitalized(self):
+        self.assertEqual(self.index.find("when is the next eclipse?"), [])
+        self.assertEqual(self.index.find("Eclipse of the sun, when is it?"), [])
+        self.assertEqual(self.index.find("Eclipse"), [0, 1])
+
+    def test_lowercase_phrases_do_not_match(self):
+        index = TitleIndex.from_df(pd.DataFrame({"title": ["The Island", "The War", "The Road"],
+                                                 "author": [None, None, None]}))
+        self.assertEqual(index.find("what happens on the island after the storm?"), [])
+        self.assertEqual(index.find("What happened after the war ended?"), [])
+        self.assertEqual(index.find("The road to the castle, who walks it?"), [])
+        self.assertEqual(index.find("Who walks down The Road?"), [2])
+        self.assertEqual(index.find("What happens on The Island?"), [0])
+
+    def test_quoted_titles_match(self):
+        self.assertEqual(self.index.find('who is the main character of "the game"?'), [3])
+        self.assertEqual(self.index.find("where does “eclipse” take place?"), [0, 1])
+        self.assertEqual(self.index.find("who is the main character of the game?"), [])
+
+    def test_stopword_titles_never_match(self):
+        self.assertEqual(self.index.find("How does It die?"), [])
+
+    def test_lookup_stats(self):
+        self.assertTrue(np.array_equal(self.index.lookup("Who wrote Ender's Game?", 3), [2]))
+        self.assertIsNone(self.index.lookup("Who wrote Eclipse?", 1))
+        self.assertIsNone(self.index.lookup("Which book has a spider?", 3))
+        stats = self.index.stats()
+        self.assertEqual((stats["lookups"], stats["hits"], stats["ambiguous"]), (3, 1, 1))
+        self.assertAlmostEqual(stats["hit_rate"], 1 / 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
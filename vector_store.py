@@ -0,0 +1,226 @@
+import glob
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Selects the k highest scores of every row without fully sorting the rows.
+    Ties are broken in favor of the lower row index.
+    Args:
+        scores (numpy array): (Q, N) matrix of scores, or a single (N,) vector
+        k (int): number of indices to select per row
+
+    Returns:
+        (Q, k) matrix (or (k,) vector) of column indices, ordered from highest to lowest score
+    """
+    single = scores.ndim == 1
+    scores = np.atleast_2d(scores)
+    n = scores.shape[1]
+    k = max(0, min(k, n))
+    if k == 0:
+        candidates = np.empty((scores.shape[0], 0), dtype=np.intp)
+    elif k < n:
+        candidates = np.sort(np.argpartition(-scores, k - 1, axis=1)[:, :k], axis=1)
+    else:
+        candidates = np.broadcast_to(np.arange(n), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind='stable')
+    rows = np.take_along_axis(candidates, order, axis=1)
+    return rows[0] if single else rows
+
+
+class VectorStore:
+    """
+    Read-only store of book embeddings kept as one contiguous, L2-normalized float32 matrix,
+    so that cosine similarity against every book is a single matrix-vector product.
+    Row i of the matrix belongs to the book with id ids[i].
+    """
+    def __init__(self, embeddings: np.ndarray, ids: np.ndarray | None = None, normalized: bool = False):
+        """
+        Args:
+            embeddings (numpy array): (N, dim) matrix of book embeddings
+            ids (numpy array): book id for each row, defaults to the row positions
+            normalized (bool): whether the rows of embeddings are already L2-normalized float32 vectors,
+                in which case a C-contiguous matrix (such as a read-only memmap) is used without copying it
+        """
+        if normalized:
+            matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+        else:
+            matrix = np.array(embeddings, dtype=np.float32, order='C', ndmin=2)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            # leave all-zero embeddings as zeros instead of dividing by zero
+            norms[norms == 0] = 1
+            matrix /= norms
+        if matrix.flags.writeable:
+            matrix.flags.writeable = False
+        self.matrix = matrix
+        self.ids = np.arange(len(matrix)) if ids is None else np.asarray(ids)
+        self.id_to_row = {book_id: row for row, book_id in enumerate(self.ids.tolist())}
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    def __deepcopy__(self, memo: dict) -> "VectorStore":
+        # the store is read-only, so copies of the dataframe it is attached to can share it
+        return self
+
+    @classmethod
+    def from_df(cls, data_df: pd.DataFrame) -> "VectorStore":
+        """
+        Builds a store from a dataframe with an embedding column (and optionally an id column).
+        Args:
+            data_df (pd.DataFrame): Dataframe containing embedding column of numpy array embedding vectors
+
+        Returns:
+            VectorStore whose rows line up with the rows of data_df
+        """
+        if len(data_df) == 0:
+            embeddings = np.zeros((0, 0), dtype=np.float32)
+        else:
+            embeddings = np.stack(data_df['embedding'].to_numpy())
+        ids = data_df['id'].to_numpy() if 'id' in data_df else None
+        return cls(embeddings, ids)
+
+    def matches(self, data_df: pd.DataFrame) -> bool:
+        """
+        Checks that the rows of this store line up with the rows of data_df.
+        """
+        if len(self) != len(data_df):
+            return False
+        if 'id' in data_df:
+            return np.array_equal(self.ids, data_df['id'].to_numpy())
+        return True
+
+    def search(self, query_vec: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the k rows most similar to the query vector.
+        Args:
+            query_vec (numpy array): embedding vector representing the query
+            k (int): number of rows to return
+
+        Returns:
+            Row positions and cosine similarities of the k most similar rows, from most to least similar
+        """
+        if len(self) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        query = np.asarray(query_vec, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        scores = self.matrix @ query
+        rows = top_k(scores, k)
+        return rows, scores[rows]
+
+    def search_many(self, query_vecs: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the k rows most similar to each of several query vectors at once.
+        Args:
+            query_vecs (numpy array): (Q, dim) matrix of query embeddings
+            k (int): number of rows to return per query
+
+        Returns:
+            (Q, k) matrices of row positions and cosine similarities, each row ordered from most to least similar
+        """
+        queries = np.array(query_vecs, dtype=np.float32, ndmin=2)
+        if len(self) == 0:
+            # an empty store has no dimension to multiply the queries with
+            return np.empty((len(queries), 0), dtype=np.intp), np.empty((len(queries), 0), dtype=np.float32)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        queries /= norms
+        scores = queries @ self.matrix.T
+        rows = top_k(scores, k)
+        return rows, np.take_along_axis(scores, rows, axis=1)
+
+
+def get_vector_store(data_df: pd.DataFrame) -> VectorStore:
+    """
+    Returns the vector store attached to data_df, building and attaching one if it is missing or stale.
+    Args:
+        data_df (pd.DataFrame): Dataframe containing embedding column of numpy array embedding vectors
+
+    Returns:
+        VectorStore whose rows line up with the rows of data_df
+    """
+    store = data_df.attrs.get('vector_store')
+    if store is None or not store.matches(data_df):
+        store = VectorStore.from_df(data_df)
+        data_df.attrs['vector_store'] = store
+    return store
+
+
+def sidecar_data_path(path: str, metadata: dict) -> str:
+    """
+    Returns the name of the file holding the matrix described by metadata: path with a hash of the metadata
+    inserted before its extension, e.g. books_db.embeddings.0123456789abcdef.npy.
+    """
+    key = hashlib.sha256(json.dumps(metadata, sort_keys=True).encode()).hexdigest()[:16]
+    root, ext = os.path.splitext(path)
+    return f'{root}.{key}{ext}'
+
+
+def save_sidecar(store: VectorStore, path: str, metadata: dict) -> None:
+    """
+    Writes the normalized matrix of a store to a .npy file that can later be memory-mapped,
+    along with a JSON file (path + '.json') describing what the matrix was built from.
+    The matrix goes to a file named after its metadata (see sidecar_data_path) that the JSON file points to,
+    so replacing the JSON file switches readers to the new matrix at once, and a reader never pairs
+    the metadata of one matrix with another. Both files are written to temporary names first,
+    so readers never see a partially written file. Matrices the JSON file no longer points to are then deleted.
+    Args:
+        store (VectorStore): store to save
+        path (str): path of the .npy file
+        metadata (dict): values that must match when the sidecar is loaded again, e.g. model name and checksum
+    """
+    metadata = {**metadata, 'rows': len(store), 'dim': store.matrix.shape[1], 'dtype': 'float32'}
+    data_path = sidecar_data_path(path, metadata)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, store.matrix)
+    os.replace(tmp_path, data_path)
+    with open(tmp_path, 'w') as f:
+        json.dump({**metadata, 'file': os.path.basename(data_path)}, f)
+    os.replace(tmp_path, path + '.json')
+    root, ext = os.path.splitext(path)
+    for old_path in glob.glob(f'{glob.escape(root)}.{"[0-9a-f]" * 16}{ext}'):
+        if old_path != data_path:
+            try:
+                # processes that memory-mapped the old matrix keep their mapping
+                os.remove(old_path)
+            except OSError:
+                pass
+
+
+def load_sidecar(path: str, ids: np.ndarray, metadata: dict) -> VectorStore | None:
+    """
+    Opens a sidecar written by save_sidecar as a read-only memmap, so that every process
+    that opens it shares the same pages of the operating system's page cache.
+    Args:
+        path (str): path of the .npy file
+        ids (numpy array): book id for each row
+        metadata (dict): values the sidecar must have been saved with
+
+    Returns:
+        VectorStore backed by the memmap, or None if the sidecar is missing or stale
+    """
+    # a second attempt covers a writer deleting the matrix between reading the JSON file and opening the matrix
+    for _ in range(2):
+        try:
+            with open(path + '.json') as f:
+                saved = json.load(f)
+            matrix = np.load(os.path.join(os.path.dirname(path), saved['file']), mmap_mode='r')
+            break
+        except (OSError, ValueError, KeyError):
+            continue
+    else:
+        return None
+    expected = {**metadata, 'rows': len(ids), 'dtype': 'float32'}
+    if any(saved.get(key) != value for key, value in expected.items()):
+        return None
+    if matrix.dtype != np.float32 or matrix.ndim != 2 or matrix.shape != (saved['rows'], saved['dim']):
+        return None
+    return VectorStore(matrix, ids, normalized=True)
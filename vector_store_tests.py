@@ -0,0 +1,116 @@
+import glob
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from vector_store import VectorStore, get_vector_store, load_sidecar, save_sidecar, top_k
+
+
+class TestTopK(unittest.TestCase):
+    def test_vector(self):
+        scores = np.array([0.1, 0.9, 0.3, 0.7])
+        self.assertListEqual(top_k(scores, 2).tolist(), [1, 3])
+
+    def test_ties_prefer_lower_index(self):
+        scores = np.array([0.5, 0.9, 0.5, 0.5])
+        self.assertListEqual(top_k(scores, 3).tolist(), [1, 0, 2])
+
+    def test_matrix(self):
+        scores = np.array([[0.1, 0.9, 0.3],
+                           [0.8, 0.2, 0.4]])
+        self.assertListEqual(top_k(scores, 2).tolist(), [[1, 2], [0, 2]])
+
+    def test_k_larger_than_n(self):
+        scores = np.array([0.2, 0.4])
+        self.assertListEqual(top_k(scores, 5).tolist(), [1, 0])
+
+
+class TestVectorStore(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({'id': [10, 11, 12],
+                                'embedding': [np.array([3.0, 0, 0]),
+                                              np.array([1.0, 0, 1]),
+                                              np.array([0, 0, 0.0])]})
+
+    def test_matrix_is_normalized_float32(self):
+        store = VectorStore.from_df(self.df)
+        self.assertEqual(store.matrix.dtype, np.float32)
+        self.assertTrue(store.matrix.flags.c_contiguous)
+        self.assertFalse(store.matrix.flags.writeable)
+        np.testing.assert_allclose(np.linalg.norm(store.matrix, axis=1), [1, 1, 0], atol=1e-6)
+
+    def test_id_mapping(self):
+        store = VectorStore.from_df(self.df)
+        self.assertEqual(store.id_to_row, {10: 0, 11: 1, 12: 2})
+
+    def test_search(self):
+        store = VectorStore.from_df(self.df)
+        rows, scores = store.search(np.array([2.0, 0, 2.0]), 2)
+        self.assertListEqual(rows.tolist(), [1, 0])
+        np.testing.assert_allclose(scores, [1, np.sqrt(0.5)], rtol=1e-6)
+
+    def test_search_many_matches_search(self):
+        store = VectorStore(np.random.default_rng(0).standard_normal((50, 8)))
+        queries = np.random.default_rng(1).standard_normal((5, 8))
+        rows, scores = store.search_many(queries, 4)
+        for query, query_rows, query_scores in zip(queries, rows, scores):
+            single_rows, single_scores = store.search(query, 4)
+            self.assertListEqual(query_rows.tolist(), single_rows.tolist())
+            np.testing.assert_allclose(query_scores, single_scores, rtol=1e-5)
+
+    def test_empty_store(self):
+        store = VectorStore.from_df(self.df.iloc[:0])
+        rows, scores = store.search(np.ones(3), 2)
+        self.assertEqual((len(rows), len(scores)), (0, 0))
+        rows, scores = store.search_many(np.ones((2, 3)), 2)
+        self.assertEqual((rows.shape, scores.shape), ((2, 0), (2, 0)))
+
+    def test_get_vector_store_is_cached(self):
+        store = get_vector_store(self.df)
+        self.assertIs(get_vector_store(self.df), store)
+        # a dataframe with different rows gets its own store
+        subset = self.df.iloc[:2]
+        self.assertIsNot(get_vector_store(subset), store)
+
+
+
+class TestSidecar(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'embeddings.npy')
+        self.ids = np.array([4, 5, 6])
+        self.store = VectorStore(np.random.default_rng(0).standard_normal((3, 8)), self.ids)
+        save_sidecar(self.store, self.path, {'model': 'model', 'checksum': 'abc'})
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        store = load_sidecar(self.path, self.ids, {'model': 'model', 'checksum': 'abc'})
+        self.assertIsNotNone(store)
+        self.assertIsInstance(store.matrix.base, np.memmap)
+        self.assertFalse(store.matrix.flags.writeable)
+        np.testing.assert_array_equal(store.matrix, self.store.matrix)
+        self.assertEqual(store.id_to_row, self.store.id_to_row)
+
+    def test_stale(self):
+        self.assertIsNone(load_sidecar(self.path, self.ids, {'model': 'other model', 'checksum': 'abc'}))
+        self.assertIsNone(load_sidecar(self.path, self.ids, {'model': 'model', 'checksum': 'def'}))
+        self.assertIsNone(load_sidecar(self.path, np.array([4, 5]), {'model': 'model', 'checksum': 'abc'}))
+
+    def test_matrix_file_is_tied_to_metadata(self):
+        other = VectorStore(np.random.default_rng(1).standard_normal((3, 8)), self.ids)
+        save_sidecar(other, self.path, {'model': 'model', 'checksum': 'def'})
+        # the matrix saved first was replaced, and is not paired with the new metadata
+        self.assertEqual(len(glob.glob(os.path.join(self.tmpdir.name, 'embeddings.*.npy'))), 1)
+        self.assertIsNone(load_sidecar(self.path, self.ids, {'model': 'model', 'checksum': 'abc'}))
+        store = load_sidecar(self.path, self.ids, {'model': 'model', 'checksum': 'def'})
+        np.testing.assert_array_equal(store.matrix, other.matrix)
+
+    def test_missing(self):
+        self.assertIsNone(load_sidecar(self.path + '.missing', self.ids, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,13 @@
+""" WSGI entry point for production servers, e.g.
+
+$ gunicorn --bind 0.0.0.0:8080 --workers 2 --threads 8 wsgi:app
+
+Every worker process loads the books and the encoder once and then serves requests from all of its threads.
+Set BRAG_EMBEDDING_SIDECAR so that the workers share one memory-mapped copy of the embeddings,
+and BRAG_SECRET_KEY so that they accept each other's /stream links.
+"""
+
+from main import app
+
+if __name__ == '__main__':
+    app.run(threaded=True, port=8080, host="0.0.0.0")